@@ -3,14 +3,31 @@ Created on Aug 25, 2014
 
 @author: Filip Lindau
 '''
+import os
 import sys
 import PyTango
-import SPM002_control as spm
+try:
+    if os.environ.get('SPM002_DLL', '').lower() == 'photonspectr':
+        # Newer vendor DLL, adds on-device averaging and the correction tables
+        import SPM002_control_new as spm
+    else:
+        import SPM002_control as spm
+except (ImportError, NameError, OSError):
+    # No vendor DLL on this host (e.g. Linux), use the libusb backend. It
+    # only opens hardware with SPM002_USB_BACKEND=1, see SPM002_usb.py
+    import SPM002_usb as spm
 import threading
+import multiprocessing
 import time
 import numpy as np
 from socket import gethostname
 import Queue
+from SPM002_timing import monotonic, FramePacer
+from SPM002_calibration import CalibrationCache, loadCalibration
+from SPM002_ringbuffer import StaleFrameDetector
+from SPM002_exposure import AutoExposureController
+from SPM002_channel import ChannelHub, LATEST, LOSSLESS, DROP
+from SPM002_shm import SharedSpectrumRing, SharedMemoryError, ringName
 
 
 class SpectrometerCommand:
@@ -19,10 +36,22 @@ class SpectrometerCommand:
         self.data = data
 
 class SpectrometerDataMessage:
-    def __init__(self, serial, attribute, data=None):
+    def __init__(self, serial, attribute, data=None, sequence=None, startTime=None, endTime=None, timestamp=None,
+                 frames=None):
+        """For spectrum messages sequence is the per device frame number,
+        startTime and endTime are the monotonic times bracketing the
+        acquisition and timestamp is the wall clock time of the frame. If
+        frames is not None, data is a view into that SpectrumRingBuffer and
+        the receiver takes its copy with frames.copy(sequence).
+        """
         self.serial = serial
         self.attribute = attribute
         self.data = data
+        self.sequence = sequence
+        self.startTime = startTime
+        self.endTime = endTime
+        self.timestamp = timestamp
+        self.frames = frames
         
 class SpectrometerData:
     """Container class for spectrometer data. 
@@ -32,29 +61,84 @@ class SpectrometerData:
                 Used by the .dll for opening the correct spectrometer 
         lock: lock to prevent concurrency errors when accessing data
         commandQueue: queue for issuing commands to the spectrometer hardware thread
-        dataQueue: queue for receiving data from the spectrometer hardware thread
+        controlChannel: lossless channel for state, status and settings from the hardware thread
+        spectrumChannel: latest-wins channel for spectra from the hardware thread
+        logChannel: channel for log messages from the hardware thread, dropped when full
+        channels: the three channels, in the order of the ChannelDrops and ChannelHighWater attributes
         wavelengths (numpy array): wavelength calibration array
+        firmware: firmware version of the spectrometer, validates cached wavelength tables
         spectrum (numpy array): spectrum array
+        spectrumSequence: frame number of spectrum
+        spectrumStartTime, spectrumEndTime: monotonic acquisition start and end of spectrum
+        spectrumTimestamp: wall clock time of spectrum
+        droppedFrames: number of frames lost between the hardware thread and the master
         exposureTime: exposure time in ms during acquisition
+        average: number of exposures averaged on the device per spectrum
+        dark, linearity, specialPixels: correction tables stored in the spectrometer,
+                                        None if the backend has none
+        autoExposure: True if the exposure time is set by the AutoExposureController
         updateTime: time between acquisitions in ms
+        acquisitionMode: frame pacing mode, see SPM002_timing.FramePacer
+        achievedRate: measured acquisition rate in Hz
         state (PyTango.DevState): spectrometer state
         status (string): spectrometer status
-        hardwareThread: thread responsible for doing the actual hardware access
+        hardwareThread: thread responsible for doing the actual hardware access,
+                        a SpectrometerProcess in the process per spectrometer mode
+        ring: SharedSpectrumRing the applied spectra are published in for clients on
+              this host, None in the process per spectrometer mode where the worker writes it
+        attrNames: names of the dynamic attributes of the spectrometer with change events
     """
-    def __init__(self, serial, index, dataQueue):
+    def __init__(self, serial, index, dataHub, calibrationCache=None, staleTimeout=5.0, autoExposure=None, processMode=False):
         self.serial = serial
         self.index = index
         self.lock = threading.Lock()
-        self.commandQueue = Queue.Queue(100)
-        self.dataQueue = dataQueue
+        if processMode == True:
+            self.commandQueue = multiprocessing.Queue(100)
+        else:
+            self.commandQueue = Queue.Queue(100)
+        # Only the newest spectrum is ever applied, so one is enough
+        self.controlChannel = dataHub.channel(''.join((str(serial), ' control')), LOSSLESS, 100)
+        self.spectrumChannel = dataHub.channel(''.join((str(serial), ' spectrum')), LATEST, 1)
+        self.logChannel = dataHub.channel(''.join((str(serial), ' log')), DROP, 100)
+        self.channels = (self.spectrumChannel, self.controlChannel, self.logChannel)
         self.wavelengths = None
+        self.firmware = None
         self.spectrum = None
+        self.spectrumSequence = None
+        self.spectrumStartTime = None
+        self.spectrumEndTime = None
+        self.spectrumTimestamp = None
+        self.droppedFrames = 0
         self.exposureTime = None
+        self.average = 1
+        self.dark = None
+        self.linearity = None
+        self.specialPixels = None
+        self.autoExposure = False
         self.updateTime = None
+        self.acquisitionMode = None
+        self.achievedRate = 0.0
         self.state = None
         self.status = ''
+        # Dynamic attribute names, built once
+        self.attrNames = dict((name, ''.join(('Spectrometer', str(serial), name)))
+                              for name in ('Spectrum', 'ExposureTime', 'UpdateTime', 'State', 'Status'))
 
-        self.hardwareThread = SpectrometerThread(self, serial, index, self.commandQueue, self.dataQueue)
+        self.ring = None
+        if processMode == False:
+            try:
+                self.ring = SharedSpectrumRing(ringName(serial), create=True)
+            except (SharedMemoryError, EnvironmentError), e:
+                self.logChannel.put(SpectrometerDataMessage(serial, 'error', ''.join(('No shared memory spectrum ring: ', str(e)))))
+
+        if processMode == True:
+            self.hardwareThread = SpectrometerProcess(serial, index, self.commandQueue,
+                                                      self.controlChannel, self.spectrumChannel, self.logChannel,
+                                                      calibrationCache, staleTimeout, autoExposure)
+        else:
+            self.hardwareThread = SpectrometerThread(self, serial, index, self.commandQueue,
+                                                     self.controlChannel, self.spectrumChannel, self.logChannel,
+                                                     calibrationCache, staleTimeout, autoExposure)
         
     def startThread(self):
         self.stopThread()
@@ -66,14 +150,20 @@ class SpectrometerData:
             self.hardwareThread.join(3)
 
 class SpectrometerThread(threading.Thread):
-    def __init__(self, parent, serial, spectrometerIndex, commandQueue, dataQueue):
+    def __init__(self, parent, serial, spectrometerIndex, commandQueue, controlChannel, spectrumChannel, logChannel,
+                 calibrationCache=None, staleTimeout=5.0, autoExposure=None):
         """Init new SpectrometerThread.
         Args: 
             parent: parent self object
             serial: serial number of spectrometer
             commandQueue: queue for issuing commands to the spectrometer thread
-            dataQueue: queue for receiving responses from the spectrometer thread 
+            controlChannel: SPM002_channel.Channel for state, status and settings, lossless
+            spectrumChannel: Channel for spectra, latest-wins
+            logChannel: Channel for log messages, dropped when full so logging never stalls acquisition
             spectrometerIndex: list of the spectrometer as received by populateDeviceList
+            calibrationCache: CalibrationCache for the wavelength table, default directory if None
+            staleTimeout: time in s without a new spectrum before the spectrometer is reconnected
+            autoExposure: AutoExposureController used when auto exposure is on, default settings if None
             
             No locks are needed since all access to hardware and attributes are 
             within a single thread.
@@ -88,7 +178,9 @@ class SpectrometerThread(threading.Thread):
         self.status = ''
         self.stopStateThreadFlag = False
         self.commandQueue = commandQueue
-        self.dataQueue = dataQueue
+        self.controlChannel = controlChannel
+        self.spectrumChannel = spectrumChannel
+        self.logChannel = logChannel
         
         self.stateHandlerDict = {PyTango.DevState.ON: self.onHandler,
                                 PyTango.DevState.STANDBY: self.standbyHandler,
@@ -99,8 +191,19 @@ class SpectrometerThread(threading.Thread):
                                 PyTango.DevState.OFF: self.offHandler}
         
         self.expTime = None
+        self.average = 1
         self.wavelengths = None
         self.spectrumData = None
+        self.staleDetector = StaleFrameDetector(staleTimeout)
+        if autoExposure is None:
+            autoExposure = AutoExposureController()
+        self.autoExposure = autoExposure
+        self.pacer = FramePacer(0.5, FramePacer.FIXED_RATE)
+        if calibrationCache is None:
+            calibrationCache = CalibrationCache()
+        self.calibrationCache = calibrationCache
+        self.hotplug = None
+        self.deviceDeparted = False
 
         
     def run(self):
@@ -126,37 +229,76 @@ class SpectrometerThread(threading.Thread):
     def stopThread(self):
         """Stops the state handler thread by setting the stopStateThreadFlag
         """
+        if self.hotplug is not None:
+            self.hotplug.removeListener(self.hotplugEvent)
         self.stopStateThreadFlag = True
+
+    def hotplugEvent(self, event, key):
+        """Hotplug listener, called from the monitor thread. Departures of
+        other devices are ignored, arrivals are all queued since the serial
+        of a new device is not known yet.
+        """
+        if event == spm.HOTPLUG_LEFT and key != self.spectrometer.deviceHandle:
+            return
+        try:
+            self.commandQueue.put(SpectrometerCommand('hotplug', event), block=False)
+        except Queue.Full:
+            pass
         
     def checkCommands(self, blockTime=0):
         """Checks the commandQueue for new commands. Must be called regularly.
-        If the queue is empty the method exits immediately.
+        Waits at most blockTime s for a command, with blockTime <= 0 the
+        method exits immediately if the queue is empty.
         """
         try:
-            if blockTime == 0:
+            if blockTime <= 0:
                 cmd = self.commandQueue.get(block=False)
             else:
                 cmd = self.commandQueue.get(block=True, timeout=blockTime)
             self.info_stream(str(cmd.command))
             if cmd.command == 'writeExposureTime':
                 self.expTime = cmd.data
+                self.autoExposure.reset()
                 self.setExposure(True)
                 self.getExposure()
             elif cmd.command == 'readExposureTime':
                 self.getExposure()
+
+            elif cmd.command == 'writeAverage':
+                self.average = cmd.data
+                self.setAverage()
+
+            elif cmd.command == 'readAverage':
+                msg = SpectrometerDataMessage(self.serial, 'average', self.average)
+                self.controlChannel.put(msg)
                     
             elif cmd.command == 'writeUpdateTime':
                 self.updateTime = cmd.data
-                self.setExposure(True)
+                self.pacer.setPeriod(self.updateTime * 1e-3)
                 msg = SpectrometerDataMessage(self.serial, 'updatetime', self.updateTime)
-                self.dataQueue.put(msg, block=False)
+                self.controlChannel.put(msg)
                 
             elif cmd.command == 'readUpdateTime':
                 msg = SpectrometerDataMessage(self.serial, 'updatetime', self.updateTime)
-                self.dataQueue.put(msg, block=False)            
+                self.controlChannel.put(msg)
+
+            elif cmd.command == 'writeAcquisitionMode':
+                try:
+                    self.pacer.setMode(cmd.data)
+                except ValueError, e:
+                    self.error_stream(str(e))
+                msg = SpectrometerDataMessage(self.serial, 'acquisitionmode', self.pacer.mode)
+                self.controlChannel.put(msg)
+
+            elif cmd.command == 'readAcquisitionMode':
+                msg = SpectrometerDataMessage(self.serial, 'acquisitionmode', self.pacer.mode)
+                self.controlChannel.put(msg)
 
             elif cmd.command == 'writeAutoExposure':
                 self.autoExpose = cmd.data
+                self.autoExposure.reset()
+                msg = SpectrometerDataMessage(self.serial, 'autoexposure', self.autoExpose)
+                self.controlChannel.put(msg)
 
             elif cmd.command == 'on' or cmd.command == 'start':           
                 if self.state not in [PyTango.DevState.INIT, PyTango.DevState.UNKNOWN]:
@@ -176,10 +318,17 @@ class SpectrometerThread(threading.Thread):
             
             elif cmd.command == 'readWavelengths':
                 msg = SpectrometerDataMessage(self.serial, 'readWavelengths', self.wavelengths)
-                try:
-                    self.dataQueue.put_nowait(msg)
-                except:
-                    pass
+                self.controlChannel.put(msg)
+
+            elif cmd.command == 'hotplug':
+                if cmd.data == spm.HOTPLUG_LEFT:
+                    self.deviceDeparted = True
+                    self.setState(PyTango.DevState.FAULT)
+                    self.setStatus('Spectrometer disconnected, waiting for it to return')
+                    self.error_stream('Spectrometer disconnected')
+                elif self.deviceDeparted == True:
+                    # Possibly ours, faultHandler checks the serial
+                    self.deviceDeparted = False
 
 
         except Queue.Empty:
@@ -196,6 +345,7 @@ class SpectrometerThread(threading.Thread):
         self.expTime = 200
         self.updateTime = 500
         self.autoExpose = False
+        self.pacer.setPeriod(self.updateTime * 1e-3)
 
         while self.stopStateThreadFlag == False:
             try:
@@ -206,6 +356,9 @@ class SpectrometerThread(threading.Thread):
             self.info_stream('Trying to connect...')
             try:                
                 self.spectrometer = spm.SPM002control()
+                self.hotplug = spm.hotplugMonitor()
+                if self.hotplug is not None:
+                    self.hotplug.addListener(self.hotplugEvent)
                 self.setState(PyTango.DevState.INIT)
                 self.info_stream('... connected')
                 break
@@ -244,13 +397,18 @@ class SpectrometerThread(threading.Thread):
                 s_status = ''.join((s_status, s))
                 self.status = s_status
                 self.info_stream(s)
-                self.spectrometer.constructWavelengths()
+                if loadCalibration(self.spectrometer, self.serial, self.calibrationCache) == True:
+                    self.info_stream(''.join(('Wavelength table from cache ', self.calibrationCache.directory)))
                 self.wavelengths = self.spectrometer.wavelengths
                 # Immediately push wavelength table to device server:
                 msg = SpectrometerDataMessage(self.serial, 'wavelengths', self.wavelengths)
-                self.dataQueue.put(msg, block=False)
+                self.controlChannel.put(msg)
+                msg = SpectrometerDataMessage(self.serial, 'firmware', self.spectrometer.getFirmwareVersion())
+                self.controlChannel.put(msg)
+                self.setAverage()
+                self.readCorrectionTables()
             except Exception, e:
-                self.error_stream('Could not construct wavelengths')
+                self.error_stream(''.join(('Could not construct wavelengths ', str(e))))
                 continue
     
             self.status = 'Connected to spectrometer, not acquiring'
@@ -267,19 +425,31 @@ class SpectrometerThread(threading.Thread):
         maxAttempts = 5
         responseTimeout = 0.5
         self.info_stream('Entering faultHandler.')
-        self.status = 'Fault condition detected'
+        if self.deviceDeparted == False:
+            self.status = 'Fault condition detected'
         handledStates = [PyTango.DevState.FAULT]
             
-        while self.stopStateThreadFlag == False:
+        while self.stopStateThreadFlag == False and self.state in handledStates:
+            if self.deviceDeparted == True:
+                # Unplugged. The hotplug monitor queues a command when a
+                # spectrometer arrives, so wait for that instead of retrying.
+                self.checkCommands(blockTime=responseTimeout)
+                continue
             try:
                 self.spectrometer.closeDevice()
-                self.openSpectrometer()
+                # Rescans only if the serial map was invalidated
+                self.spectrometer.populateDeviceList()
+                self.spectrometer.openDeviceSerial(self.serial)
                 
                 self.setState(prevState)
                 self.info_stream('Fault condition cleared.')
                 break
             except Exception, e:
                 self.error_stream(''.join(('In faultHandler: Testing controller response. Returned ', str(e))))
+                if self.hotplug is not None and self.serial not in self.spectrometer.serialList:
+                    self.deviceDeparted = True
+                    self.setStatus('Spectrometer disconnected, waiting for it to return')
+                    continue
                 responseAttempts += 1
             if responseAttempts >= maxAttempts:
                 self.setState(PyTango.DevState.UNKNOWN)
@@ -297,7 +467,7 @@ class SpectrometerThread(threading.Thread):
         except Exception, e:
             self.error_stream(''.join(('Could not disconnect from spectrometer, ', str(e))))
                 
-        self.set_status('Disconnected from spectrometer')
+        self.setStatus('Disconnected from spectrometer')
         while self.stopStateThreadFlag == False:
             if self.state != PyTango.DevState.OFF:
                 break
@@ -329,101 +499,147 @@ class SpectrometerThread(threading.Thread):
     def onHandler(self, prevState):
         """Handles the ON state where the spectrometer is connected and acquiring
         spectra. Runs a loop checking for commands and reading a new spectrum from the
-        hardware every updateTime ms. The new spectrum is posted to the dataQueue.
+        hardware when the pacer says it is due. The new spectrum is posted to the
+        spectrumChannel, the achieved rate about once per second.
         
         """
         self.info_stream('Entering onHandler')
         self.status = 'Connected to spectrometer, acquiring spectra'
         handledStates = [PyTango.DevState.ON, PyTango.DevState.ALARM]
         self.openSpectrometer()
-        if self.updateTime > self.expTime:
-            self.sleepTime = (self.updateTime - self.expTime) * 1e-3
-        else:
-            self.sleepTime = self.expTime * 1e-3
-        s = ''.join(('Sleeptime: ', str(self.sleepTime)))
+        self.pacer.reset()
+        s = ''.join(('Pacing ', self.pacer.mode, ', update time ', str(self.updateTime), ' ms'))
         self.info_stream(s)
-        newSpectrumTimestamp = time.time()
-        oldSpectrumTimestamp = time.time()
+        self.staleDetector.reset()
+        self.nextRateReport = monotonic() + 1.0
         self.spectrumData = self.spectrometer.CCD
-        nextUpdateTime = time.time()
         while self.stopStateThreadFlag == False:
             if self.state not in handledStates:
                 break
-            # Check if any new commands arrived:
-            self.checkCommands(blockTime=0.01)
+
+            if self.pacer.mode == FramePacer.CONTINUOUS:
+                self.continuousAcquisition(handledStates)
+                continue
+
+            # Block on the command queue until the next acquisition is due:
+            self.checkCommands(blockTime=self.pacer.timeToNext())
             
             # Check if we should break this loop and go to a new state handler:
             if self.state not in handledStates:
                 break
 
             try:
-                t = time.time()
-#                self.debug_stream(''.join(("In onHandler()... time ", str(t), ", next update ", str(nextUpdateTime))))
-                if t > nextUpdateTime:
+                if self.pacer.timeToNext() <= 0:
+                    self.pacer.frameStarted()
                     self.spectrometer.acquireSpectrum()
-                    newSpectrum = self.spectrometer.CCD                
-                    newSpectrumTimestamp = time.time()
-                    d = np.abs(newSpectrum - self.spectrumData).sum()
-                    if d == 0:                    
-                        if newSpectrumTimestamp - oldSpectrumTimestamp > 5:                     
-                            self.set_state(PyTango.DevState.FAULT)
-                            self.set_status('Spectrum not updating. Reconnecting.')
-                            self.error_stream('Spectrum not updating. Reconnecting.')
-                    else:
-                        oldSpectrumTimestamp = newSpectrumTimestamp
-                    self.spectrumData = np.copy(newSpectrum)
-                    msg = SpectrometerDataMessage(self.serial, 'spectrum', self.spectrumData)
-                    self.dataQueue.put(msg, block=False)
-                    if self.updateTime > self.expTime:
-                        self.sleepTime = (self.updateTime - self.expTime) * 1e-3
-                    else:
-                        self.sleepTime = self.expTime * 1e-3
-                    
-                    nextUpdateTime = t + self.sleepTime
+                    self.pacer.frameDone()
+                    self.processSpectrum(self.spectrometer.CCD, self.spectrometer.getFrameInfo())
  
             except Exception, e:
                 self.setState(PyTango.DevState.FAULT)
                 self.status = 'Error reading hardware.'
+
+    def continuousAcquisition(self, handledStates):
+        """Free running acquisition used in the continuous acquisition mode.
+        The spectrometer arms the next exposure as soon as the previous readout
+        is done and every frame is posted to the spectrumChannel. Commands are checked
+        between frames without blocking. Returns when the state or the
+        acquisition mode changes.
+        """
+        self.info_stream('Starting continuous acquisition')
+        stream = self.spectrometer.streamSpectra()
+        try:
+            while self.stopStateThreadFlag == False:
+                newSpectrum = next(stream)
+                frameInfo = self.spectrometer.getFrameInfo()
+                self.pacer.frameStarted(frameInfo[1])
+                self.pacer.frameDone(frameInfo[2])
+                self.processSpectrum(newSpectrum, frameInfo)
+
+                self.checkCommands()
+                if self.state not in handledStates or self.pacer.mode != FramePacer.CONTINUOUS:
+                    break
+        except StopIteration:
+            # The generator ends when the device is closed
+            self.setState(PyTango.DevState.FAULT)
+            self.status = 'Spectrometer closed during acquisition.'
+        except Exception, e:
+            self.setState(PyTango.DevState.FAULT)
+            self.status = 'Error reading hardware.'
+            self.error_stream(''.join(('Error in continuous acquisition: ', str(e))))
+        finally:
+            stream.close()
+        self.info_stream('Continuous acquisition stopped')
+
+    def processSpectrum(self, newSpectrum, frameInfo):
+        """Checks that the spectrum is updating and posts it to the spectrumChannel.
+        newSpectrum is a read-only view into the spectrometer ring buffer and
+        is posted as such. The master copies it once when it publishes the
+        frame, checking the sequence number so a wrapped slot is never
+        published. frameInfo is the matching getFrameInfo() tuple.
+        """
+        seq, startTime, endTime, timestamp = frameInfo
+        newSpectrumTimestamp = monotonic()
+        if self.staleDetector.update(seq, newSpectrum, newSpectrumTimestamp) == True:
+            self.setState(PyTango.DevState.FAULT)
+            self.setStatus('Spectrum not updating. Reconnecting.')
+            self.error_stream('Spectrum not updating. Reconnecting.')
+        self.spectrumData = newSpectrum
+        msg = SpectrometerDataMessage(self.serial, 'spectrum', newSpectrum, seq, startTime, endTime, timestamp,
+                                      self.spectrometer.ringBuffer)
+        self.spectrumChannel.put(msg)
+        if self.autoExpose == True:
+            newExp = self.autoExposure.update(newSpectrum, self.expTime, startTime)
+            if newExp is not None:
+                self.expTime = newExp
+                self.setExposure(True)
+                msg = SpectrometerDataMessage(self.serial, 'exposuretime', self.expTime)
+                self.controlChannel.put(msg)
+        if newSpectrumTimestamp > self.nextRateReport:
+            msg = SpectrometerDataMessage(self.serial, 'acquisitionrate', self.pacer.achievedRate())
+            self.controlChannel.put(msg)
+            self.nextRateReport = newSpectrumTimestamp + 1.0
             
     def info_stream(self, s):
         msg = SpectrometerDataMessage(self.serial, 'info', s)
-        self.dataQueue.put(msg, block=False) 
+        self.logChannel.put(msg)
 
     def debug_stream(self, s):
         msg = SpectrometerDataMessage(self.serial, 'debug', s)
-        self.dataQueue.put(msg, block=False) 
+        self.logChannel.put(msg)
 
     def error_stream(self, s):
         msg = SpectrometerDataMessage(self.serial, 'error', s)
-        self.dataQueue.put(msg, block=False) 
+        self.logChannel.put(msg)
         
     def setState(self, state):
-        """Sets a new spectrometer state and posts it to the dataQueue
+        """Sets a new spectrometer state and posts it to the controlChannel
         
         """
         self.state = state
         msg = SpectrometerDataMessage(self.serial, 'state', self.state)
-        self.dataQueue.put(msg, block=False)
+        self.controlChannel.put(msg)
 
     def setStatus(self, status):
-        """Sets a new spectrometer status message and posts it to the dataQueue
+        """Sets a new spectrometer status message and posts it to the controlChannel
         
         """
         self.status = status
         msg = SpectrometerDataMessage(self.serial, 'status', self.status)
-        self.dataQueue.put(msg, block=False)
+        self.controlChannel.put(msg)
         
         
     def openSpectrometer(self):
-        """Opens the communication with the spectrometer hardware. The index of
-        the spectrometer in the deviceList retrieved from populateDeviceList is used.
+        """Opens the communication with the spectrometer hardware. The device
+        is looked up by serial in the serial map shared with enumerateSpectrometers,
+        so it is found even if its index changed.
         
         """
         # If the device was closed, we open it again
         self.debug_stream('Entering openSpectrometer')
         if self.spectrometer.deviceHandle == None:            
             try:
-                self.spectrometer.openDeviceIndex(self.spectrometerIndex)
+                self.spectrometer.openDeviceSerial(self.serial)
                 self.debug_stream(''.join(('openSpectrometer: device', str(self.serial), ' opened')))
             except Exception, e:
                 self.error_stream(''.join(('Could not open device ', str(self.serial), str(e))))
@@ -432,40 +648,23 @@ class SpectrometerThread(threading.Thread):
 
     def setExposure(self, forceSet=False):
         """Sets the exposure time of the acquisition according to the class
-        member expTime. Also updates the sleepTime used in onHandler to time
-        acquisition.
+        member expTime. With auto exposure on, the AutoExposureController
+        decides the value in processSpectrum.
         
         """
         self.info_stream('In setExposure: ')
-#         if self.autoExpose == True:
-#             # We will try to keep the max reading at around nomI counts
-#             nomI = 2500.0
-#             maxI = np.max(self.spectrumData)
-#             # Don't adjust if the intensity is within 10% of nominal    
-#             if (nomI / maxI > 1.1) or (nomI / maxI < 0.9):         
-#                 newExp = nomI / maxI * self.expTime
-#                 # Don't adjust to over 500 ms, the update rate would be too slow
-#                 if newExp > 500:
-#                     newExp = 500            
-#                 self.expTime = newExp
-#                 forceSet = True 
-
         if forceSet == True:
             try:
                 self.spectrometer.setExposureTime(int(self.expTime * 1e3))  # expTime is in ms, the spectrometer excpects us
             except Exception, e:
-                self.set_state(PyTango.DevState.FAULT)
-                self.set_status(''.join(('Could not set exposure time', str(e))))
+                self.setState(PyTango.DevState.FAULT)
+                self.setStatus(''.join(('Could not set exposure time', str(e))))
                 self.error_stream(''.join(('Could not set exposure time', str(e))))
-            if self.updateTime > self.expTime:
-                self.sleepTime = (self.updateTime - self.expTime) * 1e-3
-            else:
-                self.sleepTime = self.expTime * 1e-3
                 
                     
     def getExposure(self):
         """Reads the exposure time from the spectrometer hardware and posts
-        exposure time to the dataQueue
+        exposure time to the controlChannel
         """
         if self.state not in [PyTango.DevState.INIT, PyTango.DevState.UNKNOWN]:
             try:
@@ -475,10 +674,243 @@ class SpectrometerThread(threading.Thread):
                 self.setState(PyTango.DevState.FAULT)
                 
         msg = SpectrometerDataMessage(self.serial, 'exposuretime', self.expTime)
-        self.dataQueue.put(msg, block=False)
+        self.controlChannel.put(msg)
+
+    def setAverage(self):
+        """Sets the number of exposures averaged on the device per spectrum
+        and posts the value read back to the controlChannel. Only the
+        PhotonSpectr.dll backend averages on the device, with the others the
+        average stays 1.
+        """
+        if hasattr(self.spectrometer, 'setAverage') == False:
+            self.average = 1
+        else:
+            try:
+                self.spectrometer.setAverage(int(self.average))
+                self.average = self.spectrometer.getAverage()
+            except Exception, e:
+                self.error_stream(''.join(('Could not set average, ', str(e))))
+        msg = SpectrometerDataMessage(self.serial, 'average', self.average)
+        self.controlChannel.put(msg)
+
+    def readCorrectionTables(self):
+        """Reads the dark spectrum, linearity coefficients and special pixels
+        stored in the spectrometer and posts them to the controlChannel as
+        one message. The spectra stay uncorrected, clients apply the tables.
+        """
+        if hasattr(self.spectrometer, 'getDark') == False:
+            return
+        try:
+            tables = (self.spectrometer.getDark(), self.spectrometer.getLinearity(),
+                      self.spectrometer.getSpecialPixels())
+        except Exception, e:
+            self.error_stream(''.join(('Could not read correction tables, ', str(e))))
+            return
+        msg = SpectrometerDataMessage(self.serial, 'correctiontables', tables)
+        self.controlChannel.put(msg)
+
+
+class SharedRingChannel(object):
+    """Spectrum channel of the SpectrometerThread in a worker process. The
+    frame goes into the shared memory ring of the spectrometer, only a
+    notification without the data is sent to the master.
+    """
+    def __init__(self, ring, dataQueue):
+        self.ring = ring
+        self.dataQueue = dataQueue
+
+    def put(self, msg):
+        self.ring.write(msg.data, (msg.sequence, msg.startTime, msg.endTime, msg.timestamp))
+        note = SpectrometerDataMessage(msg.serial, 'spectrum', None, msg.sequence, msg.startTime, msg.endTime, msg.timestamp)
+        self.dataQueue.put(note)
+        return True
+
+
+class SpectrometerWorker(object):
+    """Runs in the worker process of a spectrometer in the process per
+    spectrometer mode. The SpectrometerThread owns the USB handle as usual,
+    spectra are written to the shared memory ring, the other messages are
+    forwarded to the master through dataQueue and commands from the master
+    arrive through commandQueue. A None command stops the worker.
+    """
+    def __init__(self, serial, index, deviceMap, commandQueue, dataQueue, calibrationCache, staleTimeout, autoExposure):
+        self.serial = serial
+        self.index = index
+        self.deviceMap = deviceMap
+        self.commandQueue = commandQueue
+        self.dataQueue = dataQueue
+        self.calibrationCache = calibrationCache
+        self.staleTimeout = staleTimeout
+        self.autoExposure = autoExposure
+        self.stopFlag = False
+
+    def run(self):
+        # The master scanned the bus, rescanning here would open the devices
+        # of the other workers
+        keys, serials = self.deviceMap
+        spm.enumerator.assign(keys, serials)
+        parentPid = None
+        if hasattr(os, 'getppid') == True:
+            parentPid = os.getppid()
+        ring = SharedSpectrumRing(ringName(self.serial), create=True)
+        hub = ChannelHub()
+        localCommands = Queue.Queue(100)
+        controlChannel = hub.channel('control', LOSSLESS, 100)
+        logChannel = hub.channel('log', DROP, 100)
+        thread = SpectrometerThread(None, self.serial, self.index, localCommands,
+                                    controlChannel, SharedRingChannel(ring, self.dataQueue), logChannel,
+                                    self.calibrationCache, self.staleTimeout, self.autoExposure)
+        forwarder = threading.Thread(target=self.forwardMessages, args=(hub,))
+        thread.start()
+        forwarder.start()
+        try:
+            while True:
+                try:
+                    cmd = self.commandQueue.get(timeout=1.0)
+                except Queue.Empty:
+                    # Orphaned if the master died without stopping us
+                    if parentPid is not None and os.getppid() != parentPid:
+                        break
+                    continue
+                if cmd is None:
+                    break
+                try:
+                    localCommands.put(cmd, block=False)
+                except Queue.Full:
+                    pass
+        finally:
+            thread.stopThread()
+            thread.join(3)
+            self.stopFlag = True
+            hub.wake()
+            forwarder.join(3)
+            ring.close()
+
+    def forwardMessages(self, hub):
+        # drain() waits for messages until run() calls hub.wake()
+        while self.stopFlag == False:
+            for msg in hub.drain():
+                if msg.attribute == 'state':
+                    # DevState does not pickle
+                    msg.data = int(msg.data)
+                self.dataQueue.put(msg)
+
+
+def runSpectrometerWorker(*args):
+    """Entry point of the worker processes, args as for SpectrometerWorker.
+    Python 2 multiprocessing forks on POSIX, so the child starts with the
+    backend state of the multithreaded server, possibly with locks held by
+    its threads. That state is reset before anything else.
+    """
+    spm.resetAfterFork()
+    SpectrometerWorker(*args).run()
+
+
+class SpectrometerProcess(object):
+    """Master side of a spectrometer in the process per spectrometer mode,
+    used in place of its SpectrometerThread. The hardware access runs in a
+    separate process (SpectrometerWorker), so the DLL calls and frame copies
+    of different spectrometers do not compete for one GIL. A receive thread
+    reads the newest spectrum from the shared memory ring on each
+    notification and posts it and the worker's other messages to the
+    channels, so the master handles them exactly like those of a thread.
+    """
+    def __init__(self, serial, index, commandQueue, controlChannel, spectrumChannel, logChannel,
+                 calibrationCache=None, staleTimeout=5.0, autoExposure=None):
+        self.serial = serial
+        self.index = index
+        self.commandQueue = commandQueue
+        self.controlChannel = controlChannel
+        self.spectrumChannel = spectrumChannel
+        self.logChannel = logChannel
+        if calibrationCache is None:
+            calibrationCache = CalibrationCache()
+        self.calibrationCache = calibrationCache
+        self.staleTimeout = staleTimeout
+        if autoExposure is None:
+            autoExposure = AutoExposureController()
+        self.autoExposure = autoExposure
+        self.process = None
+        self.receiveThread = None
+        self.stopFlag = True
+        self.ring = None
+        self.ringCount = 0
+
+    def start(self):
+        self.dataQueue = multiprocessing.Queue()
+        self.ring = None
+        self.ringCount = 0
+        self.process = multiprocessing.Process(target=runSpectrometerWorker,
+                                               args=(self.serial, self.index, spm.enumerator.snapshot(),
+                                                     self.commandQueue, self.dataQueue, self.calibrationCache,
+                                                     self.staleTimeout, self.autoExposure))
+        self.process.daemon = True
+        self.process.start()
+        self.stopFlag = False
+        self.receiveThread = threading.Thread(target=self.receiveMessages)
+        self.receiveThread.daemon = True
+        self.receiveThread.start()
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def stopThread(self):
+        self.stopFlag = True
+        try:
+            self.commandQueue.put(None, block=False)
+        except Queue.Full:
+            pass
+
+    def join(self, timeout=None):
+        self.process.join(timeout)
+        if self.process.is_alive() == True:
+            self.process.terminate()
+        self.stopFlag = True
+        self.receiveThread.join(timeout)
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+    def receiveMessages(self):
+        exitReported = False
+        while self.stopFlag == False:
+            try:
+                msg = self.dataQueue.get(timeout=0.1)
+            except Queue.Empty:
+                if self.process.is_alive() == False and exitReported == False:
+                    exitReported = True
+                    self.controlChannel.put(SpectrometerDataMessage(self.serial, 'state', PyTango.DevState.FAULT))
+                    self.controlChannel.put(SpectrometerDataMessage(self.serial, 'status', 'Worker process exited'))
+                    self.logChannel.put(SpectrometerDataMessage(self.serial, 'error', ''.join(('Worker process exited with code ', str(self.process.exitcode)))))
+                continue
+            if msg.attribute == 'spectrum':
+                self.readSpectrum()
+            elif msg.attribute in ('info', 'debug', 'error'):
+                self.logChannel.put(msg)
+            else:
+                if msg.attribute == 'state':
+                    msg.data = PyTango.DevState.values[msg.data]
+                self.controlChannel.put(msg)
+
+    def readSpectrum(self):
+        """Posts the newest frame of the ring, unless an earlier notification
+        already got it.
+        """
+        try:
+            if self.ring is None:
+                self.ring = SharedSpectrumRing(ringName(self.serial))
+            frame = self.ring.read(self.ringCount)
+        except SharedMemoryError, e:
+            self.logChannel.put(SpectrometerDataMessage(self.serial, 'error', str(e)))
+            return
+        if frame is None:
+            return
+        self.ringCount, data, frameInfo = frame
+        seq, startTime, endTime, timestamp = frameInfo
+        msg = SpectrometerDataMessage(self.serial, 'spectrum', data, seq, startTime, endTime, timestamp)
+        self.spectrumChannel.put(msg)
 
 
-        
 #==================================================================
 #   SPM002MasterDS Class Description:
 #
@@ -511,8 +943,7 @@ class SPM002MasterDS(PyTango.Device_4Impl):
     def delete_device(self):
         self.debug_stream(''.join(("[Device delete_device method] for device", self.get_name())))
         self.stopSpectrometerThreads()
-        self.dataReceiveThreadStopFlag = True
-        self.dataReceiveThread.join(3)
+        self.stopDataReceiveThread()
 
 #------------------------------------------------------------------
 #     Device initialization
@@ -528,23 +959,29 @@ class SPM002MasterDS(PyTango.Device_4Impl):
             pass
         
         try:
-            self.dataReceiveThreadStopFlag = True
-            self.dataReceiveThread.join(3)
+            self.stopDataReceiveThread()
         except:
             pass
         
+        if self.ProcessPerSpectrometer == True and sys.platform == 'win32':
+            # multiprocessing spawns instead of forking on Windows, so the
+            # workers would have to import the DLL backend and rebuild their
+            # state from pickles, which is not supported
+            self.error_stream('ProcessPerSpectrometer is not supported on Windows, using threads')
+            self.ProcessPerSpectrometer = False
         self.controlSpectrometer = spm.SPM002control()
+        self.calibrationCache = CalibrationCache(self.CalibrationDirectory)
         
         try:
             self.spectrometerList
             self.spectrometerDict
-            self.dataQueue
+            self.dataHub
             self.spectrometerThreads
         except AttributeError:
             self.spectrometerThreads = []
             self.spectrometerList = []
             self.spectrometerDict = {}
-            self.dataQueue = Queue.Queue(1000)
+            self.dataHub = ChannelHub()
         self.dataReceiveThread = threading.Thread()
         threading.Thread.__init__(self.dataReceiveThread, target=self.dataReceiveThreadHandler)
         self.dataReceiveThreadStopFlag = False
@@ -554,6 +991,12 @@ class SPM002MasterDS(PyTango.Device_4Impl):
         
         self.dataReceiveThread.start()
         
+    def stopDataReceiveThread(self):
+        # The thread waits in drain() without timeout until woken
+        self.dataReceiveThreadStopFlag = True
+        self.dataHub.wake()
+        self.dataReceiveThread.join(3)
+
     def stopSpectrometerThreads(self):
         for spec in self.spectrometerList:
             self.info_stream(''.join(('Stopping thread ', str(spec))))
@@ -569,12 +1012,18 @@ class SPM002MasterDS(PyTango.Device_4Impl):
         self.info_stream('In enumerateSpectrometers')
         self.set_state(PyTango.DevState.INIT)
         self.stopSpectrometerThreads()
-        self.controlSpectrometer.populateDeviceList()
+        self.controlSpectrometer.populateDeviceList(rescan=True)
         self.spectrometerList = self.controlSpectrometer.serialList
         for ind, spec in enumerate(self.spectrometerList):
             if self.spectrometerDict.has_key(spec) == False:
                 self.info_stream(''.join(('Adding spectrometer ', str(spec), ' to list.')))
-                self.spectrometerDict[spec] = SpectrometerData(spec, ind, self.dataQueue)
+                try:
+                    autoExposure = AutoExposureController(self.AutoExposureTarget, self.AutoExposurePercentile)
+                except ValueError, e:
+                    self.error_stream(''.join(('Bad AutoExposure properties, using defaults. ', str(e))))
+                    autoExposure = AutoExposureController()
+                self.spectrometerDict[spec] = SpectrometerData(spec, ind, self.dataHub, self.calibrationCache, self.StaleTimeout, autoExposure,
+                                                          self.ProcessPerSpectrometer)
 
                 attrInfo = [[PyTango.DevString, PyTango.SCALAR, PyTango.READ],
                     {
@@ -608,6 +1057,27 @@ class SPM002MasterDS(PyTango.Device_4Impl):
                 cmdMsg = SpectrometerCommand('readExposureTime')
                 self.spectrometerDict[spec].commandQueue.put(cmdMsg)
 
+                attrInfo = [[PyTango.DevBoolean, PyTango.SCALAR, PyTango.READ_WRITE],
+                    {
+                        'description':"Set the exposure time automatically from the spectrum level",
+                        'Memorized':"false",
+                    } ]
+                attrName = ''.join(('Spectrometer', str(spec), 'AutoExposure'))
+                attrData = PyTango.AttrData(attrName, self.get_name(), attrInfo)
+                self.add_attribute(attrData, r_meth=self.read_SpectrometerAutoExposure, w_meth=self.write_SpectrometerAutoExposure, is_allo_meth=self.is_SpectrometerExposureTime_allowed)
+
+                attrInfo = [[PyTango.DevLong, PyTango.SCALAR, PyTango.READ_WRITE],
+                    {
+                        'description':"Number of exposures averaged in the spectrometer per spectrum, only one spectrum per average is transferred. Stays 1 unless the PhotonSpectr.dll backend is used",
+                        'min value':1,
+                        'Memorized':"false",
+                    } ]
+                attrName = ''.join(('Spectrometer', str(spec), 'Average'))
+                attrData = PyTango.AttrData(attrName, self.get_name(), attrInfo)
+                self.add_attribute(attrData, r_meth=self.read_SpectrometerAverage, w_meth=self.write_SpectrometerAverage, is_allo_meth=self.is_SpectrometerExposureTime_allowed)
+                cmdMsg = SpectrometerCommand('readAverage')
+                self.spectrometerDict[spec].commandQueue.put(cmdMsg)
+
                 attrInfo = [[PyTango.DevDouble, PyTango.SPECTRUM, PyTango.READ, 3648],
                     {
                         'description':"spectrum",
@@ -618,6 +1088,42 @@ class SPM002MasterDS(PyTango.Device_4Impl):
                 self.add_attribute(attrData, r_meth=self.read_SpectrometerSpectrum, is_allo_meth=self.is_SpectrometerSpectrum_allowed)
                 self.set_change_event(attrName, True, False)
 
+                attrInfo = [[PyTango.DevLong64, PyTango.SCALAR, PyTango.READ],
+                    {
+                        'description':"Sequence number of the latest spectrum",
+                        'Memorized':"false",
+                    } ]
+                attrName = ''.join(('Spectrometer', str(spec), 'FrameNumber'))
+                attrData = PyTango.AttrData(attrName, self.get_name(), attrInfo)
+                self.add_attribute(attrData, r_meth=self.read_SpectrometerFrameNumber, is_allo_meth=self.is_SpectrometerSpectrum_allowed)
+
+                attrInfo = [[PyTango.DevLong64, PyTango.SCALAR, PyTango.READ],
+                    {
+                        'description':"Number of frames lost between the hardware thread and the master",
+                        'Memorized':"false",
+                    } ]
+                attrName = ''.join(('Spectrometer', str(spec), 'DroppedFrames'))
+                attrData = PyTango.AttrData(attrName, self.get_name(), attrInfo)
+                self.add_attribute(attrData, r_meth=self.read_SpectrometerDroppedFrames, is_allo_meth=self.is_SpectrometerState_allowed)
+
+                attrInfo = [[PyTango.DevLong64, PyTango.SPECTRUM, PyTango.READ, 3],
+                    {
+                        'description':"Messages dropped in the spectrum, control and log channels from the hardware thread",
+                        'Memorized':"false",
+                    } ]
+                attrName = ''.join(('Spectrometer', str(spec), 'ChannelDrops'))
+                attrData = PyTango.AttrData(attrName, self.get_name(), attrInfo)
+                self.add_attribute(attrData, r_meth=self.read_SpectrometerChannelDrops, is_allo_meth=self.is_SpectrometerState_allowed)
+
+                attrInfo = [[PyTango.DevLong64, PyTango.SPECTRUM, PyTango.READ, 3],
+                    {
+                        'description':"Highest number of waiting messages in the spectrum, control and log channels",
+                        'Memorized':"false",
+                    } ]
+                attrName = ''.join(('Spectrometer', str(spec), 'ChannelHighWater'))
+                attrData = PyTango.AttrData(attrName, self.get_name(), attrInfo)
+                self.add_attribute(attrData, r_meth=self.read_SpectrometerChannelHighWater, is_allo_meth=self.is_SpectrometerState_allowed)
+
                 attrInfo = [[PyTango.DevDouble, PyTango.SPECTRUM, PyTango.READ, 3648],
                     {
                         'description':"wavelength table",
@@ -627,6 +1133,42 @@ class SPM002MasterDS(PyTango.Device_4Impl):
                 attrData = PyTango.AttrData(attrName, self.get_name(), attrInfo)
                 self.add_attribute(attrData, r_meth=self.read_SpectrometerWavelengths, is_allo_meth=self.is_SpectrometerWavelengths_allowed)
 
+                attrInfo = [[PyTango.DevLong64, PyTango.SCALAR, PyTango.READ],
+                    {
+                        'description':"Firmware version, clients check cached wavelength tables against it",
+                        'Memorized':"false",
+                    } ]
+                attrName = ''.join(('Spectrometer', str(spec), 'Firmware'))
+                attrData = PyTango.AttrData(attrName, self.get_name(), attrInfo)
+                self.add_attribute(attrData, r_meth=self.read_SpectrometerFirmware, is_allo_meth=self.is_SpectrometerWavelengths_allowed)
+
+                attrInfo = [[PyTango.DevDouble, PyTango.SPECTRUM, PyTango.READ, 3648],
+                    {
+                        'description':"Dark spectrum stored in the spectrometer, invalid if the backend has none",
+                        'Memorized':"false",
+                    } ]
+                attrName = ''.join(('Spectrometer', str(spec), 'Dark'))
+                attrData = PyTango.AttrData(attrName, self.get_name(), attrInfo)
+                self.add_attribute(attrData, r_meth=self.read_SpectrometerDark, is_allo_meth=self.is_SpectrometerWavelengths_allowed)
+
+                attrInfo = [[PyTango.DevDouble, PyTango.SPECTRUM, PyTango.READ, 8],
+                    {
+                        'description':"Linearity polynomial coefficients stored in the spectrometer, lowest order first",
+                        'Memorized':"false",
+                    } ]
+                attrName = ''.join(('Spectrometer', str(spec), 'Linearity'))
+                attrData = PyTango.AttrData(attrName, self.get_name(), attrInfo)
+                self.add_attribute(attrData, r_meth=self.read_SpectrometerLinearity, is_allo_meth=self.is_SpectrometerWavelengths_allowed)
+
+                attrInfo = [[PyTango.DevLong, PyTango.SPECTRUM, PyTango.READ, 64],
+                    {
+                        'description':"Indices of the hot and dead pixels listed in the spectrometer",
+                        'Memorized':"false",
+                    } ]
+                attrName = ''.join(('Spectrometer', str(spec), 'SpecialPixels'))
+                attrData = PyTango.AttrData(attrName, self.get_name(), attrInfo)
+                self.add_attribute(attrData, r_meth=self.read_SpectrometerSpecialPixels, is_allo_meth=self.is_SpectrometerWavelengths_allowed)
+
                 attrInfo = [[PyTango.DevDouble, PyTango.SCALAR, PyTango.READ_WRITE],
                     {
                         'description':"Time between spectrum updates in ms",
@@ -635,8 +1177,29 @@ class SPM002MasterDS(PyTango.Device_4Impl):
                 attrName = ''.join(('Spectrometer', str(spec), 'UpdateTime'))
                 attrData = PyTango.AttrData(attrName, self.get_name(), attrInfo)
                 self.add_attribute(attrData, r_meth=self.read_SpectrometerUpdateTime, w_meth=self.write_SpectrometerUpdateTime, is_allo_meth=self.is_SpectrometerUpdateTime_allowed)                
+                self.set_change_event(attrName, True, False)
                 cmdMsg = SpectrometerCommand('readUpdateTime')
                 self.spectrometerDict[spec].commandQueue.put(cmdMsg)
+
+                attrInfo = [[PyTango.DevString, PyTango.SCALAR, PyTango.READ_WRITE],
+                    {
+                        'description':"Frame pacing: fixedrate, fastest, fixeddelay or continuous",
+                        'Memorized':"false",
+                    } ]
+                attrName = ''.join(('Spectrometer', str(spec), 'AcquisitionMode'))
+                attrData = PyTango.AttrData(attrName, self.get_name(), attrInfo)
+                self.add_attribute(attrData, r_meth=self.read_SpectrometerAcquisitionMode, w_meth=self.write_SpectrometerAcquisitionMode, is_allo_meth=self.is_SpectrometerUpdateTime_allowed)
+                cmdMsg = SpectrometerCommand('readAcquisitionMode')
+                self.spectrometerDict[spec].commandQueue.put(cmdMsg)
+
+                attrInfo = [[PyTango.DevDouble, PyTango.SCALAR, PyTango.READ],
+                    {
+                        'description':"Measured acquisition rate in Hz",
+                        'Memorized':"false",
+                    } ]
+                attrName = ''.join(('Spectrometer', str(spec), 'AchievedRate'))
+                attrData = PyTango.AttrData(attrName, self.get_name(), attrInfo)
+                self.add_attribute(attrData, r_meth=self.read_SpectrometerAchievedRate, is_allo_meth=self.is_SpectrometerState_allowed)
                 
 
                 
@@ -644,73 +1207,127 @@ class SPM002MasterDS(PyTango.Device_4Impl):
         self.set_state(PyTango.DevState.ON)
         
     def dataReceiveThreadHandler(self):
+        """Applies the messages posted by the spectrometer threads. Every
+        pending message of all channels is drained at once. Only the newest
+        spectrum of each serial in a batch is kept, the frames it replaces show
+        up in DroppedFrames. All updates of one serial are applied under a single
+        lock acquisition and the change events are pushed after the lock is
+        released.
+        """
         time.sleep(0.5)
         self.enumerateSpectrometers()
                
         while (self.dataReceiveThreadStopFlag == False):
-            try:
-                rcv = self.dataQueue.get(block=True, timeout=0.005)
-                serial = rcv.serial
+            # Without timeout, a timed Condition.wait polls in steps of up
+            # to 50 ms on Python 2. stopDataReceiveThread wakes us.
+            batch = self.dataHub.drain()
+            if len(batch) == 0:
+                continue
+
+            # Group by serial keeping the message order, log messages are
+            # handled right away
+            serialOrder = []
+            serialMessages = {}
+            for rcv in batch:
+                if rcv.attribute == 'info':
+                    self.info_stream(''.join(('Spectrometer ', str(rcv.serial), ': ', rcv.data)))
+                elif rcv.attribute == 'debug':
+                    self.debug_stream(''.join(('Spectrometer ', str(rcv.serial), ': ', rcv.data)))
+                elif rcv.attribute == 'error':
+                    self.error_stream(''.join(('Spectrometer ', str(rcv.serial), ': ', rcv.data)))
+                else:
+                    if rcv.serial not in serialMessages:
+                        serialOrder.append(rcv.serial)
+                        serialMessages[rcv.serial] = []
+                    serialMessages[rcv.serial].append(rcv)
+
+            for serial in serialOrder:
+                try:
+                    events = self.applyMessages(self.spectrometerDict[serial], serialMessages[serial])
+                except KeyError:
+                    self.error_stream(''.join(("In dataReceiveThreadHandler: Serial ", str(serial), " not in spectrometer dictionary")))
+                    continue
+                for event in events:
+                    try:
+                        self.push_change_event(*event)
+                    except Exception, e:
+                        self.error_stream(''.join(('Could not push ', event[0], ' event: ', str(e))))
+
+    def applyMessages(self, specData, messages):
+        """Applies the messages of one spectrometer to specData, holding its
+        lock once. Returns the change events to push as a list of
+        push_change_event argument tuples.
+        """
+        names = specData.attrNames
+        # Older spectra in the batch are superseded by the newest one
+        lastSpectrum = None
+        for rcv in messages:
+            if rcv.attribute == 'spectrum':
+                lastSpectrum = rcv
+        if lastSpectrum is not None and lastSpectrum.frames is not None:
+            # The only copy of the frame on its way to the clients. A frame
+            # overwritten meanwhile is skipped, the sequence gap to the next
+            # one counts it in DroppedFrames.
+            lastSpectrum.data = lastSpectrum.frames.copy(lastSpectrum.sequence)
+            lastSpectrum.frames = None
+            if lastSpectrum.data is None:
+                lastSpectrum = None
+        events = []
+        ringWrite = None
+        with specData.lock:
+            for rcv in messages:
                 if rcv.attribute == 'spectrum':
-                    attrName = ''.join(('Spectrometer', str(serial), 'Spectrum'))
-                    with self.spectrometerDict[serial].lock:
-                        self.spectrometerDict[serial].spectrum = rcv.data
-#                         try:
-#                             self.push_change_event(attrName, rcv.data)
-#                         except Exception, e:
-#                             self.error_stream(''.join(('Could not push spectrum event: ', str(e))))
-                        self.debug_stream('Pushed spectrum change event')
+                    if rcv is not lastSpectrum:
+                        continue
+                    prevSequence = specData.spectrumSequence
+                    # The sequence restarts when the spectrometer object is recreated
+                    if prevSequence is not None and rcv.sequence > prevSequence + 1:
+                        specData.droppedFrames += rcv.sequence - prevSequence - 1
+                    specData.spectrum = rcv.data
+                    specData.spectrumSequence = rcv.sequence
+                    specData.spectrumStartTime = rcv.startTime
+                    specData.spectrumEndTime = rcv.endTime
+                    specData.spectrumTimestamp = rcv.timestamp
+                    if specData.ring is not None:
+                        ringWrite = (specData.ring, rcv.data, (rcv.sequence, rcv.startTime, rcv.endTime, rcv.timestamp))
+                    events.append((names['Spectrum'], rcv.data, rcv.timestamp,
+                                   PyTango.AttrQuality.ATTR_VALID, rcv.data.shape[0]))
                 elif rcv.attribute == 'wavelengths':
-                    with self.spectrometerDict[serial].lock:
-                        self.spectrometerDict[serial].wavelengths = rcv.data
+                    specData.wavelengths = rcv.data
+                elif rcv.attribute == 'firmware':
+                    specData.firmware = rcv.data
                 elif rcv.attribute == 'exposuretime':
-                    attrName = ''.join(('Spectrometer', str(serial), 'ExposureTime'))
-                    with self.spectrometerDict[serial].lock:
-                        self.spectrometerDict[serial].exposureTime = rcv.data
-#                         try:
-#                             self.push_change_event(attrName, rcv.data)
-#                         except Exception, e:
-#                             self.error_stream(''.join(('Could not push exposuretime event: ', str(e))))                            
-                        self.debug_stream('Pushed exposuretime change event')                        
+                    specData.exposureTime = rcv.data
+                    events.append((names['ExposureTime'], rcv.data))
+                elif rcv.attribute == 'autoexposure':
+                    specData.autoExposure = rcv.data
+                elif rcv.attribute == 'average':
+                    specData.average = rcv.data
+                elif rcv.attribute == 'correctiontables':
+                    specData.dark, specData.linearity, specData.specialPixels = rcv.data
                 elif rcv.attribute == 'updatetime':
-                    attrName = ''.join(('Spectrometer', str(serial), 'UpdateTime'))
-                    with self.spectrometerDict[serial].lock:
-                        self.spectrometerDict[serial].updateTime = rcv.data
-#                         try:
-#                             self.push_change_event(attrName, rcv.data)
-#                         except Exception, e:
-#                             self.error_stream(''.join(('Could not push updatetime event: ', str(e))))
-                        self.debug_stream('Pushed updatetime change event')
+                    specData.updateTime = rcv.data
+                    events.append((names['UpdateTime'], rcv.data))
+                elif rcv.attribute == 'acquisitionmode':
+                    specData.acquisitionMode = rcv.data
+                elif rcv.attribute == 'acquisitionrate':
+                    specData.achievedRate = rcv.data
                 elif rcv.attribute == 'state':
-                    attrName = ''.join(('Spectrometer', str(serial), 'State'))
-                    with self.spectrometerDict[serial].lock:
-                        self.spectrometerDict[serial].state = rcv.data
-                        try:
-                            self.set_state(rcv.data)
-                            self.push_change_event(attrName, str(rcv.data))
-                        except Exception, e:
-                            self.error_stream(''.join(('Could not push state event: ', str(e))))
-                        self.debug_stream('Pushed state change event')
+                    specData.state = rcv.data
+                    try:
+                        self.set_state(rcv.data)
+                    except Exception, e:
+                        self.error_stream(''.join(('Could not set state: ', str(e))))
+                    events.append((names['State'], str(rcv.data)))
                 elif rcv.attribute == 'status':
-                    attrName = ''.join(('Spectrometer', str(serial), 'Status'))
-                    with self.spectrometerDict[serial].lock:
-                        self.spectrometerDict[serial].status = rcv.data
-#                         try:
-#                             self.push_change_event(attrName, str(rcv.data))
-#                         except Exception, e:
-#                             self.error_stream(''.join(('Could not push status event: ', str(e))))
-                        self.debug_stream('Pushed status change event')
-                elif rcv.attribute == 'info':
-                    self.info_stream(''.join(('Spectrometer ', str(serial), ': ', rcv.data)))
-                elif rcv.attribute == 'debug':
-                    self.debug_stream(''.join(('Spectrometer ', str(serial), ': ', rcv.data)))
-                elif rcv.attribute == 'error':
-                    self.error_stream(''.join(('Spectrometer ', str(serial), ': ', rcv.data)))
-                        
-            except Queue.Empty:
-                pass
-            except KeyError:
-                self.error_stream(''.join(("In dataReceiveThreadHandler: Serial ", str(serial), " not in spectrometer dictionary")))
+                    specData.status = rcv.data
+                    events.append((names['Status'], str(rcv.data)))
+        # The copy into shared memory and the reader wakeups do not block
+        # attribute access. This thread is the only writer of the ring.
+        if ringWrite is not None:
+            ring, data, frameInfo = ringWrite
+            ring.write(data, frameInfo)
+        return events
         
 #------------------------------------------------------------------
 #     Always excuted hook method
@@ -817,6 +1434,37 @@ class SPM002MasterDS(PyTango.Device_4Impl):
             return False
         return True
 
+#------------------------------------------------------------------
+#     SpectrometerAutoExposure attribute
+#------------------------------------------------------------------
+    def read_SpectrometerAutoExposure(self, attr):
+        self.info_stream(''.join(('Reading SpectrometerAutoExposure for ', attr.get_name())))
+        serial = int(attr.get_name().rsplit('AutoExposure')[0].rsplit('Spectrometer')[1])
+        with self.spectrometerDict[serial].lock:
+            attr.set_value(self.spectrometerDict[serial].autoExposure)
+
+    def write_SpectrometerAutoExposure(self, attr):        
+        self.info_stream(''.join(('Writing SpectrometerAutoExposure for ', attr.get_name())))
+        serial = int(attr.get_name().rsplit('AutoExposure')[0].rsplit('Spectrometer')[1])
+        data = attr.get_write_value()
+        cmdMsg = SpectrometerCommand('writeAutoExposure', data)
+        self.spectrometerDict[serial].commandQueue.put(cmdMsg)
+
+#------------------------------------------------------------------
+#     SpectrometerAverage attribute
+#------------------------------------------------------------------
+    def read_SpectrometerAverage(self, attr):
+        serial = int(attr.get_name().rsplit('Average')[0].rsplit('Spectrometer')[1])
+        with self.spectrometerDict[serial].lock:
+            attr.set_value(self.spectrometerDict[serial].average)
+
+    def write_SpectrometerAverage(self, attr):
+        self.info_stream(''.join(('Writing SpectrometerAverage for ', attr.get_name())))
+        serial = int(attr.get_name().rsplit('Average')[0].rsplit('Spectrometer')[1])
+        data = attr.get_write_value()
+        cmdMsg = SpectrometerCommand('writeAverage', data)
+        self.spectrometerDict[serial].commandQueue.put(cmdMsg)
+
 #------------------------------------------------------------------
 #     SpectrometerUpdateTime attribute
 #------------------------------------------------------------------
@@ -845,6 +1493,33 @@ class SPM002MasterDS(PyTango.Device_4Impl):
             return False
         return True
 
+#------------------------------------------------------------------
+#     SpectrometerAcquisitionMode attribute
+#------------------------------------------------------------------
+    def read_SpectrometerAcquisitionMode(self, attr):
+        serial = int(attr.get_name().rsplit('AcquisitionMode')[0].rsplit('Spectrometer')[1])
+        with self.spectrometerDict[serial].lock:
+            attr_read = self.spectrometerDict[serial].acquisitionMode
+            if attr_read is None:
+                attr.set_quality(PyTango.AttrQuality.ATTR_INVALID)
+                attr_read = ''
+            attr.set_value(attr_read)
+
+    def write_SpectrometerAcquisitionMode(self, attr):
+        self.info_stream(''.join(('Writing SpectrometerAcquisitionMode for ', attr.get_name())))
+        serial = int(attr.get_name().rsplit('AcquisitionMode')[0].rsplit('Spectrometer')[1])
+        data = attr.get_write_value()
+        cmdMsg = SpectrometerCommand('writeAcquisitionMode', data)
+        self.spectrometerDict[serial].commandQueue.put(cmdMsg)
+
+#------------------------------------------------------------------
+#     SpectrometerAchievedRate attribute
+#------------------------------------------------------------------
+    def read_SpectrometerAchievedRate(self, attr):
+        serial = int(attr.get_name().rsplit('AchievedRate')[0].rsplit('Spectrometer')[1])
+        with self.spectrometerDict[serial].lock:
+            attr.set_value(self.spectrometerDict[serial].achievedRate)
+
 #------------------------------------------------------------------
 #     SpectrometerSpectrum attribute
 #------------------------------------------------------------------
@@ -853,10 +1528,38 @@ class SPM002MasterDS(PyTango.Device_4Impl):
         serial = int(attr.get_name().rsplit('Spectrum')[0].rsplit('Spectrometer')[1])
         with self.spectrometerDict[serial].lock:
             attr_read = self.spectrometerDict[serial].spectrum
-            if attr_read == None:
+            if attr_read is None:
                 attr.set_quality(PyTango.AttrQuality.ATTR_INVALID)
                 attr_read = np.array([0.0])
-            attr.set_value(attr_read, attr_read.shape[0])
+                attr.set_value(attr_read, attr_read.shape[0])
+            else:
+                # Stamp the attribute with the acquisition time rather than the read time
+                attr.set_value_date_quality(attr_read, self.spectrometerDict[serial].spectrumTimestamp,
+                                            PyTango.AttrQuality.ATTR_VALID, attr_read.shape[0])
+
+    def read_SpectrometerFrameNumber(self, attr):
+        serial = int(attr.get_name().rsplit('FrameNumber')[0].rsplit('Spectrometer')[1])
+        with self.spectrometerDict[serial].lock:
+            attr_read = self.spectrometerDict[serial].spectrumSequence
+            if attr_read is None:
+                attr.set_quality(PyTango.AttrQuality.ATTR_INVALID)
+                attr_read = -1
+            attr.set_value(attr_read)
+
+    def read_SpectrometerDroppedFrames(self, attr):
+        serial = int(attr.get_name().rsplit('DroppedFrames')[0].rsplit('Spectrometer')[1])
+        with self.spectrometerDict[serial].lock:
+            attr.set_value(self.spectrometerDict[serial].droppedFrames)
+
+    def read_SpectrometerChannelDrops(self, attr):
+        serial = int(attr.get_name().rsplit('ChannelDrops')[0].rsplit('Spectrometer')[1])
+        attr_read = [channel.drops for channel in self.spectrometerDict[serial].channels]
+        attr.set_value(attr_read, len(attr_read))
+
+    def read_SpectrometerChannelHighWater(self, attr):
+        serial = int(attr.get_name().rsplit('ChannelHighWater')[0].rsplit('Spectrometer')[1])
+        attr_read = [channel.highWater for channel in self.spectrometerDict[serial].channels]
+        attr.set_value(attr_read, len(attr_read))
 
     def is_SpectrometerSpectrum_allowed(self, req_type):
         if self.get_state() in [PyTango.DevState.INIT,
@@ -876,11 +1579,46 @@ class SPM002MasterDS(PyTango.Device_4Impl):
         serial = int(attr.get_name().rsplit('Wavelengths')[0].rsplit('Spectrometer')[1])
         with self.spectrometerDict[serial].lock:
             attr_read = self.spectrometerDict[serial].wavelengths
-            if attr_read == None:
+            if attr_read is None:
                 attr.set_quality(PyTango.AttrQuality.ATTR_INVALID)
-                attr_read = [0.0]
+                attr_read = np.array([0.0])
             attr.set_value(attr_read, attr_read.shape[0])
 
+    def read_SpectrometerFirmware(self, attr):
+        self.info_stream(''.join(('Reading SpectrometerFirmware for ', attr.get_name())))
+        serial = int(attr.get_name().rsplit('Firmware')[0].rsplit('Spectrometer')[1])
+        with self.spectrometerDict[serial].lock:
+            attr_read = self.spectrometerDict[serial].firmware
+            if attr_read is None:
+                attr.set_quality(PyTango.AttrQuality.ATTR_INVALID)
+                attr_read = -1
+            attr.set_value(attr_read)
+
+#------------------------------------------------------------------
+#     SpectrometerDark, SpectrometerLinearity and SpectrometerSpecialPixels attributes
+#------------------------------------------------------------------
+    def read_SpectrometerDark(self, attr):
+        serial = int(attr.get_name().rsplit('Dark')[0].rsplit('Spectrometer')[1])
+        with self.spectrometerDict[serial].lock:
+            self.setTableValue(attr, self.spectrometerDict[serial].dark, 0.0)
+
+    def read_SpectrometerLinearity(self, attr):
+        serial = int(attr.get_name().rsplit('Linearity')[0].rsplit('Spectrometer')[1])
+        with self.spectrometerDict[serial].lock:
+            self.setTableValue(attr, self.spectrometerDict[serial].linearity, 0.0)
+
+    def read_SpectrometerSpecialPixels(self, attr):
+        serial = int(attr.get_name().rsplit('SpecialPixels')[0].rsplit('Spectrometer')[1])
+        with self.spectrometerDict[serial].lock:
+            self.setTableValue(attr, self.spectrometerDict[serial].specialPixels, 0)
+
+    def setTableValue(self, attr, table, default):
+        # An empty special pixel list is valid, a missing table is not
+        if table is None:
+            attr.set_quality(PyTango.AttrQuality.ATTR_INVALID)
+            table = [default]
+        attr.set_value(table, len(table))
+
     def is_SpectrometerWavelengths_allowed(self, req_type):
         if self.get_state() in [PyTango.DevState.UNKNOWN]:
             #     End of Generated Code
@@ -984,6 +1722,26 @@ class SPM002MasterDSClass(PyTango.DeviceClass):
 
     #     Device Properties
     device_property_list = {        
+        'CalibrationDirectory':
+            [PyTango.DevString,
+            "Directory of the wavelength calibration cache, empty for $SPM002_CALIBRATION_DIR or ~/.spm002",
+            [ '' ] ],
+        'StaleTimeout':
+            [PyTango.DevDouble,
+            "Time in s without a new spectrum before a spectrometer is reconnected",
+            [ 5.0 ] ],
+        'AutoExposureTarget':
+            [PyTango.DevDouble,
+            "Level in counts auto exposure keeps the AutoExposurePercentile of the spectra at",
+            [ 2500.0 ] ],
+        'AutoExposurePercentile':
+            [PyTango.DevDouble,
+            "Percentile of the spectrum pixels used as signal level by auto exposure, 100 for the maximum",
+            [ 99.5 ] ],
+        'ProcessPerSpectrometer':
+            [PyTango.DevBoolean,
+            "Run the hardware access of each spectrometer in its own process, spectra are passed through shared memory. Ignored on Windows, where processes are spawned rather than forked",
+            [ False ] ],
         }
     
     #     Command definitions
@@ -3,14 +3,28 @@ Created on Aug 27, 2014
 
 @author: Filip Lindau
 '''
+import os
 import sys
 import PyTango
-import SPM002_control as spm
+try:
+    if os.environ.get('SPM002_DLL', '').lower() == 'photonspectr':
+        # Newer vendor DLL, adds on-device averaging and the correction tables
+        import SPM002_control_new as spm
+    else:
+        import SPM002_control as spm
+except (ImportError, NameError, OSError):
+    # No vendor DLL on this host (e.g. Linux), use the libusb backend. It
+    # only opens hardware with SPM002_USB_BACKEND=1, see SPM002_usb.py
+    import SPM002_usb as spm
 import threading
 import time
 import numpy as np
 from socket import gethostname
 import Queue
+from SPM002_analysis import SpikeFilter, refinePeak, findPeaks, roiIndices, roiStatistics, PIXEL, ESTIMATORS
+from SPM002_calibration import CalibrationCache, CLIENT_NAMESPACE
+from SPM002_shm import SharedSpectrumRing, SharedMemoryError, ringName
+from SPM002_correction import SpectrumCorrection
 
 class SpectrometerCommand:
     def __init__(self, command, data=None):
@@ -75,6 +89,12 @@ class SPM002SpectrometerDS(PyTango.Device_4Impl):
 
         self.attrLock = threading.Lock()         
         self.eventIdList = []          
+        self.spectrumSubscribed = False
+        self.ring = None
+        self.ringCount = 0
+        self.ringCheckTime = 0
+        # Kept through reconnects, the tables are read again in initHandler
+        self.correction = SpectrumCorrection(3648)
         self.stateThread = threading.Thread()
         threading.Thread.__init__(self.stateThread, target=self.stateHandlerDispatcher)
         self.eventThread = threading.Thread()
@@ -117,6 +137,7 @@ class SPM002SpectrometerDS(PyTango.Device_4Impl):
         self.stopStateThreadFlag = True
         self.stateThread.join(3)
         self.unsubscribeEvents()
+        self.closeSharedRing()
         
     def unknownHandler(self, prevState):
         """Handles the UNKNOWN state, before communication with the master device
@@ -130,6 +151,7 @@ class SPM002SpectrometerDS(PyTango.Device_4Impl):
         self.wavelengthsROI = None
         self.updateTime = None
         self.expTime = None
+        self.average = None
         self.spectrum = None
         self.spectrumROI = None
         self.peakROI = None
@@ -137,9 +159,35 @@ class SPM002SpectrometerDS(PyTango.Device_4Impl):
         self.peakEnergy = None
         self.peakWavelength = None
         self.peakWidth = None
+        self.peakWavelengths = np.zeros(0)
+        self.peakWidths = np.zeros(0)
+        self.peakEnergies = np.zeros(0)
+        self.roiNames = []
+        self.roiLimits = np.zeros((0, 2))
+        self.roiStart = np.zeros(0, dtype=np.int64)
+        self.roiStop = np.zeros(0, dtype=np.int64)
+        self.roiEnergies = np.zeros(0)
+        self.roiMeans = np.zeros(0)
+        self.roiMaxima = np.zeros(0)
+        # The peak array attributes hold at most 32 values
+        self.maxPeaks = max(min(self.MaxPeaks, 32), 0)
+        try:
+            self.spikeFilter = SpikeFilter(self.SpikeFilter)
+        except ValueError, e:
+            with self.streamLock:
+                self.error_stream(''.join(('Bad SpikeFilter property, using median. ', str(e))))
+            self.spikeFilter = SpikeFilter(SpikeFilter.MEDIAN)
+        # The master's entries hold the LUT, which is not available here
+        self.calibrationCache = CalibrationCache(self.CalibrationDirectory, CLIENT_NAMESPACE)
+        self.peakEstimator = self.PeakEstimator
+        if self.peakEstimator not in ESTIMATORS:
+            with self.streamLock:
+                self.error_stream(''.join(('Bad PeakEstimator property ', str(self.peakEstimator), ', using pixel.')))
+            self.peakEstimator = PIXEL
         
         while self.stopStateThreadFlag == False:
             self.unsubscribeEvents()
+            self.closeSharedRing()
             with self.streamLock:
                 self.info_stream('Trying to connect...')        
             try:
@@ -168,13 +216,15 @@ class SPM002SpectrometerDS(PyTango.Device_4Impl):
                 if self.masterDevice.state() == PyTango.DevState.UNKNOWN:
                     self.checkCommands(blockTime=waitTime)
                     continue 
-                attrName = ''.join(('Spectrometer', str(self.Serial), 'Wavelengths'))
-                wavelengthsAttr = self.masterDevice.read_attribute(attrName)
+                wavelengths = self.readCalibration()
                 with self.attrLock:
-                    self.wavelengths = wavelengthsAttr.value
+                    self.wavelengths = wavelengths
                     self.wavelengthsROI = self.wavelengths[self.peakROIIndex[0] : self.peakROIIndex[1]]
                     self.peakROI = np.array([self.wavelengthsROI[0], self.wavelengthsROI[-1]])
+                self.setROIs(self.ROIs)
+                self.readCorrectionTables()
                     
+                self.openSharedRing()
                 self.subscribeEvents()
                 self.masterDevice.command_inout('StopSpectrometer', self.Serial)
 
@@ -191,8 +241,60 @@ class SPM002SpectrometerDS(PyTango.Device_4Impl):
             self.commandQueue.put(cmdMsg)
             cmdMsg = SpectrometerCommand('readUpdateTime')
             self.commandQueue.put(cmdMsg)
+            cmdMsg = SpectrometerCommand('readAverage')
+            self.commandQueue.put(cmdMsg)
             break
 
+    def readCalibration(self):
+        """Returns the wavelength table of the spectrometer. The master only
+        has to send the firmware version when the local calibration cache
+        holds a valid table, otherwise the full table is read and cached.
+        """
+        prefix = ''.join(('Spectrometer', str(self.Serial)))
+        firmware = None
+        try:
+            firmwareAttr = self.masterDevice.read_attribute(''.join((prefix, 'Firmware')))
+            if firmwareAttr.quality != PyTango.AttrQuality.ATTR_INVALID:
+                firmware = firmwareAttr.value
+        except PyTango.DevFailed:
+            # Master without the firmware attribute
+            pass
+        if firmware is not None:
+            entry = self.calibrationCache.load(self.Serial, firmware)
+            if entry is not None:
+                with self.streamLock:
+                    self.info_stream(''.join(('Wavelength table from cache ', self.calibrationCache.directory)))
+                return entry[1]
+        wavelengthsAttr = self.masterDevice.read_attribute(''.join((prefix, 'Wavelengths')))
+        if firmware is not None and wavelengthsAttr.quality != PyTango.AttrQuality.ATTR_INVALID:
+            self.calibrationCache.store(self.Serial, firmware, None, wavelengthsAttr.value)
+        return wavelengthsAttr.value
+
+    def readCorrectionTables(self):
+        """Reads the dark spectrum, linearity coefficients and special pixels
+        of the spectrometer from the master. A table the master does not
+        have (other backend or older master) stays unset and its correction
+        does nothing.
+        """
+        prefix = ''.join(('Spectrometer', str(self.Serial)))
+        tables = []
+        for name in ('Dark', 'Linearity', 'SpecialPixels'):
+            try:
+                attr = self.masterDevice.read_attribute(''.join((prefix, name)))
+            except PyTango.DevFailed:
+                tables.append(None)
+                continue
+            if attr.quality == PyTango.AttrQuality.ATTR_INVALID or attr.value is None:
+                tables.append(None)
+            else:
+                tables.append(attr.value)
+        with self.attrLock:
+            self.correction.setDark(tables[0])
+            self.correction.setLinearity(tables[1])
+            if tables[2] is None:
+                tables[2] = np.zeros(0, dtype=np.int64)
+            self.correction.setSpecialPixels(tables[2])
+
     def standbyHandler(self, prevState):
         """Handles the STANDBY state. Connected to the spectrometer but not
         acquiring spectra. Waits in a loop checking commands. 
@@ -211,13 +313,21 @@ class SPM002SpectrometerDS(PyTango.Device_4Impl):
             
     def onHandler(self, prevState):
         """Handles the ON state. Connected to the spectrometer and 
-        acquiring spectra. Waits in a loop checking commands. Spectrometer 
-        events are handled in a callback function spectrumEvent
+        acquiring spectra. Waits in a loop checking commands. With the master
+        on this host the spectra are read from its shared memory ring, waking
+        up when the master writes a frame (polling with backoff where the
+        ring has no wakeup). Otherwise spectrometer events are handled in a callback function
+        spectrumEvent. If the master does not push spectrum events the
+        spectrum is polled instead.
         """
         with self.streamLock:
             self.info_stream('Entering onHandler')
         handledStates = [PyTango.DevState.ON, PyTango.DevState.ALARM]
         waitTime = 0.1
+        # Ring read interval when the ring has no wakeup, doubled while no
+        # frame arrives
+        minRingPollTime = 0.001
+        ringPollTime = minRingPollTime
         
 #        self.eventThread.start()
         
@@ -226,23 +336,26 @@ class SPM002SpectrometerDS(PyTango.Device_4Impl):
                 state = self.get_state()
             if state not in handledStates:
                 break
+            if self.ring is not None:
+                self.checkCommands()
+                if self.readSharedSpectrum() == True:
+                    ringPollTime = minRingPollTime
+                elif self.ring is None:
+                    # Remapping failed, the spectra come through Tango
+                    pass
+                elif self.ring.wakeupEnabled() == True:
+                    # Returns as soon as the master writes a frame
+                    self.ring.wait(waitTime)
+                else:
+                    self.ring.wait(ringPollTime)
+                    ringPollTime = min(2 * ringPollTime, waitTime)
+                continue
             self.checkCommands(blockTime=waitTime)
+            if self.spectrumSubscribed == True:
+                continue
             attrName = ''.join(('Spectrometer', str(self.Serial), 'Spectrum'))
-            with self.attrLock:
-                attr = self.masterDevice.read_attribute(attrName)
-                self.spectrum = attr.value
-                with self.streamLock:
-                    self.debug_stream('In spectrumEvent: spectrum retrieved')
-                try:
-                    self.spectrumROI = self.spectrum[self.peakROIIndex[0] : self.peakROIIndex[1]]
-                    with self.streamLock:
-                        self.debug_stream('In spectrumEvent: roi extracted')
-                except Exception, e:
-                    with self.streamLock:
-                        self.error_stream(''.join(('In spectrumEvent: ', str(e))))
-            self.calculateSpectrumParameters()
-            with self.streamLock:
-                self.debug_stream('In spectrumEvent: parameters calculated')
+            attr = self.masterDevice.read_attribute(attrName)
+            self.updateSpectrum(attr.value)
             
             
 
@@ -284,23 +397,34 @@ class SPM002SpectrometerDS(PyTango.Device_4Impl):
                 self.error_stream(''.join(('Error subscribing to STATE event: ', str(e))))
             raise
 
-#         try:
-#             attrName = ''.join(('Spectrometer', str(self.Serial), 'ExposureTime'))
-#             eventId = self.masterDevice.subscribe_event(attrName, PyTango.EventType.CHANGE_EVENT, self.exposureTimeEvent)
-#             self.eventIdList.append(eventId)
-#         except PyTango.EventSystemFailed, e:
-#             with self.streamLock:
-#                 self.error_stream(''.join(('Error subscribing to EXPOSURETIME event: ', str(e))))
-#             raise
-# 
-#         try:
-#             attrName = ''.join(('Spectrometer', str(self.Serial), 'Spectrum'))
-#             eventId = self.masterDevice.subscribe_event(attrName, PyTango.EventType.CHANGE_EVENT, self.spectrumEvent)
-#             self.eventIdList.append(eventId)
-#         except PyTango.EventSystemFailed, e:
-#             with self.streamLock:
-#                 self.error_stream(''.join(('Error subscribing to SPECTRUM event: ', str(e))))
-#             raise
+        # The master pushes these, without them the values are polled
+        try:
+            attrName = ''.join(('Spectrometer', str(self.Serial), 'ExposureTime'))
+            eventId = self.masterDevice.subscribe_event(attrName, PyTango.EventType.CHANGE_EVENT, self.exposureTimeEvent)
+            self.eventIdList.append(eventId)
+        except PyTango.DevFailed, e:
+            with self.streamLock:
+                self.error_stream(''.join(('Error subscribing to EXPOSURETIME event: ', str(e))))
+
+        try:
+            attrName = ''.join(('Spectrometer', str(self.Serial), 'UpdateTime'))
+            eventId = self.masterDevice.subscribe_event(attrName, PyTango.EventType.CHANGE_EVENT, self.updateTimeEvent)
+            self.eventIdList.append(eventId)
+        except PyTango.DevFailed, e:
+            with self.streamLock:
+                self.error_stream(''.join(('Error subscribing to UPDATETIME event: ', str(e))))
+
+        # Spectra come from the shared memory ring when the master is local
+        if self.ring is not None:
+            return
+        try:
+            attrName = ''.join(('Spectrometer', str(self.Serial), 'Spectrum'))
+            eventId = self.masterDevice.subscribe_event(attrName, PyTango.EventType.CHANGE_EVENT, self.spectrumEvent)
+            self.eventIdList.append(eventId)
+            self.spectrumSubscribed = True
+        except PyTango.DevFailed, e:
+            with self.streamLock:
+                self.error_stream(''.join(('Error subscribing to SPECTRUM event, polling instead: ', str(e))))
         
     def unsubscribeEvents(self):
         try:
@@ -319,6 +443,8 @@ class SPM002SpectrometerDS(PyTango.Device_4Impl):
                     with self.streamLock:
                         self.error_stream(''.join(('General Error unsubscribing event ', str(eventId))))
                         self.error_stream(str(e))
+            self.eventIdList = []
+            self.spectrumSubscribed = False
         except AttributeError:
             pass
 
@@ -353,20 +479,95 @@ class SPM002SpectrometerDS(PyTango.Device_4Impl):
             with self.streamLock:
                 self.info_stream(''.join(('Error for spectrum event :', str(event.errors))))
         else:
-            with self.attrLock:
-                self.spectrum = event.attr_value.value
+            if event.attr_value is None or event.attr_value.value is None:
+                return
+            self.updateSpectrum(event.attr_value.value)
+
+    def updateSpectrum(self, spectrum):
+        """Sets a new spectrum from the master and recalculates the
+        spectrum parameters. spectrum may be a reused buffer, the spectrum
+        kept is always converted or corrected into an array of its own.
+        """
+        with self.attrLock:
+            if self.correction.enabled() == True:
+                # A buffer ring, only used under attrLock
+                spectrum = self.correction.apply(spectrum)
+            else:
+                # A copy only for a reused integer buffer
+                spectrum = np.asarray(spectrum, dtype=np.float64)
+            self.spectrum = spectrum
+            with self.streamLock:
+                self.debug_stream('In updateSpectrum: spectrum retrieved')
+            try:
+                self.spectrumROI = self.spectrum[self.peakROIIndex[0] : self.peakROIIndex[1]]
                 with self.streamLock:
-                    self.debug_stream('In spectrumEvent: spectrum retrieved')
-                try:
-                    self.spectrumROI = self.spectrum[self.peakROIIndex[0] : self.peakROIIndex[1]]
-                    with self.streamLock:
-                        self.debug_stream('In spectrumEvent: roi extracted')
-                except Exception, e:
-                    with self.streamLock:
-                        self.error_stream(''.join(('In spectrumEvent: ', str(e))))
-            self.calculateSpectrumParameters()
+                    self.debug_stream('In updateSpectrum: roi extracted')
+            except Exception, e:
+                with self.streamLock:
+                    self.error_stream(''.join(('In updateSpectrum: ', str(e))))
+        self.calculateSpectrumParameters()
+        with self.streamLock:
+            self.debug_stream('In updateSpectrum: parameters calculated')
+
+    def openSharedRing(self):
+        """Maps the shared memory spectrum ring of the master if it runs on
+        this host. Leaves self.ring None for a remote master, or when the ring
+        is not available, and the spectra are read through Tango.
+        """
+        self.closeSharedRing()
+        if self.SharedMemory == False:
+            return
+        try:
+            masterHost = self.masterDevice.info().server_host
+        except PyTango.DevFailed, e:
             with self.streamLock:
-                self.debug_stream('In spectrumEvent: parameters calculated')
+                self.error_stream(''.join(('Could not get the master host: ', str(e))))
+            return
+        if masterHost.split('.')[0].lower() != gethostname().split('.')[0].lower():
+            with self.streamLock:
+                self.info_stream(''.join(('Master on ', masterHost, ', reading spectra through Tango')))
+            return
+        try:
+            self.ring = SharedSpectrumRing(ringName(self.Serial), wakeup=True)
+        except (SharedMemoryError, EnvironmentError), e:
+            with self.streamLock:
+                self.info_stream(''.join(('No shared memory spectrum ring, reading spectra through Tango: ', str(e))))
+            return
+        self.ringCount = 0
+        self.ringCheckTime = time.time()
+        self.ringFrame = np.empty(self.ring.numPixels, dtype=np.uint16)
+        with self.streamLock:
+            self.info_stream('Reading spectra from shared memory')
+
+    def closeSharedRing(self):
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+    def readSharedSpectrum(self):
+        """Takes the newest spectrum from the shared memory ring if there is a
+        new one. Remaps the ring when the master created a new one. Returns
+        True if a spectrum was taken.
+        """
+        try:
+            frame = self.ring.read(self.ringCount, out=self.ringFrame)
+        except SharedMemoryError, e:
+            with self.streamLock:
+                self.error_stream(''.join(('In readSharedSpectrum: ', str(e))))
+            frame = None
+        if frame is None:
+            # Checked once per second when no frames arrive
+            now = time.time()
+            if now - self.ringCheckTime > 1.0:
+                self.ringCheckTime = now
+                if self.ring.replaced() == True:
+                    self.openSharedRing()
+            return False
+        self.ringCount, data, frameInfo = frame
+        self.ringCheckTime = time.time()
+        # ringFrame is reused, updateSpectrum converts it to float
+        self.updateSpectrum(data)
+        return True
             
     def exposureTimeEvent(self, event):
         with self.streamLock:
@@ -394,12 +595,16 @@ class SPM002SpectrometerDS(PyTango.Device_4Impl):
         t0 = time.clock()
         with self.attrLock:
             sp = np.copy(self.spectrumROI)
+            spectrum = self.spectrum
+            roiStart = self.roiStart
+            roiStop = self.roiStop
             with self.streamLock:
                 self.debug_stream('In calculateSpectrumParameters: copy')
 
         if sp.size != 1:
-            # Start by median filtering to remove spikes
-            m = np.median(np.vstack((sp[6:], sp[5:-1], sp[4:-2], sp[3:-3], sp[2:-4], sp[1:-5], sp[0:-6])), axis=0)
+            # Start by filtering to remove spikes. m is a work buffer of the
+            # filter, the same length as sp and overwritten by the next frame
+            m = self.spikeFilter.filter(sp)
             noiseFloor = np.mean(m[0:10])
             peakCenterInd = m.argmax()
             halfMax = (m[peakCenterInd] + noiseFloor) / 2
@@ -430,8 +635,14 @@ class SPM002SpectrometerDS(PyTango.Device_4Impl):
                 peakWavelengths = self.wavelengthsROI[peakIndMin : peakIndMax]
                 try:
                     peakEnergy = 1560 * 1e-6 * np.trapz(peakData, peakWavelengths) / self.expTime  # Integrate total intensity             
-                    peakWidth = np.abs(np.diff(self.wavelengthsROI[halfIndReduced]))
-                    peakCenter = self.wavelengthsROI[peakCenterInd]
+                    if self.peakEstimator == PIXEL:
+                        peakWidth = np.abs(np.diff(self.wavelengthsROI[halfIndReduced]))
+                        peakCenter = self.wavelengthsROI[peakCenterInd]
+                    else:
+                        peakCenter, peakWidth = refinePeak(sp, m, peakCenterInd, noiseFloor, self.wavelengthsROI,
+                                                           self.peakEstimator, self.spikeFilter.kernel)
+                        peakCenter = peakCenter[0]
+                        peakWidth = peakWidth[0]
                 except Exception, e:
                     with self.streamLock:
                         self.error_stream(''.join(('In calculateSpectrumParameters: Error calculating peak parameters: ', str(e))))
@@ -443,6 +654,41 @@ class SPM002SpectrometerDS(PyTango.Device_4Impl):
                 self.peakEnergy = peakEnergy
                 self.peakWidth = peakWidth
                 self.peakWavelength = peakCenter
+
+            # All peaks in the ROI, in the same pass over the filtered spectrum
+            try:
+                centers, widths, energies, prominences = findPeaks(sp, m, self.wavelengthsROI, self.expTime,
+                                                                   self.MinPeakProminence, self.MinPeakWidth,
+                                                                   self.maxPeaks, self.peakEstimator,
+                                                                   self.spikeFilter.kernel)
+            except Exception, e:
+                with self.streamLock:
+                    self.error_stream(''.join(('In calculateSpectrumParameters: Error finding peaks: ', str(e))))
+                centers = np.zeros(0)
+                widths = np.zeros(0)
+                energies = np.zeros(0)
+            with self.attrLock:
+                self.peakWavelengths = centers
+                self.peakWidths = widths
+                self.peakEnergies = energies
+
+            # All named ROIs together, on the full spectrum
+            if roiStart.shape[0] > 0:
+                try:
+                    roiEnergies, roiMeans, roiMaxima = roiStatistics(spectrum, self.wavelengths, roiStart, roiStop,
+                                                                     self.expTime)
+                except Exception, e:
+                    with self.streamLock:
+                        self.error_stream(''.join(('In calculateSpectrumParameters: Error in ROI statistics: ', str(e))))
+                    roiEnergies = np.zeros(0)
+                    roiMeans = np.zeros(0)
+                    roiMaxima = np.zeros(0)
+                with self.attrLock:
+                    # Skip the result if the ROIs were changed meanwhile
+                    if roiStart is self.roiStart:
+                        self.roiEnergies = roiEnergies
+                        self.roiMeans = roiMeans
+                        self.roiMaxima = roiMaxima
             
                 with self.streamLock:
                     self.info_stream(''.join(('In calculateSpectrumParameters: computations ', str(time.clock() - t0))))
@@ -475,6 +721,28 @@ class SPM002SpectrometerDS(PyTango.Device_4Impl):
                     attrName = ''.join(('Spectrometer', str(self.Serial), 'ExposureTime'))
                     attr = self.masterDevice.read_attribute(attrName)
                     self.expTime = attr.value                    
+            elif cmd.command == 'writeAverage':
+                with self.attrLock:
+                    self.average = cmd.data
+                    attrName = ''.join(('Spectrometer', str(self.Serial), 'Average'))
+                    self.masterDevice.write_attribute(attrName, cmd.data)
+            elif cmd.command == 'readAverage':
+                with self.attrLock:
+                    attrName = ''.join(('Spectrometer', str(self.Serial), 'Average'))
+                    try:
+                        self.average = self.masterDevice.read_attribute(attrName).value
+                    except PyTango.DevFailed:
+                        # Master without on-device averaging
+                        self.average = 1
+            elif cmd.command == 'writeDarkSubtraction':
+                with self.attrLock:
+                    self.correction.darkEnabled = cmd.data
+            elif cmd.command == 'writeLinearityCorrection':
+                with self.attrLock:
+                    self.correction.linearityEnabled = cmd.data
+            elif cmd.command == 'writeSpecialPixelCorrection':
+                with self.attrLock:
+                    self.correction.specialPixelsEnabled = cmd.data
             elif cmd.command == 'writeUpdateTime':
                 with self.attrLock:
                     self.updateTime = cmd.data
@@ -483,11 +751,16 @@ class SPM002SpectrometerDS(PyTango.Device_4Impl):
             elif cmd.command == 'writePeakROI':
                 with self.attrLock:
                     self.peakROI = cmd.data
-                    roi1 = np.abs(self.wavelengths - self.peakROI[0]).argmin()
-                    roi2 = np.abs(self.wavelengths - self.peakROI[1]).argmin()
-                    self.peakROIIndex = np.array([min(roi1, roi2), max([roi1, roi2])])
+                    start, stop = roiIndices(self.wavelengths, self.peakROI)
+                    # write_PeakROI rejects empty ROIs, keep at least one
+                    # pixel in case the wavelength table changed since
+                    start = min(start[0], self.wavelengths.shape[0] - 1)
+                    stop = max(stop[0], start + 1)
+                    self.peakROIIndex = np.array([start, stop])
                     self.wavelengthsROI = self.wavelengths[self.peakROIIndex[0] : self.peakROIIndex[1]]
                     self.spectrumROI = self.spectrum[self.peakROIIndex[0] : self.peakROIIndex[1]]                
+            elif cmd.command == 'writeROIs':
+                self.setROIs(cmd.data)
             elif cmd.command == 'readUpdateTime':
                 with self.attrLock:
                     attrName = ''.join(('Spectrometer', str(self.Serial), 'UpdateTime'))
@@ -522,6 +795,38 @@ class SPM002SpectrometerDS(PyTango.Device_4Impl):
 
             pass
 
+    def setROIs(self, entries):
+        """Sets the named regions of interest from a list of 'name:min:max'
+        strings, limits in nm. The pixel ranges are looked up once here so
+        evaluating the ROIs costs almost nothing per frame. The old ROIs are
+        kept if an entry can not be parsed.
+        """
+        names = []
+        limits = []
+        if len(entries) > 32:
+            with self.streamLock:
+                self.error_stream('More than 32 ROIs, using the first 32.')
+            entries = entries[0:32]
+        try:
+            for entry in entries:
+                name, low, high = entry.rsplit(':', 2)
+                names.append(name.strip())
+                limits.append([float(low), float(high)])
+        except ValueError, e:
+            with self.streamLock:
+                self.error_stream(''.join(('Could not parse ROIs ', str(entries), ', use name:min:max. ', str(e))))
+            return
+        limits = np.array(limits).reshape(-1, 2)
+        with self.attrLock:
+            start, stop = roiIndices(self.wavelengths, limits)
+            self.roiNames = names
+            self.roiLimits = limits
+            self.roiStart = start
+            self.roiStop = stop
+            self.roiEnergies = np.zeros(0)
+            self.roiMeans = np.zeros(0)
+            self.roiMaxima = np.zeros(0)
+
 #------------------------------------------------------------------
 #     Always excuted hook method
 #------------------------------------------------------------------
@@ -645,6 +950,52 @@ class SPM002SpectrometerDS(PyTango.Device_4Impl):
             return False
         return True
 
+#------------------------------------------------------------------
+#     Average attribute
+#------------------------------------------------------------------
+    def read_Average(self, attr):
+        with self.attrLock:
+            attr_read = self.average
+            if attr_read == None:
+                attr.set_quality(PyTango.AttrQuality.ATTR_INVALID)
+                attr_read = 1
+            attr.set_value(attr_read)
+
+    def write_Average(self, attr):
+        data = attr.get_write_value()
+        cmdMsg = SpectrometerCommand('writeAverage', data)
+        self.commandQueue.put(cmdMsg)
+
+    is_Average_allowed = is_ExposureTime_allowed
+
+#------------------------------------------------------------------
+#     DarkSubtraction, LinearityCorrection and SpecialPixelCorrection attributes
+#------------------------------------------------------------------
+    def read_DarkSubtraction(self, attr):
+        with self.attrLock:
+            attr.set_value(self.correction.darkEnabled)
+
+    def write_DarkSubtraction(self, attr):
+        self.commandQueue.put(SpectrometerCommand('writeDarkSubtraction', attr.get_write_value()))
+
+    def read_LinearityCorrection(self, attr):
+        with self.attrLock:
+            attr.set_value(self.correction.linearityEnabled)
+
+    def write_LinearityCorrection(self, attr):
+        self.commandQueue.put(SpectrometerCommand('writeLinearityCorrection', attr.get_write_value()))
+
+    def read_SpecialPixelCorrection(self, attr):
+        with self.attrLock:
+            attr.set_value(self.correction.specialPixelsEnabled)
+
+    def write_SpecialPixelCorrection(self, attr):
+        self.commandQueue.put(SpectrometerCommand('writeSpecialPixelCorrection', attr.get_write_value()))
+
+    is_DarkSubtraction_allowed = is_ExposureTime_allowed
+    is_LinearityCorrection_allowed = is_ExposureTime_allowed
+    is_SpecialPixelCorrection_allowed = is_ExposureTime_allowed
+
 #------------------------------------------------------------------
 #     UpdateTime attribute
 #------------------------------------------------------------------
@@ -690,6 +1041,16 @@ class SPM002SpectrometerDS(PyTango.Device_4Impl):
         with self.streamLock:
             self.info_stream(''.join(('Writing PeakROI')))
         data = attr.get_write_value()
+        if len(data) != 2:
+            PyTango.Except.throw_exception('Bad PeakROI', 'PeakROI needs two wavelengths, [min, max] in nm', 'write_PeakROI')
+        with self.attrLock:
+            wavelengths = self.wavelengths
+        if wavelengths is not None:
+            start, stop = roiIndices(wavelengths, data)
+            if stop[0] <= start[0]:
+                PyTango.Except.throw_exception('Bad PeakROI',
+                                               ''.join(('No pixel between ', str(data[0]), ' and ', str(data[1]), ' nm')),
+                                               'write_PeakROI')
         cmdMsg = SpectrometerCommand('writePeakROI', data)
         self.commandQueue.put(cmdMsg)
 
@@ -746,6 +1107,81 @@ class SPM002SpectrometerDS(PyTango.Device_4Impl):
             return False
         return True
 
+#------------------------------------------------------------------
+#     PeakWavelengths, PeakWidths and PeakEnergies attributes
+#------------------------------------------------------------------
+    def read_PeakWavelengths(self, attr):
+        with self.attrLock:
+            attr_read = self.peakWavelengths
+        attr.set_value(attr_read, attr_read.shape[0])
+
+    def read_PeakWidths(self, attr):
+        with self.attrLock:
+            attr_read = self.peakWidths
+        attr.set_value(attr_read, attr_read.shape[0])
+
+    def read_PeakEnergies(self, attr):
+        with self.attrLock:
+            attr_read = self.peakEnergies
+        attr.set_value(attr_read, attr_read.shape[0])
+
+    def is_PeakWavelengths_allowed(self, req_type):
+        if self.get_state() in [PyTango.DevState.INIT,
+                                PyTango.DevState.UNKNOWN]:
+            #     End of Generated Code
+            #     Re-Start of Generated Code
+            return False
+        return True
+
+    is_PeakWidths_allowed = is_PeakWavelengths_allowed
+    is_PeakEnergies_allowed = is_PeakWavelengths_allowed
+
+#------------------------------------------------------------------
+#     ROIs attribute
+#------------------------------------------------------------------
+    def read_ROIs(self, attr):
+        with self.attrLock:
+            attr_read = [''.join((name, ':', str(limits[0]), ':', str(limits[1])))
+                         for name, limits in zip(self.roiNames, self.roiLimits)]
+        attr.set_value(attr_read, len(attr_read))
+
+    def write_ROIs(self, attr):
+        with self.streamLock:
+            self.info_stream(''.join(('Writing ROIs')))
+        data = attr.get_write_value()
+        cmdMsg = SpectrometerCommand('writeROIs', data)
+        self.commandQueue.put(cmdMsg)
+
+    def is_ROIs_allowed(self, req_type):
+        if self.get_state() in [PyTango.DevState.INIT,
+                                PyTango.DevState.UNKNOWN]:
+            #     End of Generated Code
+            #     Re-Start of Generated Code
+            return False
+        return True
+
+#------------------------------------------------------------------
+#     ROIEnergies, ROIMeans and ROIMaxima attributes
+#------------------------------------------------------------------
+    def read_ROIEnergies(self, attr):
+        with self.attrLock:
+            attr_read = self.roiEnergies
+        attr.set_value(attr_read, attr_read.shape[0])
+
+    def read_ROIMeans(self, attr):
+        with self.attrLock:
+            attr_read = self.roiMeans
+        attr.set_value(attr_read, attr_read.shape[0])
+
+    def read_ROIMaxima(self, attr):
+        with self.attrLock:
+            attr_read = self.roiMaxima
+        attr.set_value(attr_read, attr_read.shape[0])
+
+    is_ROIEnergies_allowed = is_ROIs_allowed
+    is_ROIMeans_allowed = is_ROIs_allowed
+    is_ROIMaxima_allowed = is_ROIs_allowed
+
 #------------------------------------------------------------------
 #     PeakWavelength attribute
 #------------------------------------------------------------------
@@ -835,6 +1271,38 @@ class SPM002SpectrometerDSClass(PyTango.DeviceClass):
             [PyTango.DevString,
             "Tango device name of the master device",
             [ 'gunlaser/devices/spm002' ] ],
+        'SpikeFilter':
+            [PyTango.DevString,
+            "Spike filter kernel applied before the peak analysis: median, hampel or minmax",
+            [ 'median' ] ],
+        'PeakEstimator':
+            [PyTango.DevString,
+            "Peak position estimator: pixel, parabolic, gaussian or centroid. All but pixel also interpolate the FWHM",
+            [ 'pixel' ] ],
+        'MinPeakProminence':
+            [PyTango.DevDouble,
+            "Minimum prominence in counts of the peaks reported in PeakWavelengths",
+            [ 100.0 ] ],
+        'MinPeakWidth':
+            [PyTango.DevDouble,
+            "Minimum width in pixels at half prominence of the peaks reported in PeakWavelengths",
+            [ 3.0 ] ],
+        'MaxPeaks':
+            [PyTango.DevLong,
+            "Maximum number of peaks reported in PeakWavelengths, at most 32",
+            [ 8 ] ],
+        'ROIs':
+            [PyTango.DevVarStringArray,
+            "Named regions of interest set at init, one name:min:max entry (nm) per line",
+            [ ] ],
+        'CalibrationDirectory':
+            [PyTango.DevString,
+            "Directory of the wavelength calibration cache, empty for $SPM002_CALIBRATION_DIR or ~/.spm002",
+            [ '' ] ],
+        'SharedMemory':
+            [PyTango.DevBoolean,
+            "Read the spectra from the shared memory ring of the master when it runs on this host",
+            [ True ] ],
         }
 
 
@@ -869,6 +1337,39 @@ class SPM002SpectrometerDSClass(PyTango.DeviceClass):
                         'Memorized':"false",
                         'unit': 'ms',
                     } ],
+        'Average':
+            [[PyTango.DevLong,
+              PyTango.SCALAR,
+              PyTango.READ_WRITE],
+                    {
+                        'description':"Number of exposures averaged in the spectrometer per spectrum, stays 1 unless the master uses the PhotonSpectr.dll backend",
+                        'min value':1,
+                        'Memorized':"false",
+                    } ],
+        'DarkSubtraction':
+            [[PyTango.DevBoolean,
+              PyTango.SCALAR,
+              PyTango.READ_WRITE],
+                    {
+                        'description':"Subtract the dark spectrum stored in the spectrometer",
+                        'Memorized':"false",
+                    } ],
+        'LinearityCorrection':
+            [[PyTango.DevBoolean,
+              PyTango.SCALAR,
+              PyTango.READ_WRITE],
+                    {
+                        'description':"Correct the counts with the linearity polynomial stored in the spectrometer",
+                        'Memorized':"false",
+                    } ],
+        'SpecialPixelCorrection':
+            [[PyTango.DevBoolean,
+              PyTango.SCALAR,
+              PyTango.READ_WRITE],
+                    {
+                        'description':"Interpolate over the hot and dead pixels listed in the spectrometer",
+                        'Memorized':"false",
+                    } ],
         'Spectrum':
             [[PyTango.DevDouble,
             PyTango.SPECTRUM,
@@ -933,6 +1434,61 @@ class SPM002SpectrometerDSClass(PyTango.DeviceClass):
                 'description':"Energy inside the main peak",
                 'unit':'counts*m/s'
             } ],
+        'PeakWavelengths':
+            [[PyTango.DevDouble,
+            PyTango.SPECTRUM,
+            PyTango.READ, 32],
+            {
+                'unit':"nm",
+                'description': "Center wavelengths of all peaks in the region of interest",
+            } ],
+        'PeakWidths':
+            [[PyTango.DevDouble,
+            PyTango.SPECTRUM,
+            PyTango.READ, 32],
+            {
+                'unit':"nm",
+                'description': "Full width at half prominence of each peak in PeakWavelengths",
+            } ],
+        'PeakEnergies':
+            [[PyTango.DevDouble,
+            PyTango.SPECTRUM,
+            PyTango.READ, 32],
+            {
+                'description':"Energy inside each peak in PeakWavelengths",
+                'unit':'counts*m/s'
+            } ],
+        'ROIs':
+            [[PyTango.DevString,
+            PyTango.SPECTRUM,
+            PyTango.READ_WRITE, 32],
+            {
+                'description': "Named regions of interest, name:min:max with the limits in nm",
+            } ],
+        'ROIEnergies':
+            [[PyTango.DevDouble,
+            PyTango.SPECTRUM,
+            PyTango.READ, 32],
+            {
+                'description':"Energy inside each ROI, in the order of ROIs",
+                'unit':'counts*m/s'
+            } ],
+        'ROIMeans':
+            [[PyTango.DevDouble,
+            PyTango.SPECTRUM,
+            PyTango.READ, 32],
+            {
+                'description':"Mean counts inside each ROI, in the order of ROIs",
+                'unit':'a.u.'
+            } ],
+        'ROIMaxima':
+            [[PyTango.DevDouble,
+            PyTango.SPECTRUM,
+            PyTango.READ, 32],
+            {
+                'description':"Maximum counts inside each ROI, in the order of ROIs",
+                'unit':'a.u.'
+            } ],
         }
 
 
@@ -32,19 +32,59 @@
 
 
 import PyTango
+import os
 import sys
-import SPM002_control as spm
+try:
+	if os.environ.get('SPM002_DLL', '').lower() == 'photonspectr':
+		# Newer vendor DLL, adds on-device averaging and the correction tables
+		import SPM002_control_new as spm
+	else:
+		import SPM002_control as spm
+except (ImportError, NameError, OSError):
+	# No vendor DLL on this host (e.g. Linux), use the libusb backend. It
+	# only opens hardware with SPM002_USB_BACKEND=1, see SPM002_usb.py
+	import SPM002_usb as spm
 import threading
 import time
 import numpy as np
 from socket import gethostname
 import Queue
+from SPM002_timing import monotonic, FramePacer
+from SPM002_analysis import SpikeFilter, refinePeak, PIXEL, ESTIMATORS
+from SPM002_calibration import CalibrationCache, loadCalibration
+from SPM002_ringbuffer import StaleFrameDetector
+from SPM002_exposure import AutoExposureController
+from SPM002_correction import SpectrumCorrection
 
 		
 class SpectrometerCommand:
 	def __init__(self, command, data=None):
 		self.command = command
 		self.data = data
+
+
+class SpectrumSnapshot(object):
+	"""Result of one processed frame: the spectrum, its frame info and the
+	parameters calculated from it. A snapshot takes ownership of spectrum,
+	which the caller must not reuse, and is never modified after it is
+	created. The acquisition thread publishes a new one by rebinding
+	SPM002_DS.snapshot, which is atomic, so attribute reads pick up a
+	consistent frame without taking a lock and never stall acquisition,
+	however long they hold on to it.
+	"""
+	__slots__ = ('spectrum', 'sequence', 'startTime', 'endTime', 'timestamp',
+				'center', 'fwhm', 'peakEnergy', 'analysisTime')
+
+	def __init__(self, spectrum=None, frameInfo=(-1, None, None, None),
+				center=0.0, fwhm=0.0, peakEnergy=0.0, analysisTime=0.0):
+		if spectrum is not None:
+			spectrum.flags.writeable = False
+		self.spectrum = spectrum
+		self.sequence, self.startTime, self.endTime, self.timestamp = frameInfo
+		self.center = center
+		self.fwhm = fwhm
+		self.peakEnergy = peakEnergy
+		self.analysisTime = analysisTime
 		
 #==================================================================
 #   SPM002_DS Class Description:
@@ -79,6 +119,8 @@ class SPM002_DS(PyTango.Device_4Impl):
 #------------------------------------------------------------------
 	def delete_device(self):
 		print "[Device delete_device method] for device", self.get_name()
+		if self.hotplug is not None:
+			self.hotplug.removeListener(self.hotplugEvent)
 		self.stopStateThread()
 		self.spectrometer.closeDevice()
 
@@ -101,6 +143,8 @@ class SPM002_DS(PyTango.Device_4Impl):
 		threading.Thread.__init__(self.stateThread, target=self.stateHandlerDispatcher)
 		
 		self.commandQueue = Queue.Queue(100)
+		self.hotplug = None
+		self.deviceDeparted = False
 		
 		self.stateHandlerDict = {PyTango.DevState.ON: self.onHandler,
 								PyTango.DevState.STANDBY: self.standbyHandler,
@@ -148,20 +192,42 @@ class SPM002_DS(PyTango.Device_4Impl):
 		self.info_stream('Entering unknownHandler')
 		connectionTimeout = 1.0
 		
+		# spectrumData is only used by the state thread, attribute reads
+		# go through the published snapshot
 		self.spectrumData = None
-		self.spectrumCenter = 0.0
-		self.spectrumFWHM = 0.0
-		self.peakEnergy = 0.0
+		self.snapshot = SpectrumSnapshot()
+		self.staleDetector = StaleFrameDetector(self.StaleTimeout)
 
 		self.expTime = 200
 		self.updateTime = 500
 		self.autoExpose = True
+		self.average = 1
+		self.correction = SpectrumCorrection(3648)
+		try:
+			self.autoExposure = AutoExposureController(self.AutoExposureTarget, self.AutoExposurePercentile)
+		except ValueError, e:
+			self.error_stream(''.join(('Bad AutoExposure properties, using defaults. ', str(e))))
+			self.autoExposure = AutoExposureController()
+		self.pacer = FramePacer(self.updateTime * 1e-3, FramePacer.FIXED_RATE)
+		try:
+			self.spikeFilter = SpikeFilter(self.SpikeFilter)
+		except ValueError, e:
+			self.error_stream(''.join(('Bad SpikeFilter property, using median. ', str(e))))
+			self.spikeFilter = SpikeFilter(SpikeFilter.MEDIAN)
+		self.calibrationCache = CalibrationCache(self.CalibrationDirectory)
+		self.peakEstimator = self.PeakEstimator
+		if self.peakEstimator not in ESTIMATORS:
+			self.error_stream(''.join(('Bad PeakEstimator property ', str(self.peakEstimator), ', using pixel.')))
+			self.peakEstimator = PIXEL
 		self.deviceList = []
 
 		while self.get_state() == PyTango.DevState.UNKNOWN:
 			self.info_stream('Trying to connect...')
 			try:				
 				self.spectrometer = spm.SPM002control()
+				self.hotplug = spm.hotplugMonitor()
+				if self.hotplug is not None:
+					self.hotplug.addListener(self.hotplugEvent)
 				self.set_state(PyTango.DevState.INIT)
 				self.info_stream('... connected')
 				break
@@ -187,14 +253,18 @@ class SPM002_DS(PyTango.Device_4Impl):
 		
 		while exitInitFlag == False:
 			exitInitFlag = True  # Preset in case nothing goes wrong
-			s = 'Populating device list. Could be time consuming.\n'
+			s = 'Populating device list.\n'
 			s_status = ''.join((s_status, s))
 			self.set_status(s_status)
-			self.info_stream(s)			
+			self.info_stream(s)
+			# The first lookup uses the serial map shared with the other
+			# devices of this process, the bus is only scanned on retries
+			rescan = False
 			while self.Serial not in self.spectrometer.serialList: 
 				try:
 
-					self.spectrometer.populateDeviceList()
+					self.spectrometer.populateDeviceList(rescan)
+					rescan = True
 					self.info_stream(str(self.spectrometer.serialList))
 					if self.Serial not in self.spectrometer.serialList:
 						self.error_stream(''.join(('Device ', str(self.Serial), ' not in list, retrying')))
@@ -208,6 +278,8 @@ class SPM002_DS(PyTango.Device_4Impl):
 						
 				except Exception, e:
 					self.error_stream(''.join(('Could not populate device list, retrying', str(e))))
+					rescan = True
+					time.sleep(initTimeout)
 				
 			try:
 				s = ''.join(('Setting device ', str(self.Serial), '\n'))
@@ -224,10 +296,11 @@ class SPM002_DS(PyTango.Device_4Impl):
 				s_status = ''.join((s_status, s))
 				self.set_status(s_status)
 				self.info_stream(s)
-				self.spectrometer.constructWavelengths()
+				if loadCalibration(self.spectrometer, self.Serial, self.calibrationCache) == True:
+					self.info_stream(''.join(('Wavelength table from cache ', self.calibrationCache.directory)))
 				self.wavelengths = self.spectrometer.wavelengths
 			except Exception, e:
-				self.error_stream('Could not construct wavelengths')
+				self.error_stream(''.join(('Could not construct wavelengths ', str(e))))
 				exitInitFlag = False
 				continue
 			s = 'Setting exposure time\n'
@@ -255,6 +328,15 @@ class SPM002_DS(PyTango.Device_4Impl):
 				self.info_stream(s)
 			except Exception, e:
 				self.error_stream('Could not retrieve attribute UpdateTime, using default value')
+			self.pacer.setPeriod(self.updateTime * 1e-3)
+
+			try:
+				mode = attrs.get_w_attr_by_name('AcquisitionMode').get_write_value()
+				self.pacer.setMode(mode)
+				s = ''.join(('Acquisition mode ', str(mode)))
+				self.info_stream(s)
+			except Exception, e:
+				self.error_stream('Could not retrieve attribute AcquisitionMode, using default value')
 
 			try:
 				self.autoExpose = attrs.get_w_attr_by_name('AutoExposure').get_write_value()
@@ -263,12 +345,18 @@ class SPM002_DS(PyTango.Device_4Impl):
 			except Exception, e:
 				self.error_stream('Could not retrieve attribute UpdateTime, using default value')
 
+			self.loadCorrectionTables()
+			try:
+				self.correction.darkEnabled = attrs.get_w_attr_by_name('DarkSubtraction').get_write_value()
+				self.correction.linearityEnabled = attrs.get_w_attr_by_name('LinearityCorrection').get_write_value()
+				self.correction.specialPixelsEnabled = attrs.get_w_attr_by_name('SpecialPixelCorrection').get_write_value()
+			except Exception, e:
+				self.error_stream('Could not retrieve correction attributes, corrections off')
 			try:
-				self.spectrometer.closeDevice()
+				self.average = attrs.get_w_attr_by_name('Average').get_write_value()
+				self.setAverage()
 			except Exception, e:
-				self.error_stream(''.join(('Could not disconnect from spectrometer, ', str(e))))
-			time.sleep(5)  # Wait to let other spectrometers populate their device lists
-			self.openSpectrometer()
+				self.error_stream('Could not retrieve attribute Average, using default value')
 
 			self.set_status('Connected to spectrometer, not acquiring')
 			self.info_stream('Initialization finished.')
@@ -282,8 +370,8 @@ class SPM002_DS(PyTango.Device_4Impl):
 		while self.stopStateThreadFlag == False:
 			if self.get_state() != PyTango.DevState.STANDBY:
 				break
-			# Check if any new commands arrived:
-			self.checkCommands()
+			# Wait for new commands, checking the hardware every 0.5 s:
+			self.checkCommands(blockTime=0.5)
 			if self.get_state() != PyTango.DevState.STANDBY:
 				break
 						
@@ -295,7 +383,6 @@ class SPM002_DS(PyTango.Device_4Impl):
 				self.set_state(PyTango.DevState.FAULT)
 			finally:
 				self.hardwareLock.release()
-			time.sleep(0.5)
 
 
 	def onHandler(self, prevState):
@@ -303,61 +390,40 @@ class SPM002_DS(PyTango.Device_4Impl):
 		self.set_status('Connected to spectrometer, acquiring spectra')
 		handledStates = [PyTango.DevState.ON, PyTango.DevState.ALARM]
 		self.openSpectrometer()
-		if self.updateTime > self.expTime:
-			self.sleepTime = (self.updateTime - self.expTime) * 1e-3
-		else:
-			self.sleepTime = self.expTime * 1e-3
-		s = ''.join(('Sleeptime: ', str(self.sleepTime)))
+		self.pacer.reset()
+		s = ''.join(('Pacing ', self.pacer.mode, ', update time ', str(self.updateTime), ' ms'))
 		self.info_stream(s)
-		newSpectrumTimestamp = time.time()
-		oldSpectrumTimestamp = time.time()
-		self.hardwareLock.acquire()
+		self.staleDetector.reset()
 		self.spectrumData = self.spectrometer.CCD
-		self.hardwareLock.release()
-		nextUpdateTime = time.time()
 		while self.stopStateThreadFlag == False:
 			if self.get_state() not in handledStates:
 				break
 
-			# Check if any new commands arrived:
-			self.checkCommands()
+			if self.pacer.mode == FramePacer.CONTINUOUS:
+				self.continuousAcquisition(handledStates)
+				continue
+
+			# Block on the command queue until the next acquisition is due:
+			self.checkCommands(blockTime=self.pacer.timeToNext())
 			
 			# Check if we should break this loop and go to a new state handler:
 			if self.get_state() not in handledStates:
 				break
 
 			try:
-				t = time.time()
-				if t > nextUpdateTime:
+				if self.pacer.timeToNext() <= 0:
 					self.debug_stream(''.join(("In ", self.get_name(), "::onHandler()... acquire spectrum")))
+					self.pacer.frameStarted()
 					self.hardwareLock.acquire()
-					self.spectrometer.acquireSpectrum()
-					newSpectrum = self.spectrometer.CCD				
-					self.hardwareLock.release()
+					try:
+						self.spectrometer.acquireSpectrum()
+						newSpectrum = self.spectrometer.CCD				
+						frameInfo = self.spectrometer.getFrameInfo()
+					finally:
+						self.hardwareLock.release()
+					self.pacer.frameDone()
 					self.debug_stream(''.join(("In ", self.get_name(), "::onHandler()... spectrum done")))
-					newSpectrumTimestamp = time.time()
-					d = np.abs(newSpectrum - self.spectrumData).sum()
-					if d == 0:					
-						if newSpectrumTimestamp - oldSpectrumTimestamp > 5: 					
-							self.set_state(PyTango.DevState.FAULT)
-							self.set_status('Spectrum not updating. Reconnecting.')
-							self.error_stream('Spectrum not updating. Reconnecting.')
-					else:
-						oldSpectrumTimestamp = newSpectrumTimestamp
-					self.debug_stream(''.join(("In ", self.get_name(), "::onHandler()... copy spectrum")))						
-					self.spectrumData = np.copy(newSpectrum)
-					self.debug_stream(''.join(("In ", self.get_name(), "::onHandler()... calculate parameters")))					
-					self.calculateSpectrumParameters()
-					self.debug_stream(''.join(("In ", self.get_name(), "::onHandler()... done")))
-					self.attrLock.acquire()
-					if self.updateTime > self.expTime:
-						self.sleepTime = (self.updateTime - self.expTime) * 1e-3
-					else:
-						self.sleepTime = self.expTime * 1e-3
-					self.attrLock.release()
-					
-					nextUpdateTime = t + self.sleepTime
-				time.sleep(0.01)
+					self.processSpectrum(newSpectrum, frameInfo)
 
 			except Exception, e:
 				self.set_state(PyTango.DevState.FAULT)
@@ -365,6 +431,74 @@ class SPM002_DS(PyTango.Device_4Impl):
 				PyTango.Except.throw_exception('Error reading hardware', str(e), 'readHardware thread')
 
 
+	def continuousAcquisition(self, handledStates):
+		"""Free running acquisition used in the continuous acquisition mode.
+		The spectrometer arms the next exposure as soon as the previous readout
+		is done and every frame is processed. Commands are checked between
+		frames without blocking. Returns when the state or the acquisition
+		mode changes.
+		"""
+		self.info_stream('Starting continuous acquisition')
+		stream = self.spectrometer.streamSpectra()
+		try:
+			while self.stopStateThreadFlag == False:
+				self.hardwareLock.acquire()
+				try:
+					newSpectrum = next(stream)
+					frameInfo = self.spectrometer.getFrameInfo()
+				finally:
+					self.hardwareLock.release()
+				self.pacer.frameStarted(frameInfo[1])
+				self.pacer.frameDone(frameInfo[2])
+				self.processSpectrum(newSpectrum, frameInfo)
+
+				self.checkCommands()
+				if self.get_state() not in handledStates or self.pacer.mode != FramePacer.CONTINUOUS:
+					break
+		except StopIteration:
+			# The generator ends when the device is closed
+			self.set_state(PyTango.DevState.FAULT)
+			self.set_status('Spectrometer closed during acquisition.')
+		except Exception, e:
+			self.set_state(PyTango.DevState.FAULT)
+			self.set_status('Error reading hardware.')
+			self.error_stream(''.join(('Error in continuous acquisition: ', str(e))))
+		finally:
+			stream.close()
+		self.info_stream('Continuous acquisition stopped')
+
+
+	def processSpectrum(self, newSpectrum, frameInfo):
+		"""Checks that the spectrum is updating, calculates the spectrum
+		parameters and publishes the result as a new snapshot. newSpectrum is
+		a read-only view into the spectrometer ring buffer, frameInfo the
+		matching getFrameInfo() tuple.
+		"""
+		if self.staleDetector.update(frameInfo[0], newSpectrum) == True:
+			self.set_state(PyTango.DevState.FAULT)
+			self.set_status('Spectrum not updating. Reconnecting.')
+			self.error_stream('Spectrum not updating. Reconnecting.')
+		# Only used in this thread
+		self.spectrumData = newSpectrum
+		self.debug_stream(''.join(("In ", self.get_name(), "::onHandler()... calculate parameters")))					
+		t0 = monotonic()
+		# The one copy per frame, the ring buffer slot is reused a few frames
+		# later while the snapshot may be read for longer
+		if self.correction.enabled() == True:
+			sp = self.correction.apply(newSpectrum, np.empty(newSpectrum.shape[0]))
+		else:
+			sp = np.array(newSpectrum)
+		center, fwhm, peakEnergy = self.calculateSpectrumParameters(sp)
+		analysisTime = (monotonic() - t0) * 1e3
+		self.snapshot = SpectrumSnapshot(sp, frameInfo, center, fwhm, peakEnergy, analysisTime)
+		if self.autoExpose == True:
+			newExp = self.autoExposure.update(newSpectrum, self.expTime, frameInfo[1])
+			if newExp is not None:
+				self.expTime = newExp
+				self.setExposure(True)
+		self.debug_stream(''.join(("In ", self.get_name(), "::onHandler()... done")))
+
+
 	def alarmHandler(self, prevState):
 		pass
 
@@ -374,25 +508,54 @@ class SPM002_DS(PyTango.Device_4Impl):
 		maxAttempts = 5
 		responseTimeout = 0.5
 		self.info_stream('Entering faultHandler.')
-		self.set_status('Fault condition detected')
+		if self.deviceDeparted == False:
+			self.set_status('Fault condition detected')
 			
-		while self.get_state() == PyTango.DevState.FAULT:
+		while self.get_state() == PyTango.DevState.FAULT and self.stopStateThreadFlag == False:
+			if self.deviceDeparted == True:
+				# Unplugged. The hotplug monitor queues a command when a
+				# spectrometer arrives, so wait for that instead of retrying.
+				self.checkCommands(blockTime=responseTimeout)
+				continue
 			try:
-				self.spectrometer.closeDevice()
-				self.openSpectrometer()
+				self.hardwareLock.acquire()
+				try:
+					self.spectrometer.closeDevice()
+					# Rescans only if the serial map was invalidated
+					self.spectrometer.populateDeviceList()
+					self.spectrometer.openDeviceSerial(self.Serial)
+				finally:
+					self.hardwareLock.release()
 				
 				self.set_state(prevState)
 				self.info_stream('Fault condition cleared.')
 				break
 			except Exception, e:
 				self.error_stream(''.join(('In faultHandler: Testing controller response. Returned ', str(e))))
+				if self.hotplug is not None and self.Serial not in self.spectrometer.serialList:
+					self.deviceDeparted = True
+					self.set_status('Spectrometer disconnected, waiting for it to return')
+					continue
 				responseAttempts += 1
 			if responseAttempts >= maxAttempts:
 				self.set_state(PyTango.DevState.UNKNOWN)
 				self.set_status('Could not connect to controller')
 				self.error_stream('Giving up fault handling. Going to UNKNOWN state.')
 				break
-			time.sleep(responseTimeout)
+			self.checkCommands(blockTime=responseTimeout)
+
+
+	def hotplugEvent(self, event, key):
+		"""Hotplug listener, called from the monitor thread. Departures of
+		other devices are ignored, arrivals are all queued since the serial
+		of a new device is not known yet.
+		"""
+		if event == spm.HOTPLUG_LEFT and key != self.spectrometer.deviceHandle:
+			return
+		try:
+			self.commandQueue.put(SpectrometerCommand('hotplug', event), block=False)
+		except Queue.Full:
+			pass
 
 
 	def offHandler(self, prevState):
@@ -406,28 +569,52 @@ class SPM002_DS(PyTango.Device_4Impl):
 		while self.stopStateThreadFlag == False:
 			if self.get_state() != PyTango.DevState.OFF:
 				break
-			# Check if any new commands arrived:
-			self.checkCommands()
-			if self.get_state() != PyTango.DevState.OFF:
-				break
+			# Wait for new commands:
+			self.checkCommands(blockTime=0.5)
 
-			time.sleep(0.5)
 
-
-	def checkCommands(self):
+	def checkCommands(self, blockTime=0):
+		"""Checks the commandQueue for new commands, waiting at most blockTime s
+		for one to arrive. With blockTime <= 0 the method exits immediately
+		if the queue is empty.
+		"""
 		try:
-			cmd = self.commandQueue.get(block=False)
+			if blockTime <= 0:
+				cmd = self.commandQueue.get(block=False)
+			else:
+				cmd = self.commandQueue.get(block=True, timeout=blockTime)
 			self.info_stream(str(cmd.command))
 			if cmd.command == 'writeExposureTime':
 				self.expTime = cmd.data
+				self.autoExposure.reset()
 				self.setExposure(True)
 					
 			elif cmd.command == 'writeUpdateTime':
 				self.updateTime = cmd.data
-				self.setExposure(True)
+				self.pacer.setPeriod(self.updateTime * 1e-3)
+
+			elif cmd.command == 'writeAcquisitionMode':
+				try:
+					self.pacer.setMode(cmd.data)
+				except ValueError, e:
+					self.error_stream(str(e))
 
 			elif cmd.command == 'writeAutoExposure':
 				self.autoExpose = cmd.data
+				self.autoExposure.reset()
+
+			elif cmd.command == 'writeAverage':
+				self.average = cmd.data
+				self.setAverage()
+
+			elif cmd.command == 'writeDarkSubtraction':
+				self.correction.darkEnabled = cmd.data
+
+			elif cmd.command == 'writeLinearityCorrection':
+				self.correction.linearityEnabled = cmd.data
+
+			elif cmd.command == 'writeSpecialPixelCorrection':
+				self.correction.specialPixelsEnabled = cmd.data
 
 			elif cmd.command == 'on':
 				
@@ -440,28 +627,24 @@ class SPM002_DS(PyTango.Device_4Impl):
 			elif cmd.command == 'off':
 				self.set_state(PyTango.DevState.OFF)			
 
+			elif cmd.command == 'hotplug':
+				if cmd.data == spm.HOTPLUG_LEFT:
+					self.deviceDeparted = True
+					self.set_state(PyTango.DevState.FAULT)
+					self.set_status('Spectrometer disconnected, waiting for it to return')
+					self.error_stream('Spectrometer disconnected')
+				elif self.deviceDeparted == True:
+					# Possibly ours, faultHandler checks the serial
+					self.deviceDeparted = False
+
 		except Queue.Empty:
 			pass
 
 	def setExposure(self, forceSet=False):
+		"""Writes expTime to the hardware. With auto exposure on, the
+		AutoExposureController decides the value in processSpectrum.
+		"""
 		self.info_stream('In setExposure: ')
-		if self.autoExpose == True:
-			# We will try to keep the max reading at around nomI counts
-			nomI = 2500.0
-			self.debug_stream('lock acquire')
-			self.attrLock.acquire()
-			maxI = np.max(self.spectrumData)
-			self.attrLock.release()
-			self.debug_stream('lock release')
-			# Don't adjust if the intensity is within 10% of nominal	
-			if (nomI / maxI > 1.1) or (nomI / maxI < 0.9): 		
-				newExp = nomI / maxI * self.expTime
-				# Don't adjust to over 500 ms, the update rate would be too slow
-				if newExp > 500:
-					newExp = 500			
-				self.expTime = newExp
-				forceSet = True 
-
 		if forceSet == True:
 			t0 = time.clock()
 			try:
@@ -474,16 +657,48 @@ class SPM002_DS(PyTango.Device_4Impl):
 				self.error_stream(''.join(('Could not set exposure time', str(e))))
 			finally:
 				self.hardwareLock.release()
-			if self.updateTime > self.expTime:
-				self.sleepTime = (self.updateTime - self.expTime) * 1e-3
-			else:
-				self.sleepTime = self.expTime * 1e-3
 			dt = time.clock() - t0
 			self.info_stream(''.join(('Time to set exposure: ', str(dt))))
 				
 		
 		
 
+	def setAverage(self):
+		"""Sets the number of exposures averaged on the device per spectrum.
+		Only the PhotonSpectr.dll backend averages on the device, with the
+		others the average stays 1.
+		"""
+		if hasattr(self.spectrometer, 'setAverage') == False:
+			self.average = 1
+			return
+		self.hardwareLock.acquire()
+		try:
+			self.spectrometer.setAverage(int(self.average))
+			self.average = self.spectrometer.getAverage()
+			self.info_stream(''.join(('Averaging ', str(self.average), ' exposures per spectrum')))
+		except Exception, e:
+			self.error_stream(''.join(('Could not set average, ', str(e))))
+		finally:
+			self.hardwareLock.release()
+			
+	def loadCorrectionTables(self):
+		"""Reads the dark spectrum, linearity coefficients and special pixels
+		stored in the spectrometer. Only the PhotonSpectr.dll backend has
+		them, otherwise the tables stay unset and the corrections do nothing.
+		"""
+		if hasattr(self.spectrometer, 'getDark') == False:
+			return
+		self.hardwareLock.acquire()
+		try:
+			try:
+				self.correction.setDark(self.spectrometer.getDark())
+				self.correction.setLinearity(self.spectrometer.getLinearity())
+				self.correction.setSpecialPixels(self.spectrometer.getSpecialPixels())
+			except Exception, e:
+				self.error_stream(''.join(('Could not read correction tables, ', str(e))))
+		finally:
+			self.hardwareLock.release()
+
 	def openSpectrometer(self):
 		# If the device was closed, we open it again
 		self.debug_stream('Entering openSpectrometer')
@@ -516,15 +731,16 @@ class SPM002_DS(PyTango.Device_4Impl):
 		self.set_state(PyTango.DevState.UNKNOWN)
 
 
-	def calculateSpectrumParameters(self):
-		self.debug_stream('lock acquire')
-		self.attrLock.acquire()
-		sp = np.copy(self.spectrumData)
-		self.attrLock.release()
-		self.debug_stream('lock release')
+	def calculateSpectrumParameters(self, sp):
+		"""Returns (center, fwhm, peakEnergy) of the spectrum sp. The values
+		of the current snapshot are returned if sp is not a full spectrum.
+		"""
+		snapshot = self.snapshot
+		center, fwhm, peakEnergy = snapshot.center, snapshot.fwhm, snapshot.peakEnergy
 		if sp.size != 1:
-			# Start by median filtering to remove spikes
-			m = np.median(np.vstack((sp[6:], sp[5:-1], sp[4:-2], sp[3:-3], sp[2:-4], sp[1:-5], sp[0:-6])), axis=0)
+			# Start by filtering to remove spikes. m is a work buffer of the
+			# filter, the same length as sp and overwritten by the next frame
+			m = self.spikeFilter.filter(sp)
 			noiseFloor = np.mean(m[0:10])
 			peakInd = m.argmax()
 			halfMax = (m[peakInd] + noiseFloor) / 2
@@ -540,19 +756,19 @@ class SPM002_DS(PyTango.Device_4Impl):
  			# The peak is then located between [peakEdge - 1] and [peakEdge + 1]: 
  			peakData = sp[noiseInd[peakEdge - 1]:noiseInd[peakEdge + 1]]
  			
- 			self.debug_stream('lock acquire')
- 			self.attrLock.acquire()
  			peakWavelengths = self.wavelengths[noiseInd[peakEdge - 1]:noiseInd[peakEdge + 1]]
- 			self.peakEnergy = 1560 * 1e-6 * np.trapz(peakData, peakWavelengths) / self.expTime  # Integrate total intensity 			
-			self.spectrumFWHM = np.abs(np.diff(self.wavelengths[halfIndReduced]))
-			self.spectrumCenter = self.wavelengths[peakInd]
-			self.attrLock.release()
-			self.debug_stream('lock release')
-			
-			self.info_stream(''.join(('In calculateSpectrumParameters: PeakEnergy = ', str(self.peakEnergy))))
+ 			peakEnergy = 1560 * 1e-6 * np.trapz(peakData, peakWavelengths) / self.expTime  # Integrate total intensity 			
+			if self.peakEstimator == PIXEL:
+				fwhm = np.abs(np.diff(self.wavelengths[halfIndReduced]))
+				center = self.wavelengths[peakInd]
+			else:
+				center, fwhm = refinePeak(sp, m, peakInd, noiseFloor, self.wavelengths,
+										self.peakEstimator, self.spikeFilter.kernel)
+				center = center[0]
+				fwhm = fwhm[0]
 			
-			if self.autoExpose == True:
-				self.setExposure()
+			self.info_stream(''.join(('In calculateSpectrumParameters: PeakEnergy = ', str(peakEnergy))))
+		return center, fwhm, peakEnergy
 
 
 #------------------------------------------------------------------
@@ -616,12 +832,8 @@ class SPM002_DS(PyTango.Device_4Impl):
 	def read_ExposureTime(self, attr):
 		
 		# 	Add your own code here
-		self.debug_stream('lock acquire')
-		self.attrLock.acquire()
 		attr_ExposureTime_read = self.expTime
 		attr.set_value(attr_ExposureTime_read)
-		self.attrLock.release()
-		self.debug_stream('lock release')
 
 
 #------------------------------------------------------------------
@@ -641,12 +853,8 @@ class SPM002_DS(PyTango.Device_4Impl):
 	def read_AutoExposure(self, attr):
 		
 		# 	Add your own code here
-		self.debug_stream('lock acquire')
-		self.attrLock.acquire()
 		attr_ExposureTime_read = self.autoExpose
 		attr.set_value(attr_ExposureTime_read)
-		self.attrLock.release()
-		self.debug_stream('lock release')
 
 
 #------------------------------------------------------------------
@@ -666,12 +874,8 @@ class SPM002_DS(PyTango.Device_4Impl):
 	def read_UpdateTime(self, attr):
 		
 		# 	Add your own code here
-		self.debug_stream('lock acquire')
-		self.attrLock.acquire()
 		attr_UpdateTime_read = self.updateTime
 		attr.set_value(attr_UpdateTime_read)
-		self.attrLock.release()
-		self.debug_stream('lock release')
 
 
 #------------------------------------------------------------------
@@ -683,15 +887,7 @@ class SPM002_DS(PyTango.Device_4Impl):
 		print "Attribute value = ", data
 
 		# 	Add your own code here
-		self.debug_stream('lock acquire')
-		self.attrLock.acquire()
-		self.updateTime = data
-		self.attrLock.release()
-		self.debug_stream('lock release')
-		# If running, restart capture thread with new update time
-# 		if self.get_state() == PyTango.DevState.ON:
-# 			self.stopStateThread()
-# 			self.startStateThread()
+		self.commandQueue.put(SpectrometerCommand('writeUpdateTime', data))
 
 
 #---- UpdateTime attribute State Machine -----------------
@@ -704,18 +900,123 @@ class SPM002_DS(PyTango.Device_4Impl):
 		return True
 
 
+#------------------------------------------------------------------
+# 	Read AcquisitionMode attribute
+#------------------------------------------------------------------
+	def read_AcquisitionMode(self, attr):
+		
+		# 	Add your own code here
+		attr.set_value(self.pacer.mode)
+
+
+#------------------------------------------------------------------
+# 	Write AcquisitionMode attribute
+#------------------------------------------------------------------
+	def write_AcquisitionMode(self, attr):
+		print "In ", self.get_name(), "::write_AcquisitionMode()"
+		data = attr.get_write_value()
+		print "Attribute value = ", data
+
+		# 	Add your own code here
+		self.commandQueue.put(SpectrometerCommand('writeAcquisitionMode', data))
+
+
+#---- AcquisitionMode attribute State Machine -----------------
+	def is_AcquisitionMode_allowed(self, req_type):
+		if self.get_state() in [PyTango.DevState.OFF,
+		                        PyTango.DevState.UNKNOWN]:
+			# 	End of Generated Code
+			# 	Re-Start of Generated Code
+			return False
+		return True
+
+
+#------------------------------------------------------------------
+# 	Read Average attribute
+#------------------------------------------------------------------
+	def read_Average(self, attr):
+		
+		# 	Add your own code here
+		attr.set_value(self.average)
+
+
+#------------------------------------------------------------------
+# 	Write Average attribute
+#------------------------------------------------------------------
+	def write_Average(self, attr):
+		print "In ", self.get_name(), "::write_Average()"
+		data = attr.get_write_value()
+		print "Attribute value = ", data
+
+		# 	Add your own code here
+		self.commandQueue.put(SpectrometerCommand('writeAverage', data))
+
+
+#------------------------------------------------------------------
+# 	DarkSubtraction, LinearityCorrection and SpecialPixelCorrection attributes
+#------------------------------------------------------------------
+	def read_DarkSubtraction(self, attr):
+		attr.set_value(self.correction.darkEnabled)
+
+	def write_DarkSubtraction(self, attr):
+		self.commandQueue.put(SpectrometerCommand('writeDarkSubtraction', attr.get_write_value()))
+
+	def read_LinearityCorrection(self, attr):
+		attr.set_value(self.correction.linearityEnabled)
+
+	def write_LinearityCorrection(self, attr):
+		self.commandQueue.put(SpectrometerCommand('writeLinearityCorrection', attr.get_write_value()))
+
+	def read_SpecialPixelCorrection(self, attr):
+		attr.set_value(self.correction.specialPixelsEnabled)
+
+	def write_SpecialPixelCorrection(self, attr):
+		self.commandQueue.put(SpectrometerCommand('writeSpecialPixelCorrection', attr.get_write_value()))
+
+	is_Average_allowed = is_AcquisitionMode_allowed
+	is_DarkSubtraction_allowed = is_AcquisitionMode_allowed
+	is_LinearityCorrection_allowed = is_AcquisitionMode_allowed
+	is_SpecialPixelCorrection_allowed = is_AcquisitionMode_allowed
+
+
+#------------------------------------------------------------------
+# 	Read AchievedRate attribute
+#------------------------------------------------------------------
+	def read_AchievedRate(self, attr):
+		
+		# 	Add your own code here
+		attr.set_value(self.pacer.achievedRate())
+
+
+#------------------------------------------------------------------
+# 	Read RequestedRate attribute
+#------------------------------------------------------------------
+	def read_RequestedRate(self, attr):
+		
+		# 	Add your own code here
+		attr.set_value(self.pacer.requestedRate())
+
+
+#---- AchievedRate/RequestedRate attribute State Machine -----------------
+	def is_AchievedRate_allowed(self, req_type):
+		if self.get_state() in [PyTango.DevState.OFF,
+		                        PyTango.DevState.UNKNOWN]:
+			# 	End of Generated Code
+			# 	Re-Start of Generated Code
+			return False
+		return True
+
+	is_RequestedRate_allowed = is_AchievedRate_allowed
+
+
 #------------------------------------------------------------------
 # 	Read PeakWavelength attribute
 #------------------------------------------------------------------
 	def read_PeakWavelength(self, attr):
 		
 		# 	Add your own code here
-		self.debug_stream('lock acquire')
-		self.attrLock.acquire()
-		attr_PeakWavelength_read = self.spectrumCenter
+		attr_PeakWavelength_read = self.snapshot.center
 		attr.set_value(attr_PeakWavelength_read)
-		self.attrLock.release()
-		self.debug_stream('lock release')
 
 
 #---- PeakWavelength attribute State Machine -----------------
@@ -737,12 +1038,8 @@ class SPM002_DS(PyTango.Device_4Impl):
 	def read_SpectrumWidth(self, attr):
 		
 		# 	Add your own code here
-		self.debug_stream('lock acquire')
-		self.attrLock.acquire()
-		attr_SpectrumWidth_read = self.spectrumFWHM
+		attr_SpectrumWidth_read = self.snapshot.fwhm
 		attr.set_value(attr_SpectrumWidth_read)
-		self.attrLock.release()
-		self.debug_stream('lock release')
 
 
 #---- SpectrumWidth attribute State Machine -----------------
@@ -765,12 +1062,8 @@ class SPM002_DS(PyTango.Device_4Impl):
 		self.debug_stream(''.join(("In ", self.get_name(), "::read_PeakEnergy()")))
 		
 		# 	Add your own code here
-		self.debug_stream('lock acquire')
-		self.attrLock.acquire()		
-		attr_PeakEnergy_read = self.peakEnergy
+		attr_PeakEnergy_read = self.snapshot.peakEnergy
 		attr.set_value(attr_PeakEnergy_read)
-		self.attrLock.release()
-		self.debug_stream('lock release')
 
 
 #---- PeakEnergy attribute State Machine -----------------
@@ -791,12 +1084,8 @@ class SPM002_DS(PyTango.Device_4Impl):
 #------------------------------------------------------------------
 	def read_Wavelengths(self, attr):
 		# 	Add your own code here
-		self.debug_stream('lock acquire')
-		self.attrLock.acquire()
 		attr_Wavelengths_read = self.wavelengths
-		attr.set_value(attr_Wavelengths_read, self.wavelengths.shape[0])
-		self.attrLock.release()
-		self.debug_stream('lock release')
+		attr.set_value(attr_Wavelengths_read, attr_Wavelengths_read.shape[0])
 
 
 #---- Wavelengths attribute State Machine -----------------
@@ -815,13 +1104,19 @@ class SPM002_DS(PyTango.Device_4Impl):
 	def read_Spectrum(self, attr):
 		self.debug_stream(''.join(("In ", self.get_name(), "::read_Spectrum()")))
 		# 	Add your own code here
-		self.debug_stream('lock acquire')
-		self.attrLock.acquire()
-		attr_Spectrum_read = np.copy(self.spectrumData)
-		self.debug_stream('...read_Spectrum finish')
-		self.attrLock.release()
-		self.debug_stream('lock release')
-		attr.set_value(attr_Spectrum_read, attr_Spectrum_read.shape[0])
+		# Take the snapshot once so the spectrum and its timestamp match
+		snapshot = self.snapshot
+		attr_Spectrum_read = snapshot.spectrum
+		if attr_Spectrum_read is None:
+			# No frame acquired yet
+			attr.set_quality(PyTango.AttrQuality.ATTR_INVALID)
+			attr_Spectrum_read = np.array([0.0])
+			attr.set_value(attr_Spectrum_read, attr_Spectrum_read.shape[0])
+		elif snapshot.timestamp is None:
+			attr.set_value(attr_Spectrum_read, attr_Spectrum_read.shape[0])
+		else:
+			# Stamp the attribute with the acquisition time rather than the read time
+			attr.set_value_date_quality(attr_Spectrum_read, snapshot.timestamp, PyTango.AttrQuality.ATTR_VALID, attr_Spectrum_read.shape[0])
 
 
 #---- Spectrum attribute State Machine -----------------
@@ -834,18 +1129,53 @@ class SPM002_DS(PyTango.Device_4Impl):
 		return True
 
 
+#------------------------------------------------------------------
+# 	Read FrameNumber attribute
+#------------------------------------------------------------------
+	def read_FrameNumber(self, attr):
+		
+		# 	Add your own code here
+		attr_FrameNumber_read = self.snapshot.sequence
+		attr.set_value(attr_FrameNumber_read)
+
+
+#---- FrameNumber attribute State Machine -----------------
+	def is_FrameNumber_allowed(self, req_type):
+		if self.get_state() in [PyTango.DevState.OFF,
+		                        PyTango.DevState.UNKNOWN]:
+			# 	End of Generated Code
+			# 	Re-Start of Generated Code
+			return False
+		return True
+
+
+#------------------------------------------------------------------
+# 	Read AnalysisTime attribute
+#------------------------------------------------------------------
+	def read_AnalysisTime(self, attr):
+		
+		# 	Add your own code here
+		attr.set_value(self.snapshot.analysisTime)
+
+
+#---- AnalysisTime attribute State Machine -----------------
+	def is_AnalysisTime_allowed(self, req_type):
+		if self.get_state() in [PyTango.DevState.OFF,
+		                        PyTango.DevState.UNKNOWN]:
+			# 	End of Generated Code
+			# 	Re-Start of Generated Code
+			return False
+		return True
+
+
 #------------------------------------------------------------------
 # 	Read DeviceList attribute
 #------------------------------------------------------------------
 	def read_DeviceList(self, attr):
 		
 		# 	Add your own code here
-		self.debug_stream('lock acquire')
-		self.attrLock.acquire()
 		attr_DeviceList_read = self.spectrometer.serialList
 		attr.set_value(attr_DeviceList_read, attr_DeviceList_read.__len__())
-		self.attrLock.release()
-		self.debug_stream('lock release')
 
 
 #---- DeviceList attribute State Machine -----------------
@@ -947,6 +1277,30 @@ class SPM002_DSClass(PyTango.DeviceClass):
 			[PyTango.DevLong,
 			"Serial number of the spectrometer",
 			[ 70058308 ] ],
+		'SpikeFilter':
+			[PyTango.DevString,
+			"Spike filter kernel applied before the peak analysis: median, hampel or minmax",
+			[ 'median' ] ],
+		'PeakEstimator':
+			[PyTango.DevString,
+			"Peak position estimator: pixel, parabolic, gaussian or centroid. All but pixel also interpolate the FWHM",
+			[ 'pixel' ] ],
+		'CalibrationDirectory':
+			[PyTango.DevString,
+			"Directory of the wavelength calibration cache, empty for $SPM002_CALIBRATION_DIR or ~/.spm002",
+			[ '' ] ],
+		'StaleTimeout':
+			[PyTango.DevDouble,
+			"Time in s without a new spectrum before the spectrometer is reconnected",
+			[ 5.0 ] ],
+		'AutoExposureTarget':
+			[PyTango.DevDouble,
+			"Level in counts auto exposure keeps the AutoExposurePercentile of the spectrum at",
+			[ 2500.0 ] ],
+		'AutoExposurePercentile':
+			[PyTango.DevDouble,
+			"Percentile of the spectrum pixels used as signal level by auto exposure, 100 for the maximum",
+			[ 99.5 ] ],
 		}
 
 
@@ -990,6 +1344,63 @@ class SPM002_DSClass(PyTango.DeviceClass):
 				'description':"Time in ms between acquisitions",
 				'Memorized':"true_without_hard_applied",
 			} ],
+		'AcquisitionMode':
+			[[PyTango.DevString,
+			PyTango.SCALAR,
+			PyTango.READ_WRITE],
+			{
+				'description':"Frame pacing: fixedrate (one frame every UpdateTime), fastest, fixeddelay (UpdateTime between the end of a frame and the next) or continuous (free running, every frame published)",
+				'Memorized':"true_without_hard_applied",
+			} ],
+		'Average':
+			[[PyTango.DevLong,
+			PyTango.SCALAR,
+			PyTango.READ_WRITE],
+			{
+				'description':"Number of exposures averaged in the spectrometer per spectrum, only one spectrum per average is transferred",
+				'min value':1,
+				'Memorized':"true_without_hard_applied",
+			} ],
+		'DarkSubtraction':
+			[[PyTango.DevBoolean,
+			PyTango.SCALAR,
+			PyTango.READ_WRITE],
+			{
+				'description':"Subtract the dark spectrum stored in the spectrometer",
+				'Memorized':"true_without_hard_applied",
+			} ],
+		'LinearityCorrection':
+			[[PyTango.DevBoolean,
+			PyTango.SCALAR,
+			PyTango.READ_WRITE],
+			{
+				'description':"Correct the counts with the linearity polynomial stored in the spectrometer",
+				'Memorized':"true_without_hard_applied",
+			} ],
+		'SpecialPixelCorrection':
+			[[PyTango.DevBoolean,
+			PyTango.SCALAR,
+			PyTango.READ_WRITE],
+			{
+				'description':"Interpolate over the hot and dead pixels listed in the spectrometer",
+				'Memorized':"true_without_hard_applied",
+			} ],
+		'AchievedRate':
+			[[PyTango.DevDouble,
+			PyTango.SCALAR,
+			PyTango.READ],
+			{
+				'unit':"Hz",
+				'description':"Measured acquisition rate",
+			} ],
+		'RequestedRate':
+			[[PyTango.DevDouble,
+			PyTango.SCALAR,
+			PyTango.READ],
+			{
+				'unit':"Hz",
+				'description':"Acquisition rate requested by UpdateTime and AcquisitionMode, 0 if unpaced",
+			} ],
 		'PeakWavelength':
 			[[PyTango.DevDouble,
 			PyTango.SCALAR,
@@ -1024,6 +1435,21 @@ class SPM002_DSClass(PyTango.DeviceClass):
 			{
 				'description':"Latest spectrum acquired",
 			} ],
+		'FrameNumber':
+			[[PyTango.DevLong64,
+			PyTango.SCALAR,
+			PyTango.READ],
+			{
+				'description':"Sequence number of the latest spectrum",
+			} ],
+		'AnalysisTime':
+			[[PyTango.DevDouble,
+			PyTango.SCALAR,
+			PyTango.READ],
+			{
+				'unit':"ms",
+				'description':"Time spent calculating the peak parameters of the latest spectrum",
+			} ],
 		'DeviceList':
 			[[PyTango.DevLong,
 			PyTango.SPECTRUM,
@@ -0,0 +1,714 @@
+# -*- coding:utf-8 -*-
+"""
+Created on Oct 17, 2026
+
+Spectrum analysis stages shared by the SPM002 device servers.
+"""
+import itertools
+import numpy as np
+
+
+# Median networks already built, keyed by (width, presorted)
+_networks = {}
+
+
+def _groups(width, presorted):
+    """Returns the index groups of width inputs that arrive presorted when
+    the inputs are consecutive runs of presorted values.
+    """
+    groups = []
+    if presorted > 1:
+        for start in range(0, width, presorted):
+            group = tuple(range(start, min(start + presorted, width)))
+            if len(group) > 1:
+                groups.append(group)
+    return groups
+
+
+def _selectsMedian(network, width, groups):
+    """Checks that network moves the median of width inputs to position
+    width // 2 for every input whose groups are sorted. By the 0-1
+    principle it is enough to try all inputs of zeros and ones.
+    """
+    mid = width // 2
+    for bits in itertools.product((0, 1), repeat=width):
+        if any(bits[g[k]] > bits[g[k + 1]] for g in groups for k in range(len(g) - 1)):
+            continue
+        x = list(bits)
+        for i, j in network:
+            if x[i] > x[j]:
+                x[i], x[j] = x[j], x[i]
+        if x[mid] != sorted(bits)[mid]:
+            return False
+    return True
+
+
+def _medianNetwork(width, presorted=1):
+    """Returns the compare-exchange steps (i, j, keepMin, keepMax) that move
+    the median of width values to position width // 2. keepMin/keepMax tell
+    if the minimum/maximum of the step is used later.
+
+    Inputs in runs of presorted values (see _groups) are assumed to be
+    sorted already. The network starts from a selection sort, drops the
+    exchanges that cannot influence the middle position and then, for
+    small widths, every exchange the presorted runs make redundant.
+    """
+    key = (width, presorted)
+    if key in _networks:
+        return _networks[key]
+    network = [(i, j) for i in range(width) for j in range(i + 1, width)]
+    needed = set([width // 2])
+    pruned = []
+    for i, j in reversed(network):
+        if i in needed or j in needed:
+            pruned.append((i, j))
+            needed.add(i)
+            needed.add(j)
+    pruned.reverse()
+    groups = _groups(width, presorted)
+    if len(groups) > 0 and width <= 11:
+        # Exhaustive check, 2**width inputs per try
+        k = 0
+        while k < len(pruned):
+            candidate = pruned[:k] + pruned[k + 1:]
+            if _selectsMedian(candidate, width, groups):
+                pruned = candidate
+            else:
+                k += 1
+    # Mark which outputs of each exchange are read later on, the others
+    # need not be computed
+    live = set([width // 2])
+    schedule = []
+    for i, j in reversed(pruned):
+        schedule.append((i, j, i in live, j in live))
+        live.add(i)
+        live.add(j)
+    schedule.reverse()
+    _networks[key] = schedule
+    return schedule
+
+
+class SpikeFilter(object):
+    """Removes single pixel spikes from a spectrum before peak analysis.
+
+    Kernels:
+        median: running median over width pixels.
+        hampel: pixels further than nSigma scaled MADs from the running
+                median are replaced by the median, the others are kept.
+                Preserves the peak shape better than the plain median.
+        minmax: morphological opening (running min followed by running
+                max). Removes positive spikes narrower than width and is
+                the cheapest of the three.
+
+    The running statistics are computed with a fixed network of elementwise
+    minimum/maximum operations into preallocated work buffers, so filtering
+    a frame allocates nothing and needs no stacked copies of the spectrum.
+    For the running median every run of three neighbouring pixels is
+    sorted once per frame and shared by all the windows containing it,
+    which leaves 12 minimum/maximum operations per window for width 7
+    instead of 36. The hampel test needs no second network for the MAD,
+    it counts the window pixels close to the median instead, see
+    _outliers.
+
+    filter() returns a float64 array of the same shape as the input that
+    stays owned by the filter and is overwritten by the next call. Pixels
+    closer than width // 2 to the ends take the nearest filtered value.
+    Blocks of spectra (N x numPixels) are filtered row by row in one call.
+    """
+    MEDIAN = 'median'
+    HAMPEL = 'hampel'
+    MINMAX = 'minmax'
+    KERNELS = (MEDIAN, HAMPEL, MINMAX)
+
+    def __init__(self, kernel=MEDIAN, width=7, numPixels=3648, nSigma=3.0):
+        if width < 3 or width % 2 == 0:
+            raise ValueError(''.join(('Spike filter width must be odd and >= 3, got ', str(width))))
+        self.kernel = None
+        self.width = width
+        self.nSigma = nSigma
+        self.presortedNetwork = _medianNetwork(width, 3)
+        self.shape = None
+        self.setKernel(kernel)
+        self._allocate((numPixels,))
+
+    def setKernel(self, kernel):
+        if kernel not in self.KERNELS:
+            raise ValueError(''.join(('Unknown spike filter kernel ', str(kernel), ', use one of ', ', '.join(self.KERNELS))))
+        self.kernel = kernel
+
+    def _allocate(self, shape):
+        """(Re)allocates the work buffers for spectra of the given shape."""
+        self.shape = shape
+        batch = shape[:-1]
+        n = shape[-1]
+        length = max(n - self.width + 1, 1)
+        self.x = np.zeros(shape)
+        # Sorted pairs and triples of neighbouring pixels
+        self.pairs = [np.zeros(batch + (max(n - 1, 1),)) for k in range(2)]
+        self.triples = [np.zeros(batch + (max(n - 2, 1),)) for k in range(3)]
+        self.pool = [np.zeros(batch + (length,)) for k in range(self.width + 2)]
+        self.lo = np.zeros(batch + (length,))
+        self.hi = np.zeros(batch + (length,))
+        self.count = np.zeros(batch + (length,), dtype=np.int16)
+        self.mask = np.zeros(batch + (length,), dtype=np.bool_)
+        self.inside = np.zeros(batch + (length,), dtype=np.bool_)
+        self.padded = np.zeros(batch + (n + self.width - 1,))
+        self.out = np.zeros(shape)
+
+    def filter(self, sp):
+        """Returns the filtered spectrum sp, see the class docstring. sp may
+        also be a block of spectra, the filter runs along the last axis.
+        """
+        if sp.shape != self.shape:
+            self._allocate(sp.shape)
+        n = sp.shape[-1]
+        if n < self.width:
+            self.out[...] = sp
+            return self.out
+        if self.kernel == self.MINMAX:
+            self._opening(sp)
+            return self.out
+
+        h = self.width // 2
+        length = n - self.width + 1
+        x = self.x
+        np.copyto(x, sp, casting='unsafe')
+        med = self._runningMedian()
+        center = self.out[..., h:h + length]
+        if self.kernel == self.HAMPEL:
+            self._outliers(med)
+            center[...] = x[..., h:h + length]
+            np.copyto(center, med, where=self.mask)
+        else:
+            center[...] = med
+        self.out[..., :h] = self.out[..., h:h + 1]
+        self.out[..., h + length:] = self.out[..., h + length - 1:h + length]
+        return self.out
+
+    def _outliers(self, med):
+        """Sets self.mask where the centre pixel of a window lies further
+        than nSigma scaled MADs from the window median med.
+
+        The MAD is never computed. |x - med| > scale * MAD holds exactly
+        when more than half of the window lies strictly within
+        |x - med| / scale of med, so one pass per window position with an
+        elementwise compare and a count is enough.
+        """
+        x = self.x
+        h = self.width // 2
+        length = med.shape[-1]
+        # 1.4826 scales the MAD to the standard deviation of gaussian noise
+        scale = 1.4826 * self.nSigma
+        lo = self.lo
+        hi = self.hi
+        np.subtract(x[..., h:h + length], med, out=hi)
+        np.abs(hi, out=hi)
+        np.multiply(hi, 1.0 / scale, out=hi)
+        np.subtract(med, hi, out=lo)
+        np.add(med, hi, out=hi)
+        self.count.fill(0)
+        for k in range(self.width):
+            if k == h and scale >= 1.0:
+                # The centre pixel itself is never inside
+                continue
+            xk = x[..., k:k + length]
+            np.greater(xk, lo, out=self.mask)
+            np.less(xk, hi, out=self.inside)
+            np.logical_and(self.mask, self.inside, out=self.mask)
+            np.add(self.count, self.mask, out=self.count)
+        np.greater(self.count, h, out=self.mask)
+
+    def _runningMedian(self):
+        """Returns a pool buffer holding the running median of self.x."""
+        x = self.x
+        n = x.shape[-1]
+        lo, hi = self.pairs
+        t0, t1, t2 = self.triples
+        np.minimum(x[..., :-1], x[..., 1:], out=lo)
+        np.maximum(x[..., :-1], x[..., 1:], out=hi)
+        # Insert the third pixel into each sorted pair
+        np.minimum(hi[..., :-1], x[..., 2:], out=t1)
+        np.maximum(hi[..., :-1], x[..., 2:], out=t2)
+        np.minimum(lo[..., :-1], t1, out=t0)
+        np.maximum(lo[..., :-1], t1, out=t1)
+        # The window starting at pixel i is made of the runs starting at
+        # i, i + 3, ... which are all views into the shared sorted runs
+        length = n - self.width + 1
+        rows = []
+        for start in range(0, self.width, 3):
+            size = min(3, self.width - start)
+            if size == 3:
+                runs = self.triples
+            elif size == 2:
+                runs = self.pairs
+            else:
+                runs = [x]
+            for r in runs:
+                rows.append(r[..., start:start + length])
+        return self._exchange(rows, [False] * self.width, list(self.pool), self.presortedNetwork)
+
+    def _exchange(self, rows, owned, pool, network):
+        """Runs the compare-exchange network over rows and returns the row
+        holding the elementwise median. Results go to buffers taken from
+        pool, rows that are not owned (views of shared data) are never
+        written to.
+        """
+        for i, j, keepMin, keepMax in network:
+            lo = None
+            hi = None
+            if keepMin == True:
+                lo = pool.pop()
+                np.minimum(rows[i], rows[j], out=lo)
+            if keepMax == True:
+                hi = pool.pop()
+                np.maximum(rows[i], rows[j], out=hi)
+            for k in (i, j):
+                if owned[k]:
+                    pool.append(rows[k])
+            rows[i] = lo
+            rows[j] = hi
+            owned[i] = lo is not None
+            owned[j] = hi is not None
+        return rows[self.width // 2]
+
+    def _opening(self, sp):
+        w = self.width
+        n = sp.shape[-1]
+        length = n - w + 1
+        # Erosion: minimum over each window of w pixels
+        eroded = self.padded[..., w - 1:w - 1 + length]
+        np.copyto(eroded, sp[..., 0:length], casting='unsafe')
+        for k in range(1, w):
+            np.minimum(eroded, sp[..., k:k + length], out=eroded)
+        # Dilation: every pixel takes the maximum of the eroded windows
+        # covering it. The padding keeps the output the input length.
+        self.padded[..., :w - 1] = -np.inf
+        self.padded[..., w - 1 + length:] = -np.inf
+        np.copyto(self.out, self.padded[..., 0:n])
+        for k in range(1, w):
+            np.maximum(self.out, self.padded[..., k:k + n], out=self.out)
+
+
+# Peak position estimators
+PIXEL = 'pixel'
+PARABOLIC = 'parabolic'
+GAUSSIAN = 'gaussian'
+CENTROID = 'centroid'
+ESTIMATORS = (PIXEL, PARABOLIC, GAUSSIAN, CENTROID)
+
+
+def peakPosition(m, peakInd, estimator=PARABOLIC, noiseFloor=None, halfWidth=3):
+    """Returns the peak positions in fractional pixels.
+
+    Input:
+        m: spectrum, or N x numPixels block of them. The median and minmax
+           spike filters flatten the top of the peak, so pass the raw or
+           hampel filtered spectrum here.
+        peakInd: approximate index of the maximum pixel, one per row, for
+                 example the maximum of the median filtered spectrum. The
+                 maximum is searched again within halfWidth pixels.
+        estimator:
+            pixel: the maximum pixel itself
+            parabolic: vertex of the parabola through the maximum pixel
+                       and its neighbours
+            gaussian: the same fit on the logarithm of the baseline
+                      subtracted signal, exact for gaussian peaks
+            centroid: mean position of the pixels between the half
+                      maximum crossings around the maximum, weighted by
+                      their height above the half maximum
+        noiseFloor: baseline subtracted before the gaussian estimate and
+                    the half maximum of the centroid, one per row
+    """
+    if estimator not in ESTIMATORS:
+        raise ValueError(''.join(('Unknown peak estimator ', str(estimator), ', use one of ', ', '.join(ESTIMATORS))))
+    m = np.atleast_2d(m)
+    peakInd = np.atleast_1d(peakInd)
+    numRows, n = m.shape
+    rows = np.arange(numRows)
+    if noiseFloor is None:
+        noiseFloor = np.zeros(numRows)
+    noiseFloor = np.atleast_1d(noiseFloor)
+    if estimator == PIXEL:
+        return peakInd.astype(np.float64)
+
+    ind = np.clip(peakInd[:, np.newaxis] + np.arange(-halfWidth, halfWidth + 1), 0, n - 1)
+    peakInd = ind[rows, m[rows[:, np.newaxis], ind].argmax(axis=1)]
+    if estimator == CENTROID:
+        # Only the part of the peak above its half maximum is weighted. The
+        # weights fall to zero at the crossings, so the result moves
+        # smoothly with the peak, and a constant offset of the local
+        # baseline from noiseFloor cancels out.
+        halfMax = (m[rows, peakInd] + noiseFloor) / 2
+        left, right = halfMaxCrossings(m, peakInd, halfMax, False)
+        left[np.isnan(left)] = -1
+        right[np.isnan(right)] = n
+        pixels = np.arange(n)
+        inside = (pixels > left[:, np.newaxis]) & (pixels <= right[:, np.newaxis])
+        weights = np.where(inside, m - halfMax[:, np.newaxis], 0)
+        total = weights.sum(axis=1)
+        position = peakInd.astype(np.float64)
+        ok = total > 0
+        position[ok] = np.dot(weights[ok], pixels) / total[ok]
+        return position
+
+    ind = np.clip(peakInd, 1, n - 2)
+    y0 = m[rows, ind - 1].astype(np.float64)
+    y1 = m[rows, ind].astype(np.float64)
+    y2 = m[rows, ind + 1].astype(np.float64)
+    if estimator == GAUSSIAN:
+        # Keep the logarithm finite where the signal is at the baseline
+        y0 = np.log(np.maximum(y0 - noiseFloor, 1e-3))
+        y1 = np.log(np.maximum(y1 - noiseFloor, 1e-3))
+        y2 = np.log(np.maximum(y2 - noiseFloor, 1e-3))
+    curvature = y0 - 2 * y1 + y2
+    # Only a downward opening parabola has a maximum
+    ok = curvature < 0
+    delta = np.zeros(numRows)
+    delta[ok] = 0.5 * (y0[ok] - y2[ok]) / curvature[ok]
+    return ind + np.clip(delta, -0.5, 0.5)
+
+
+def halfMaxCrossings(m, peakInd, halfMax, interpolate=True):
+    """Returns (left, right), the positions in pixels where m crosses
+    halfMax closest to the peak on either side, nan where there is no
+    crossing. With interpolate the positions are found by linear
+    interpolation between the pixels, otherwise the pixel before each
+    crossing is returned.
+    """
+    m = np.atleast_2d(m)
+    peakInd = np.atleast_1d(peakInd)
+    halfMax = np.atleast_1d(halfMax)
+    numRows, n = m.shape
+    rows = np.arange(numRows)
+    pixels = np.arange(n - 1)
+    # Pixel j is a crossing if m is on different sides of the half max at j and j + 1
+    above = m > halfMax[:, np.newaxis]
+    crossing = above[:, 1:] != above[:, :-1]
+    beforePeak = pixels < peakInd[:, np.newaxis]
+    left = np.where(crossing & beforePeak, pixels, -1).max(axis=1)
+    right = np.where(crossing & ~beforePeak, pixels, n).min(axis=1)
+    positions = []
+    for j, valid in ((left, left >= 0), (right, right < n - 1)):
+        j = np.clip(j, 0, n - 2)
+        position = j.astype(np.float64)
+        if interpolate == True:
+            ya = m[rows, j].astype(np.float64)
+            yb = m[rows, j + 1].astype(np.float64)
+            step = yb - ya
+            step[step == 0] = 1.0
+            position += np.clip((halfMax - ya) / step, 0.0, 1.0)
+        position[~valid] = np.nan
+        positions.append(position)
+    return positions[0], positions[1]
+
+
+def pixelToWavelength(position, wavelengths):
+    """Returns the wavelengths at fractional pixel positions (linear
+    interpolation on the wavelength axis, nan stays nan).
+    """
+    return np.interp(position, np.arange(wavelengths.shape[0]), wavelengths)
+
+
+def refinePeak(sp, m, peakInd, noiseFloor, wavelengths, estimator=PARABOLIC, kernel=SpikeFilter.MEDIAN):
+    """Returns (center, fwhm) with sub-pixel resolution, one value per row.
+
+    sp is the raw spectrum (or block), m the output of a SpikeFilter with
+    the given kernel and peakInd the maximum of m. The peak position is
+    estimated with estimator (see peakPosition) and the half max crossings
+    of m are interpolated between pixels.
+    """
+    m = np.atleast_2d(m)
+    peakInd = np.atleast_1d(peakInd)
+    noiseFloor = np.atleast_1d(noiseFloor)
+    # Sub-pixel estimates need the true peak shape, which only the hampel
+    # filter keeps
+    if kernel == SpikeFilter.HAMPEL:
+        peakSignal = m
+    else:
+        peakSignal = sp
+    center = pixelToWavelength(peakPosition(peakSignal, peakInd, estimator, noiseFloor), wavelengths)
+    halfMax = (m[np.arange(m.shape[0]), peakInd] + noiseFloor) / 2
+    left, right = halfMaxCrossings(m, peakInd, halfMax)
+    fwhm = np.abs(pixelToWavelength(right, wavelengths) - pixelToWavelength(left, wavelengths))
+    return center, fwhm
+
+
+def findPeaks(sp, m, wavelengths, expTime, minProminence=100.0, minWidth=3.0, maxPeaks=8,
+              estimator=PIXEL, kernel=SpikeFilter.MEDIAN):
+    """Finds the peaks of one spectrum and calculates their parameters.
+
+    Input:
+        sp: raw spectrum
+        m: sp filtered by a SpikeFilter with the given kernel
+        wavelengths: wavelength axis of sp
+        expTime: exposure time in ms, for the peak energies
+        minProminence: minimum height in counts of a peak above the higher
+                       of the two minima separating it from higher ground
+                       on either side
+        minWidth: minimum width in pixels at half prominence
+        maxPeaks: at most this many peaks are returned, the most prominent
+        estimator: peak position estimator, see peakPosition
+
+    Output:
+        (centers, widths, energies, prominences), arrays with one value
+        per peak sorted by wavelength. widths are the full widths at half
+        prominence in nm, energies are integrated between the minima on
+        either side of each peak.
+    """
+    n = m.shape[0]
+    # Local maxima, a flat top counts once at its left edge
+    candidates = np.nonzero((m[1:-1] > m[:-2]) & (m[1:-1] >= m[2:]))[0] + 1
+    # A peak cannot be more prominent than its height above the lowest pixel
+    candidates = candidates[m[candidates] - m.min() >= minProminence]
+    # Bound the work on noisy frames, the highest candidates are kept
+    if candidates.shape[0] > 4 * maxPeaks:
+        candidates = np.sort(candidates[np.argsort(m[candidates])[-4 * maxPeaks:]])
+
+    peaks = []
+    for i in candidates:
+        level = m[i]
+        higher = np.nonzero(m[:i] > level)[0]
+        leftLimit = higher[-1] if higher.shape[0] > 0 else 0
+        higher = np.nonzero(m[i + 1:] > level)[0]
+        rightLimit = i + 1 + higher[0] if higher.shape[0] > 0 else n - 1
+        leftBase = leftLimit + m[leftLimit:i + 1].argmin()
+        rightBase = i + m[i:rightLimit + 1].argmin()
+        prominence = level - max(m[leftBase], m[rightBase])
+        if prominence < minProminence:
+            continue
+        # Width at half prominence, interpolated between pixels
+        half = level - prominence / 2.0
+        k = leftBase + np.nonzero(m[leftBase:i + 1] <= half)[0][-1]
+        left = k + (half - m[k]) / (m[k + 1] - m[k])
+        k = i + np.nonzero(m[i:rightBase + 1] <= half)[0][0]
+        right = k - (half - m[k]) / (m[k - 1] - m[k])
+        if right - left < minWidth:
+            continue
+        peaks.append((prominence, i, left, right, leftBase, rightBase))
+
+    peaks = sorted(peaks, reverse=True)[0:maxPeaks]
+    peaks.sort(key=lambda peak: peak[1])
+    if len(peaks) == 0:
+        empty = np.zeros(0)
+        return empty, empty, empty, empty
+    prominences, peakInd, left, right, leftBase, rightBase = [np.array(v) for v in zip(*peaks)]
+
+    if estimator == PIXEL:
+        centers = wavelengths[peakInd]
+    else:
+        if kernel == SpikeFilter.HAMPEL:
+            peakSignal = m
+        else:
+            peakSignal = sp
+        # One row per peak, all views of the same spectrum
+        rows = np.broadcast_to(peakSignal, (peakInd.shape[0], n))
+        centers = pixelToWavelength(peakPosition(rows, peakInd, estimator, np.minimum(m[leftBase], m[rightBase])),
+                                    wavelengths)
+    widths = np.abs(pixelToWavelength(right, wavelengths) - pixelToWavelength(left, wavelengths))
+    # Trapezoidal integrals over the samples leftBase..rightBase from one cumulative sum
+    cumulative = np.zeros(n)
+    np.cumsum(0.5 * (sp[1:] + sp[:-1].astype(np.float64)) * np.diff(wavelengths), out=cumulative[1:])
+    energies = 1560 * 1e-6 * (cumulative[rightBase] - cumulative[leftBase]) / expTime
+    return centers, widths, energies, prominences
+
+
+def roiIndices(wavelengths, limits):
+    """Maps wavelength regions of interest to pixel ranges.
+
+    limits is a K x 2 array of [lambda_min, lambda_max] (either order).
+    Returns (start, stop) index arrays such that the pixels start:stop of
+    each ROI have wavelengths inside its limits. wavelengths must be
+    monotonic, either increasing or decreasing, so a binary search is
+    enough.
+    """
+    limits = np.sort(np.atleast_2d(np.asarray(limits, dtype=np.float64)), axis=1)
+    n = wavelengths.shape[0]
+    if wavelengths[0] <= wavelengths[-1]:
+        start = np.searchsorted(wavelengths, limits[:, 0], 'left')
+        stop = np.searchsorted(wavelengths, limits[:, 1], 'right')
+    else:
+        reverse = wavelengths[::-1]
+        start = n - np.searchsorted(reverse, limits[:, 1], 'right')
+        stop = n - np.searchsorted(reverse, limits[:, 0], 'left')
+    return start, stop
+
+
+def roiStatistics(sp, wavelengths, start, stop, expTime):
+    """Calculates statistics of many ROIs of one spectrum at once.
+
+    start and stop come from roiIndices. Returns (energy, mean, maximum),
+    arrays with one value per ROI. energy is the trapezoidal integral over
+    wavelength scaled like the peak energy. The sums all come from one
+    cumulative sum and the maxima from one np.maximum.reduceat, so the
+    cost barely grows with the number of ROIs. Empty ROIs give nan.
+    """
+    n = sp.shape[0]
+    start = np.clip(start, 0, n)
+    stop = np.clip(stop, start, n)
+    empty = stop <= start
+    cumulative = np.zeros(n + 1)
+    np.cumsum(sp, out=cumulative[1:])
+    count = np.maximum(stop - start, 1)
+    mean = (cumulative[stop] - cumulative[start]) / count
+    # Trapezoidal integral over the samples start..stop-1
+    np.cumsum(0.5 * (sp[1:] + sp[:-1].astype(np.float64)) * np.diff(wavelengths), out=cumulative[1:n])
+    last = np.maximum(stop - 1, start)
+    energy = 1560 * 1e-6 * (cumulative[np.minimum(last, n - 1)] - cumulative[np.minimum(start, n - 1)]) / expTime
+    # reduceat over [start0, stop0, start1, stop1, ...], the even outputs are
+    # the ROI maxima. The appended pixel keeps every index valid.
+    padded = np.concatenate((sp, sp[-1:])).astype(np.float64)
+    bounds = np.column_stack((np.minimum(start, n - 1), np.maximum(stop, np.minimum(start, n - 1) + 1))).ravel()
+    maximum = np.maximum.reduceat(padded, bounds)[0::2]
+    energy[empty] = np.nan
+    mean[empty] = np.nan
+    maximum[empty] = np.nan
+    return energy, mean, maximum
+
+
+def analyzeSpectra(spectra, wavelengths, expTime, spikeFilter=None, chunkSize=64, estimator=PIXEL):
+    """Calculates the peak parameters of every spectrum in a block.
+
+    Input:
+        spectra: N x numPixels array, one spectrum per row
+        wavelengths: numPixels wavelength axis shared by all rows
+        expTime: exposure time in ms, scalar or one per row
+        spikeFilter: SpikeFilter to use, a width 7 median filter by default
+        chunkSize: number of rows processed at once, bounds the memory used
+                   for temporaries
+        estimator: peak position estimator, see peakPosition. With any
+                   estimator but pixel the half max crossings are also
+                   interpolated between pixels.
+
+    Output:
+        (center, fwhm, energy, noiseFloor), arrays of N values. fwhm is nan
+        for rows where the half maximum is not crossed on both sides of
+        the peak.
+
+    Uses the same method as calculateSpectrumParameters in the device
+    servers, but every step is vectorized along the rows.
+    """
+    if estimator not in ESTIMATORS:
+        raise ValueError(''.join(('Unknown peak estimator ', str(estimator), ', use one of ', ', '.join(ESTIMATORS))))
+    spectra = np.atleast_2d(spectra)
+    numSpectra = spectra.shape[0]
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    expTime = np.asarray(expTime, dtype=np.float64)
+    if spikeFilter is None:
+        spikeFilter = SpikeFilter(SpikeFilter.MEDIAN)
+    center = np.zeros(numSpectra)
+    fwhm = np.zeros(numSpectra)
+    energy = np.zeros(numSpectra)
+    noiseFloor = np.zeros(numSpectra)
+    dx = np.diff(wavelengths)
+    for first in range(0, numSpectra, chunkSize):
+        last = min(first + chunkSize, numSpectra)
+        if expTime.ndim == 0:
+            chunkExpTime = expTime
+        else:
+            chunkExpTime = expTime[first:last]
+        sp = spectra[first:last]
+        result = _analyzeBlock(sp, spikeFilter.filter(sp), wavelengths, dx, chunkExpTime,
+                               estimator, spikeFilter.kernel)
+        center[first:last], fwhm[first:last], energy[first:last], noiseFloor[first:last] = result
+    return center, fwhm, energy, noiseFloor
+
+
+def _analyzeBlock(sp, m, wavelengths, dx, expTime, estimator, kernel):
+    """analyzeSpectra for one block of raw spectra sp and spike filtered
+    spectra m.
+    """
+    numRows, n = sp.shape
+    rows = np.arange(numRows)
+
+    noiseFloor = m[:, 0:10].mean(axis=1)
+    peakInd = m.argmax(axis=1)
+    if estimator == PIXEL:
+        center = wavelengths[peakInd]
+        halfMax = (m[rows, peakInd] + noiseFloor) / 2
+        left, right = halfMaxCrossings(m, peakInd, halfMax, False)
+        fwhm = np.abs(pixelToWavelength(right, wavelengths) - pixelToWavelength(left, wavelengths))
+    else:
+        center, fwhm = refinePeak(sp, m, peakInd, noiseFloor, wavelengths, estimator, kernel)
+
+    # The peak extends between the closest pixels below 1.2 * noiseFloor on
+    # either side. Integrate the raw spectrum there with the trapezoidal
+    # rule, using a cumulative sum so all rows are done at once.
+    low = sp < 1.2 * noiseFloor[:, np.newaxis]
+    allPixels = np.arange(n)
+    start = np.where(low & (allPixels < peakInd[:, np.newaxis]), allPixels, 0).max(axis=1)
+    stop = np.where(low & (allPixels > peakInd[:, np.newaxis]), allPixels, n - 1).min(axis=1)
+    segments = 0.5 * (sp[:, 1:] + sp[:, :-1].astype(np.float64)) * dx
+    cumulative = np.zeros((numRows, n))
+    np.cumsum(segments, axis=1, out=cumulative[:, 1:])
+    # trapz over the samples start..stop-1, like sp[start:stop] in the device servers
+    integral = cumulative[rows, np.maximum(stop - 1, start)] - cumulative[rows, start]
+    energy = 1560 * 1e-6 * integral / expTime
+    return center, fwhm, energy, noiseFloor
+
+
+if __name__ == '__main__':
+    # Benchmark against the np.vstack/np.median filter the device servers used
+    import timeit
+    rng = np.random.RandomState(0)
+    x = np.arange(3648)
+    sp = (200 + 3000 * np.exp(-((x - 1800) / 40.0) ** 2) + rng.normal(0, 20, 3648)).astype(np.uint16)
+    sp[rng.randint(0, 3648, 30)] = 4095
+
+    def vstackMedian():
+        return np.median(np.vstack((sp[6:], sp[5:-1], sp[4:-2], sp[3:-3], sp[2:-4], sp[1:-5], sp[0:-6])), axis=0)
+
+    reference = vstackMedian()
+    number = 2000
+    t = timeit.timeit(vstackMedian, number=number) / number
+    print 'vstack median: %8.1f us/frame' % (t * 1e6)
+    for kernel in SpikeFilter.KERNELS:
+        f = SpikeFilter(kernel)
+        m = f.filter(sp)
+        t = timeit.timeit(lambda: f.filter(sp), number=number) / number
+        if kernel == SpikeFilter.MEDIAN:
+            assert np.array_equal(m[3:-3], reference)
+        print '%-13s: %8.1f us/frame, max %6.1f at pixel %d' % (kernel, t * 1e6, m.max(), m.argmax())
+
+    # Batched analysis of a block of frames with moving peaks
+    numFrames = 10000
+    wavelengths = np.linspace(600.0, 1000.0, 3648)
+    shifts = rng.randint(-500, 500, numFrames)
+    block = np.empty((numFrames, 3648), dtype=np.uint16)
+    for k in range(numFrames):
+        block[k] = np.roll(sp, shifts[k])
+    t0 = timeit.default_timer()
+    center, fwhm, energy, noiseFloor = analyzeSpectra(block, wavelengths, 100.0)
+    t = timeit.default_timer() - t0
+    assert np.array_equal(center, wavelengths[(1800 + shifts) % 3648])
+    print 'analyzeSpectra: %8.1f us/frame, %d frames in %.2f s' % (t / numFrames * 1e6, numFrames, t)
+
+    # Per frame cost and stability of the peak estimators on a peak moving
+    # in 0.05 pixel steps
+    f = SpikeFilter()
+    steps = np.arange(0, 1, 0.05)
+    for estimator in ESTIMATORS:
+        errors = []
+        for shift in steps:
+            frame = 200 + 3000 * np.exp(-((x - 1800 - shift) / 40.0) ** 2)
+            peakInd = f.filter(frame).argmax()
+            errors.append(peakPosition(frame, peakInd, estimator, 200.0)[0] - (1800 + shift))
+        m = f.filter(sp)
+        peakInd = m.argmax()
+        noise = m[0:10].mean()
+        t = timeit.timeit(lambda: (peakPosition(sp, peakInd, estimator, noise),
+                                   halfMaxCrossings(m, peakInd, (m[peakInd] + noise) / 2, estimator != PIXEL)),
+                          number=number) / number
+        print '%-13s: %8.1f us/frame, max position error %.3f pixels' % (estimator, t * 1e6, np.abs(errors).max())
+
+    # Multi peak detection on three lines with spikes
+    multi = 200 + rng.normal(0, 20, 3648)
+    for position, height, width in ((900, 3000, 15), (1800, 1500, 30), (2500, 800, 10)):
+        multi += height * np.exp(-((x - position) / float(width)) ** 2)
+    multi = multi.astype(np.uint16)
+    multi[rng.randint(0, 3648, 30)] = 4095
+    f = SpikeFilter()
+    m = f.filter(multi)
+    centers, widths, energies, prominences = findPeaks(multi, m, x.astype(np.float64), 100.0, 200.0, 3.0, 8, PARABOLIC)
+    t = timeit.timeit(lambda: findPeaks(multi, m, x.astype(np.float64), 100.0, 200.0, 3.0, 8, PARABOLIC),
+                      number=number) / number
+    print 'findPeaks    : %8.1f us/frame, peaks at %s' % (t * 1e6, ', '.join(['%.1f' % c for c in centers]))
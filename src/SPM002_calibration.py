@@ -0,0 +1,148 @@
+# -*- coding:utf-8 -*-
+"""
+Created on Oct 17, 2026
+
+Persistent wavelength calibration cache for SPM002 spectrometers.
+"""
+import json
+import os
+import zlib
+import numpy as np
+
+
+# Namespace of the entries stored by clients without the LUT
+CLIENT_NAMESPACE = 'spm002client'
+
+
+def defaultDirectory():
+    """Returns the cache directory, $SPM002_CALIBRATION_DIR or ~/.spm002"""
+    directory = os.environ.get('SPM002_CALIBRATION_DIR')
+    if directory is None or directory == '':
+        directory = os.path.join(os.path.expanduser('~'), '.spm002')
+    return directory
+
+
+class CalibrationCache(object):
+    """Stores the LUT and wavelength axis of each spectrometer on disk.
+
+    Every serial has two files in the cache directory:
+        <namespace>_<serial>.json: serial, firmware version, LUT coefficients
+                and the CRC32 of the wavelength axis
+        <namespace>_<serial>.npy: float64 wavelength axis, loaded memory mapped
+
+    The device servers talking to the hardware use the default namespace.
+    Clients that only get the wavelength axis from the master store entries
+    without a LUT, they use their own namespace (CLIENT_NAMESPACE) so they
+    never replace a complete entry in a shared directory.
+
+    An entry is only used when the firmware version it was made with
+    matches the connected device, so a reflashed spectrometer gets a fresh
+    table, and when the axis matches the CRC in the JSON file. The two
+    files are replaced one after the other, so after a crash in between
+    the pair does not match and the entry is made again. Failing to write
+    the cache is not an error, the next init simply reads the hardware
+    again.
+    """
+    def __init__(self, directory=None, namespace='spm002'):
+        if directory is None or directory == '':
+            directory = defaultDirectory()
+        self.directory = directory
+        self.namespace = namespace
+
+    def _paths(self, serial):
+        base = os.path.join(self.directory, ''.join((self.namespace, '_', str(serial))))
+        return ''.join((base, '.json')), ''.join((base, '.npy'))
+
+    def load(self, serial, firmware=None):
+        """Returns (LUT, wavelengths) of serial, or None if there is no
+        valid entry. With firmware None the firmware version is not checked.
+        wavelengths is a read-only memory mapped array, LUT is None if the
+        entry was stored without one.
+        """
+        infoPath, axisPath = self._paths(serial)
+        try:
+            with open(infoPath, 'r') as f:
+                info = json.load(f)
+            if info['serial'] != serial:
+                return None
+            if firmware is not None and info['firmware'] != firmware:
+                return None
+            wavelengths = np.load(axisPath, mmap_mode='r')
+            if wavelengths.ndim != 1 or wavelengths.shape[0] != info['numPixels']:
+                return None
+            if axisChecksum(wavelengths) != info['axisCrc']:
+                return None
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        LUT = info.get('lut')
+        if LUT is not None:
+            LUT = np.array(LUT, dtype=np.float32)
+        return LUT, wavelengths
+
+    def firmware(self, serial):
+        """Returns the firmware version stored for serial, None if unknown."""
+        infoPath, axisPath = self._paths(serial)
+        try:
+            with open(infoPath, 'r') as f:
+                return json.load(f)['firmware']
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def store(self, serial, firmware, LUT, wavelengths):
+        """Writes the entry of serial. Returns False if it could not be
+        written. Each file is replaced atomically, a load between the two
+        replacements finds the CRC mismatch and returns None.
+        """
+        infoPath, axisPath = self._paths(serial)
+        lut = None
+        if LUT is not None:
+            lut = [float(c) for c in LUT]
+        wavelengths = np.asarray(wavelengths, dtype=np.float64)
+        info = {'serial': serial, 'firmware': firmware, 'lut': lut,
+                'numPixels': int(wavelengths.shape[0]),
+                'axisCrc': axisChecksum(wavelengths)}
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            tmpAxisPath = ''.join((axisPath, '.tmp.npy'))
+            np.save(tmpAxisPath, wavelengths)
+            self._replace(tmpAxisPath, axisPath)
+            tmpInfoPath = ''.join((infoPath, '.tmp'))
+            with open(tmpInfoPath, 'w') as f:
+                json.dump(info, f)
+            self._replace(tmpInfoPath, infoPath)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def _replace(self, src, dst):
+        try:
+            os.rename(src, dst)
+        except OSError:
+            # Windows does not rename over an existing file
+            os.remove(dst)
+            os.rename(src, dst)
+
+
+def axisChecksum(wavelengths):
+    """Returns the CRC32 of the float64 wavelength axis as stored."""
+    data = np.ascontiguousarray(wavelengths, dtype=np.float64)
+    return zlib.crc32(data.view(np.uint8)) & 0xffffffff
+
+
+def loadCalibration(spectrometer, serial, cache):
+    """Sets spectrometer.LUT and spectrometer.wavelengths of the open
+    device, from cache if it holds a valid entry for serial, otherwise
+    from the hardware, storing the result in cache.
+
+    Returns True if the cache was used.
+    """
+    firmware = spectrometer.getFirmwareVersion()
+    entry = cache.load(serial, firmware)
+    if entry is not None and entry[0] is not None:
+        spectrometer.LUT, spectrometer.wavelengths = entry
+        return True
+    spectrometer.getLUT()
+    spectrometer.constructWavelengths()
+    cache.store(serial, firmware, spectrometer.LUT, spectrometer.wavelengths)
+    return False
@@ -0,0 +1,122 @@
+# -*- coding:utf-8 -*-
+"""
+Created on Oct 17, 2026
+
+Bounded message channels between the spectrometer threads and the master.
+"""
+import collections
+import heapq
+import threading
+
+# Overflow policies
+LATEST = 'latest'
+LOSSLESS = 'lossless'
+DROP = 'drop'
+POLICIES = (LATEST, LOSSLESS, DROP)
+
+
+class Channel(object):
+    """FIFO of one kind of message from one producer.
+
+    What happens to put() when capacity items are waiting depends on the
+    policy:
+        latest: the oldest item is dropped, the consumer always gets the
+                newest ones (spectra).
+        lossless: nothing is dropped, capacity is only a soft limit. For
+                  rare messages that must all arrive (state changes).
+        drop: the new item is dropped (log messages).
+    put() never blocks and never raises on overflow, so a slow consumer
+    cannot stall the producer. Drops and the highest fill level seen are
+    counted in drops and highWater. Items are stored with the sequence
+    number of their hub, so drain() can return them in put() order.
+    """
+    def __init__(self, hub, name, policy, capacity):
+        if policy not in POLICIES:
+            raise ValueError(''.join(('Unknown overflow policy ', str(policy), ', use one of ', ', '.join(POLICIES))))
+        self.hub = hub
+        self.name = name
+        self.policy = policy
+        self.capacity = max(int(capacity), 1)
+        self.items = collections.deque()
+        self.drops = 0
+        self.highWater = 0
+
+    def put(self, item):
+        """Queues item, returns False if it was dropped."""
+        with self.hub.condition:
+            if len(self.items) >= self.capacity:
+                if self.policy == DROP:
+                    self.drops += 1
+                    return False
+                elif self.policy == LATEST:
+                    self.items.popleft()
+                    self.drops += 1
+            self.items.append((self.hub.sequence, item))
+            self.hub.sequence += 1
+            if len(self.items) > self.highWater:
+                self.highWater = len(self.items)
+            self.hub.condition.notify()
+        return True
+
+    def counters(self):
+        """Returns (drops, highWater)."""
+        return self.drops, self.highWater
+
+
+class ChannelHub(object):
+    """Set of channels with a single consumer.
+
+    Producers put into their own channels. The consumer calls drain(),
+    which waits until any channel holds items and then takes everything
+    pending in one go. Every put() is numbered by the hub, so the items
+    come out in the order they were put, across all channels: a state
+    change is never applied after a spectrum acquired later. One lock
+    covers all channels, it is only held for appends and for the drain.
+
+    On Python 2 Condition.wait(timeout) polls with sleeps of up to 50 ms,
+    only a wait without timeout wakes up at once. The consumer should
+    therefore call drain() without timeout and be stopped with wake().
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.channels = []
+        self.sequence = 0
+        self.woken = False
+
+    def channel(self, name, policy, capacity):
+        channel = Channel(self, name, policy, capacity)
+        with self.condition:
+            self.channels.append(channel)
+        return channel
+
+    def remove(self, channel):
+        with self.condition:
+            if channel in self.channels:
+                self.channels.remove(channel)
+
+    def wake(self):
+        """Makes a waiting drain() return, empty if nothing is pending.
+        Used to stop the consumer.
+        """
+        with self.condition:
+            self.woken = True
+            self.condition.notify_all()
+
+    def drain(self, timeout=None):
+        """Returns the list of all pending items in put() order. Waits for
+        the first one until wake() is called, or at most timeout s if timeout
+        is not None. Empty if none arrived.
+        """
+        with self.condition:
+            while self.woken == False and not any(len(channel.items) > 0 for channel in self.channels):
+                self.condition.wait(timeout)
+                if timeout is not None:
+                    break
+            self.woken = False
+            pending = []
+            for channel in self.channels:
+                if len(channel.items) > 0:
+                    pending.append(list(channel.items))
+                    channel.items.clear()
+        # Each channel is already in put() order
+        return [item for sequence, item in heapq.merge(*pending)]
@@ -9,32 +9,63 @@ from struct import *
 import numpy as np
 import time
 import atexit
+from SPM002_ringbuffer import SpectrumRingBuffer
+from SPM002_timing import monotonic
+from SPM002_enumeration import DeviceEnumerator
 
 spmlib = windll.LoadLibrary("SPM002.dll")
 
+# Serial map shared by all SPM002control objects of the process, keyed by
+# the PHO_Open index
+enumerator = DeviceEnumerator()
+
+# Events passed to hotplug listeners, see SPM002_usb.HotplugMonitor
+HOTPLUG_ARRIVED = 'arrived'
+HOTPLUG_LEFT = 'left'
+
 class SpectrometerError(Exception):
     pass
 
+def hotplugMonitor():
+    """The vendor DLL has no hotplug notification, faults are only found
+    by failing reads.
+    """
+    return None
+
+def resetAfterFork():
+    """Drops the serial map a forked child inherits, with its lock."""
+    enumerator.reset()
+
 class SPM002control():
-    def __init__(self):
+    def __init__(self, numBuffers=16):
         self.deviceList = []
         self.serialList = []
         self.deviceHandle = None
         self.deviceIndex = None
-        self.CCD = np.zeros(3648)
-        self.CCD = self.CCD.astype(np.uint16)
-        self.CCD_ct = self.CCD.ctypes.data_as(POINTER(c_uint16))
+        # Spectra are acquired straight into a preallocated ring buffer,
+        # CCD is a read-only view of the latest frame
+        self.ringBuffer = SpectrumRingBuffer(numBuffers, 3648)
+        self.ringBuffer_ct = [self.ringBuffer.data[k].ctypes.data_as(POINTER(c_uint16)) for k in range(numBuffers)]
+        self.CCD = self.ringBuffer.latest()
 
         self.LUT = None
         self.wavelengths = np.zeros(3648)
         
-    def populateDeviceList(self):
+    def populateDeviceList(self, rescan=False):
+        """Fills deviceList and serialList from the shared enumerator. The
+        devices are only opened to read their serials if the cached map is
+        invalid or rescan is True.
+        """
+        self.deviceList, self.serialList = enumerator.devices(self._scanDevices, rescan)
+
+    def _scanDevices(self, known):
+        # The DLL indices are not tied to a bus path, so every scan reads all
+        # serials again. The device held by this object is closed meanwhile.
         indexTmp = None
         if self.deviceHandle != None:
             indexTmp = self.deviceIndex
             self.closeDevice()
-        self.deviceList = []
-        self.serialList = []
+        devices = []
         for k in range(15):
             # It seems the first index is not valid... start with 1
             index = c_int(k + 1)
@@ -44,15 +75,17 @@ class SPM002control():
             if handle == 0:
                 break
             serial = spmlib.PHO_Getsn(handle)
-            self.deviceList.append(handle)
-            self.serialList.append(serial)
+            devices.append((k + 1, serial))
             spmlib.PHO_Close(handle)
         if indexTmp != None:
-            self.openDevice(indexTmp)
+            self.openDeviceIndex(indexTmp)
+        return devices
             
     def openDeviceSerial(self, serial):
         if self.deviceHandle != None:
             self.closeDevice()
+        if serial not in self.serialList:
+            self.populateDeviceList()
         try:
             index = self.serialList.index(serial) + 1
 #            print 'Opening device', index
@@ -62,14 +95,17 @@ class SPM002control():
 #        print 'Handle: ', self.deviceHandle
         if self.deviceHandle == 0:
             self.deviceHandle = None
+            # The device moved or was unplugged since the last scan
+            enumerator.invalidate()
             raise SpectrometerError('Error opening spectrometer')
-        self.deviceIndex = index
+        self.deviceIndex = index - 1  # counts from 0 as in openDeviceIndex
 
     def openDeviceIndex(self, index):
         if self.deviceHandle != None:
             self.closeDevice()
         self.deviceHandle = spmlib.PHO_Open(c_int(index + 1))
         if self.deviceHandle == 0:
+            self.deviceHandle = None
             raise SpectrometerError('Error opening spectrometer')
         self.deviceIndex = index
             
@@ -86,6 +122,11 @@ class SPM002control():
             serial = spmlib.PHO_Getsn(self.deviceHandle)
             return serial
         
+    def getFirmwareVersion(self):
+        if self.deviceIndex != None:
+            firmware = spmlib.PHO_Getfw(self.deviceHandle)
+            return firmware
+
     def getExposureTime(self):
         if self.deviceIndex != None:
             exposure = spmlib.PHO_Gettime(self.deviceHandle)
@@ -111,19 +152,39 @@ class SPM002control():
             self.LUT = LUT
         
     def constructWavelengths(self):
-        if self.LUT == None:
+        if self.LUT is None:
             self.getLUT()
-        if self.LUT != None:
+        if self.LUT is not None:
             x = np.arange(self.wavelengths.shape[0], dtype=np.float64)
             w = self.LUT[0] + self.LUT[1] * x + self.LUT[2] * x ** 2 + self.LUT[3] * x ** 3
             self.wavelengths = w
             
     def acquireSpectrum(self):
         if self.deviceIndex != None:
-            result = spmlib.PHO_Acquire(self.deviceHandle, self.CCD_ct)
+            startTime = monotonic()
+            result = spmlib.PHO_Acquire(self.deviceHandle, self.ringBuffer_ct[self.ringBuffer.writeIndex])
             # Unknown meaning of this result value
 #            if result != 0:
 #                raise SpectrometerError(''.join(('Could not acquire spectrum, returned ', str(result))))
+            seq = self.ringBuffer.commit(startTime, monotonic())
+            self.CCD = self.ringBuffer.latest()
+            return seq
+
+    def streamSpectra(self, numTransfers=None):
+        """Generator for free running acquisition, yields CCD once per new frame.
+        The DLL has no asynchronous interface, so frames are acquired back to
+        back; numTransfers is accepted for compatibility with the libusb backend.
+        """
+        while self.deviceIndex != None:
+            self.acquireSpectrum()
+            yield self.CCD
+
+    def getFrameInfo(self):
+        """Returns (sequence, startTime, endTime, timestamp) of the latest frame.
+        startTime and endTime are monotonic and bracket the acquisition call,
+        timestamp is the wall clock time when it finished.
+        """
+        return self.ringBuffer.frameInfo()
 
         
         
@@ -3,62 +3,250 @@
 Created on Jun 11, 2012
 
 @author: Laser
+
+Backend for the newer vendor DLL, PhotonSpectr.dll. It has the interface of
+SPM002_control and also averages on the device and reads the dark spectrum,
+linearity coefficients and special pixels stored in the spectrometer. The
+device servers use it when SPM002_DLL=PhotonSpectr is set.
+
+Unlike SPM002.dll every call after PHO_Open takes the device index, not the
+value returned by PHO_Open, and PHO_Open returns 0 on success like the other
+calls.
+
+There is no vendor header for the table functions. The buffers passed to
+them are several times larger than the tables are expected to be, so a DLL
+writing more than expected does not overrun them, and only the expected part
+is used.
 """
 from ctypes import *
 from struct import *
 import numpy as np
 import time
 import atexit
+from SPM002_ringbuffer import SpectrumRingBuffer
+from SPM002_timing import monotonic
+from SPM002_enumeration import DeviceEnumerator
 
 spmlib = cdll.LoadLibrary("PhotonSpectr.dll")
 
+# Serial map shared by all SPM002control objects of the process, keyed by
+# the device index
+enumerator = DeviceEnumerator()
+
+# Events passed to hotplug listeners, see SPM002_usb.HotplugMonitor
+HOTPLUG_ARRIVED = 'arrived'
+HOTPLUG_LEFT = 'left'
+
+NUM_PIXELS = 3648
+NUM_LINEARITY_COEFFS = 8
+MAX_SPECIAL_PIXELS = 64
+# Sizes of the buffers handed to the table functions, see the module docstring
+DARK_BUFFER_SIZE = 4 * NUM_PIXELS
+LINEARITY_BUFFER_SIZE = 64
+SPECIAL_PIXELS_BUFFER_SIZE = 4 * NUM_PIXELS
+
 class SpectrometerError(Exception):
     pass
 
+def hotplugMonitor():
+    """The vendor DLL has no hotplug notification, faults are only found
+    by failing reads.
+    """
+    return None
+
+def resetAfterFork():
+    """Drops the serial map a forked child inherits, with its lock."""
+    enumerator.reset()
+
 class SPM002control():
-    def __init__(self):
+    def __init__(self, numBuffers=16):
         self.deviceList = []
         self.serialList = []
         self.deviceHandle = None
         self.deviceIndex = None
-        self.CCD = np.zeros(3648)
-        self.CCD = self.CCD.astype(np.uint16)
-        self.CCD_ct = self.CCD.ctypes.data_as(POINTER(c_uint16))
+        # Spectra are acquired straight into a preallocated ring buffer,
+        # CCD is a read-only view of the latest frame
+        self.ringBuffer = SpectrumRingBuffer(numBuffers, 3648)
+        self.ringBuffer_ct = [self.ringBuffer.data[k].ctypes.data_as(POINTER(c_uint16)) for k in range(numBuffers)]
+        self.CCD = self.ringBuffer.latest()
 
         self.LUT = None
         self.wavelengths = np.zeros(3648)
-        
-    def populateDeviceList(self):
+
+    def populateDeviceList(self, rescan=False):
+        """Fills deviceList and serialList from the shared enumerator. The
+        devices are only opened to read their serials if the cached map is
+        invalid or rescan is True.
+        """
+        self.deviceList, self.serialList = enumerator.devices(self._scanDevices, rescan)
+
+    def _scanDevices(self, known):
+        # The device held by this object is closed meanwhile
         indexTmp = None
         if self.deviceHandle != None:
             indexTmp = self.deviceIndex
             self.closeDevice()
-        self.deviceList = []
-        numDevices = spmlib.PHO_EnumerateDevices()
-        for k in range(numDevices):
-            index = c_int(k)
-            handle = spmlib.PHO_Open(index)
-            serial = spmlib.PHO_Getsn(handle)
-            self.deviceList.append(handle)
-            self.serialList.append(serial)
-            spmlib.PHO_Close(handle)
-        if indexTmp != None:
-            self.openDevice(indexTmp)
-            
-    def openDevice(self, index):
+        devices = []
+        try:
+            numDevices = spmlib.PHO_EnumerateDevices()
+            for k in range(numDevices):
+                index = c_int(k)
+                result = spmlib.PHO_Open(index)
+                if result != 0:
+                    raise SpectrometerError(''.join(('Could not open device ', str(k), ' to read its serial, returned ', str(result))))
+                serial = spmlib.PHO_GetSn(index)
+                devices.append((k, serial))
+                spmlib.PHO_Close(index)
+        finally:
+            if indexTmp != None:
+                self.openDeviceIndex(indexTmp)
+        return devices
+
+    def openDeviceSerial(self, serial):
+        if serial not in self.serialList:
+            self.populateDeviceList()
+        try:
+            index = self.deviceList[self.serialList.index(serial)]
+        except ValueError:
+            raise SpectrometerError(''.join(('No device ', str(serial), ' found in list of connected spectrometers.')))
+        self.openDeviceIndex(index)
+        if self.getSerial() != serial:
+            # The device moved or was unplugged since the last scan
+            self.closeDevice()
+            enumerator.invalidate()
+            raise SpectrometerError('Error opening spectrometer')
+
+    def openDeviceIndex(self, index):
         if self.deviceHandle != None:
             self.closeDevice()
-        self.deviceHandle = spmlib.PHO_Open(c_int(index))
+        result = spmlib.PHO_Open(c_int(index))
+        if result != 0:
+            raise SpectrometerError(''.join(('Error opening spectrometer, returned ', str(result))))
+        self.deviceHandle = result
         self.deviceIndex = index
-            
+
     def closeDevice(self):
         if self.deviceHandle != None:
             result = spmlib.PHO_Close(c_int(self.deviceIndex))
+            self.deviceHandle = None
+            self.deviceIndex = None
             if result != 0:
                 raise SpectrometerError(''.join(('Could not close device, returned ', str(result))))
-            self.deviceIndex = None
-            
+
+    def getSerial(self):
+        if self.deviceIndex != None:
+            serial = spmlib.PHO_GetSn(c_int(self.deviceIndex))
+            return serial
+
+    def getFirmwareVersion(self):
+        if self.deviceIndex != None:
+            firmware = spmlib.PHO_GetFw(c_int(self.deviceIndex))
+            return firmware
+
+    def getExposureTime(self):
+        if self.deviceIndex != None:
+            exposure = spmlib.PHO_GetTime(c_int(self.deviceIndex))
+            return exposure
+
+    def setExposureTime(self, exposure):
+        if self.deviceIndex != None:
+            result = spmlib.PHO_SetTime(c_int(self.deviceIndex), c_int(exposure))
+            if result != 0:
+                raise SpectrometerError(''.join(('Could not set exposure time, returned ', str(result))))
+
+    def setAverage(self, average):
+        """Sets the number of exposures averaged in the spectrometer per
+        acquired spectrum.
+        """
+        if self.deviceIndex != None:
+            if average < 1:
+                raise SpectrometerError(''.join(('Average must be at least 1, got ', str(average))))
+            result = spmlib.PHO_SetAverage(c_int(self.deviceIndex), c_int(average))
+            if result != 0:
+                raise SpectrometerError(''.join(('Could not set average, returned ', str(result))))
+
+    def getAverage(self):
+        if self.deviceIndex != None:
+            average = spmlib.PHO_GetAverage(c_int(self.deviceIndex))
+            return average
+
+    def getDark(self):
+        """Returns the dark spectrum stored in the spectrometer."""
+        if self.deviceIndex != None:
+            dark = np.zeros(DARK_BUFFER_SIZE, dtype=np.uint16)
+            dark_ct = dark.ctypes.data_as(POINTER(c_uint16))
+            result = spmlib.PHO_GetDark(c_int(self.deviceIndex), dark_ct)
+            if result != 0:
+                raise SpectrometerError(''.join(('Could not get dark spectrum, returned ', str(result))))
+            return dark[:NUM_PIXELS].copy()
+
+    def getLinearity(self):
+        """Returns the 8 linearity polynomial coefficients, lowest order first."""
+        if self.deviceIndex != None:
+            coeffs = np.zeros(LINEARITY_BUFFER_SIZE, dtype=np.float32)
+            coeffs_ct = coeffs.ctypes.data_as(POINTER(c_float))
+            result = spmlib.PHO_GetLinearity(c_int(self.deviceIndex), coeffs_ct)
+            if result != 0:
+                raise SpectrometerError(''.join(('Could not get linearity, returned ', str(result))))
+            return coeffs[:NUM_LINEARITY_COEFFS].astype(np.float64)
+
+    def getSpecialPixels(self):
+        """Returns the indices of the pixels flagged hot or dead, at most
+        MAX_SPECIAL_PIXELS. The DLL is taken to return how many entries it
+        filled, a negative value is an error. Indices outside the detector
+        are dropped.
+        """
+        if self.deviceIndex != None:
+            pixels = np.zeros(SPECIAL_PIXELS_BUFFER_SIZE, dtype=np.int32)
+            pixels_ct = pixels.ctypes.data_as(POINTER(c_int))
+            count = spmlib.PHO_GetSpecialPixels(c_int(self.deviceIndex), pixels_ct)
+            if count < 0:
+                raise SpectrometerError(''.join(('Could not get special pixels, returned ', str(count))))
+            pixels = pixels[:min(count, MAX_SPECIAL_PIXELS)].astype(np.int64)
+            return pixels[(pixels >= 0) & (pixels < NUM_PIXELS)]
+
+    def getLUT(self):
+        if self.deviceIndex != None:
+            LUT = np.zeros(4)
+            LUT = LUT.astype(np.float32)
+            LUT_ct = LUT.ctypes.data_as(POINTER(c_float))
+            result = spmlib.PHO_GetLut(c_int(self.deviceIndex), LUT_ct)
+            self.LUT = LUT
+
+    def constructWavelengths(self):
+        if self.LUT is None:
+            self.getLUT()
+        if self.LUT is not None:
+            x = np.arange(self.wavelengths.shape[0], dtype=np.float64)
+            w = self.LUT[0] + self.LUT[1] * x + self.LUT[2] * x ** 2 + self.LUT[3] * x ** 3
+            self.wavelengths = w
+
+    def acquireSpectrum(self):
+        if self.deviceIndex != None:
+            startTime = monotonic()
+            result = spmlib.PHO_Acquire(c_int(self.deviceIndex), self.ringBuffer_ct[self.ringBuffer.writeIndex])
+            seq = self.ringBuffer.commit(startTime, monotonic())
+            self.CCD = self.ringBuffer.latest()
+            return seq
+
+    def streamSpectra(self, numTransfers=None):
+        """Generator for free running acquisition, yields CCD once per new frame.
+        The DLL has no asynchronous interface, so frames are acquired back to
+        back; numTransfers is accepted for compatibility with the libusb backend.
+        """
+        while self.deviceIndex != None:
+            self.acquireSpectrum()
+            yield self.CCD
+
+    def getFrameInfo(self):
+        """Returns (sequence, startTime, endTime, timestamp) of the latest frame.
+        startTime and endTime are monotonic and bracket the acquisition call,
+        timestamp is the wall clock time when it finished.
+        """
+        return self.ringBuffer.frameInfo()
+
+
 if __name__ == '__main__':
-    spm = SPM002control()    
-#    spm.populateDeviceList()
-#    spm.openDevice(1)  
+    spm = SPM002control()
+    spm.populateDeviceList()
+#    spm.openDevice(1)
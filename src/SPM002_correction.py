@@ -0,0 +1,102 @@
+# -*- coding:utf-8 -*-
+"""
+Created on Oct 17, 2026
+
+Dark, linearity and special pixel correction of SPM002 spectra.
+"""
+import numpy as np
+
+
+class SpectrumCorrection(object):
+    """Applies the per device corrections stored in the spectrometer to raw
+    frames, using the tables read with getDark(), getLinearity() and
+    getSpecialPixels() of the SPM002control backends.
+
+    Steps, each one enabled separately:
+        dark: the dark frame is subtracted pixel by pixel.
+        linearity: the dark subtracted counts c are divided by the response
+                   polynomial p(c) = coeffs[0] + coeffs[1] * c + ...
+        special pixels: pixels flagged by the device (hot or dead) are
+                        replaced by the mean of their nearest good neighbours.
+
+    All work buffers are allocated up front. apply() writes into a ring of
+    numBuffers output arrays, so a corrected spectrum handed to readers stays
+    valid until numBuffers more frames were corrected, as with
+    SPM002_ringbuffer.SpectrumRingBuffer.
+    """
+    def __init__(self, numPixels=3648, numBuffers=4):
+        self.numPixels = numPixels
+        self.dark = None
+        self.linearity = None
+        self.specialPixels = np.zeros(0, dtype=np.int64)
+        self.leftNeighbour = np.zeros(0, dtype=np.int64)
+        self.rightNeighbour = np.zeros(0, dtype=np.int64)
+        self.darkEnabled = False
+        self.linearityEnabled = False
+        self.specialPixelsEnabled = False
+        self.buffers = [np.zeros(numPixels) for k in range(numBuffers)]
+        self.writeIndex = 0
+        self.poly = np.zeros(numPixels)
+
+    def setDark(self, dark):
+        """Sets the dark frame, None clears it."""
+        if dark is None:
+            self.dark = None
+        else:
+            self.dark = np.asarray(dark, dtype=np.float64).copy()
+
+    def setLinearity(self, coeffs):
+        """Sets the response polynomial coefficients, lowest order first.
+        None or all zero coefficients clear it.
+        """
+        if coeffs is None or not np.any(coeffs):
+            self.linearity = None
+        else:
+            # Trailing zero coefficients would only cost Horner steps
+            self.linearity = np.trim_zeros(np.asarray(coeffs, dtype=np.float64), 'b').copy()
+
+    def setSpecialPixels(self, pixels):
+        """Sets the indices of the pixels to interpolate over."""
+        pixels = np.unique(np.asarray(pixels, dtype=np.int64))
+        pixels = pixels[(pixels >= 0) & (pixels < self.numPixels)]
+        good = np.ones(self.numPixels, dtype=np.bool_)
+        good[pixels] = False
+        goodIndex = np.flatnonzero(good)
+        self.specialPixels = pixels
+        if goodIndex.shape[0] == 0:
+            self.specialPixels = np.zeros(0, dtype=np.int64)
+            pixels = self.specialPixels
+        # Nearest good pixel on each side, the edge pixels use the one side
+        # they have
+        pos = np.searchsorted(goodIndex, pixels)
+        self.leftNeighbour = goodIndex[np.maximum(pos - 1, 0)]
+        self.rightNeighbour = goodIndex[np.minimum(pos, goodIndex.shape[0] - 1)]
+
+    def enabled(self):
+        return ((self.darkEnabled == True and self.dark is not None) or
+                (self.linearityEnabled == True and self.linearity is not None) or
+                (self.specialPixelsEnabled == True and self.specialPixels.shape[0] > 0))
+
+    def apply(self, raw, out=None):
+        """Returns the corrected frame raw as float64, in out if given and
+        otherwise in the next output buffer. Uncorrected steps are skipped,
+        with none enabled the result is a float copy of raw.
+        """
+        if out is None:
+            out = self.buffers[self.writeIndex]
+            self.writeIndex = (self.writeIndex + 1) % len(self.buffers)
+        if self.darkEnabled == True and self.dark is not None:
+            np.subtract(raw, self.dark, out=out)
+        else:
+            out[:] = raw
+        if self.linearityEnabled == True and self.linearity is not None:
+            # Horner evaluation of p(out) in place
+            coeffs = self.linearity
+            self.poly.fill(coeffs[-1])
+            for c in coeffs[-2::-1]:
+                self.poly *= out
+                self.poly += c
+            np.divide(out, self.poly, out=out, where=self.poly != 0)
+        if self.specialPixelsEnabled == True and self.specialPixels.shape[0] > 0:
+            out[self.specialPixels] = 0.5 * (out[self.leftNeighbour] + out[self.rightNeighbour])
+        return out
@@ -0,0 +1,94 @@
+# -*- coding:utf-8 -*-
+"""
+Created on Oct 17, 2026
+
+Shared enumeration of the SPM002 spectrometers connected to the host.
+"""
+import threading
+from SPM002_timing import monotonic
+
+
+class DeviceEnumerator(object):
+    """Process wide cache of the connected spectrometers.
+
+    Finding the serial numbers means opening every device, which takes
+    seconds with many spectrometers on the bus and must not run from several
+    threads at once. All SPM002control objects of a backend share one
+    DeviceEnumerator, so the bus is only scanned when the cached map is
+    invalid (at start, after invalidate() or on an explicit rescan) and
+    concurrent callers wait for the scan in progress instead of starting
+    their own.
+
+    The scan itself is done by the backend: scan(known) is called with the
+    cached {key: serial} map and returns the list of (key, serial) of the
+    connected devices in bus order. A backend with stable device keys (bus
+    path) only has to open devices it has not seen before.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.keys = []
+        self.serials = []
+        self.valid = False
+        self.generation = 0
+        self.scanTime = None
+
+    def reset(self):
+        """Forgets the map and replaces the lock. For a forked child, which
+        inherits the lock in whatever state a thread of the parent held it.
+        """
+        self.__init__()
+
+    def invalidate(self):
+        """Marks the map as out of date, the next devices() call rescans.
+        Called on hotplug events and when opening a listed device fails.
+        """
+        self.valid = False
+
+    def devices(self, scan, rescan=False):
+        """Returns (keys, serials) of the connected devices, scanning the bus
+        with scan() only if the map is invalid or rescan is True. A rescan
+        request is satisfied by any scan that started after the call.
+        """
+        generation = self.generation
+        with self.lock:
+            if self.valid == False or (rescan == True and self.generation == generation):
+                known = dict(zip(self.keys, self.serials))
+                # Marked valid before scanning, so an invalidate() arriving
+                # during the scan clears the flag again and is not lost. A
+                # scan that fails leaves the map invalid.
+                self.valid = True
+                try:
+                    found = scan(known)
+                except Exception:
+                    self.valid = False
+                    raise
+                self.keys = [key for key, serial in found]
+                self.serials = [serial for key, serial in found]
+                self.generation += 1
+                self.scanTime = monotonic()
+            return list(self.keys), list(self.serials)
+
+    def snapshot(self):
+        """Returns (keys, serials) of the cached map without scanning."""
+        with self.lock:
+            return list(self.keys), list(self.serials)
+
+    def assign(self, keys, serials):
+        """Installs a map scanned elsewhere as valid. Used by worker
+        processes, which must not open devices held by their siblings to read
+        the serial numbers.
+        """
+        with self.lock:
+            self.keys = list(keys)
+            self.serials = list(serials)
+            self.valid = True
+            self.generation += 1
+            self.scanTime = monotonic()
+
+    def key(self, serial):
+        """Returns the cached device key of serial, None if it is not listed."""
+        with self.lock:
+            try:
+                return self.keys[self.serials.index(serial)]
+            except ValueError:
+                return None
@@ -0,0 +1,128 @@
+# -*- coding:utf-8 -*-
+"""
+Created on Oct 17, 2026
+
+Automatic exposure control for the SPM002 acquisition loops.
+"""
+import numpy as np
+from SPM002_timing import monotonic
+
+# Largest value of the 12 bit ADC
+SATURATION = 4095
+
+
+class AutoExposureController(object):
+    """Closed loop exposure control from the acquired spectra.
+
+    The signal level is the target percentile of a frame, so a few hot
+    pixels do not set the exposure. A low percentile is taken as background.
+    The CCD offset does not scale with the exposure, so the new exposure is
+    solved from level - background instead of the raw level, and a correct
+    frame reaches the target in one step.
+
+    Stability:
+        hysteresis: nothing changes while the level is within tolerance of
+                    the target. Once adjusting, the controller continues
+                    until the level is within half the tolerance, so it
+                    does not hunt at the band edge.
+        rate limit: one step scales the exposure by at most maxStep. Frames
+                    whose exposure started before the last change are
+                    skipped, as they were taken with the old time.
+        saturation: a frame with any pixel at SATURATION says nothing about
+                    the true level, so the exposure is halved until the
+                    peak comes out of saturation. The shortest saturating
+                    exposure is remembered and later increases stay below
+                    it, approaching it in geometric steps. Without this a
+                    line narrower than the percentile window, which never
+                    reaches the target level, would cycle between
+                    saturating and too short exposures. The cap is dropped
+                    once the frame maximum predicts that the capped
+                    exposure no longer saturates, e.g. after the light got
+                    weaker.
+
+    update() only computes, it does not talk to the hardware. It costs one
+    np.partition of the frame, so it can run on every frame in the
+    acquisition thread.
+    """
+    def __init__(self, target=2500.0, percentile=99.5, tolerance=0.1, maxStep=4.0,
+                 minExposure=0.1, maxExposure=500.0, backgroundPercentile=10.0):
+        if not 0.0 <= backgroundPercentile < percentile <= 100.0:
+            raise ValueError('Percentiles must satisfy 0 <= background < target percentile <= 100')
+        if not 0.0 < target < SATURATION:
+            raise ValueError(''.join(('Target must be between 0 and ', str(SATURATION), ' counts')))
+        self.target = float(target)
+        self.percentile = percentile
+        self.backgroundPercentile = backgroundPercentile
+        self.tolerance = tolerance
+        self.maxStep = maxStep
+        self.minExposure = minExposure
+        self.maxExposure = maxExposure
+        self.reset()
+
+    def reset(self):
+        """Forgets the last change, e.g. after the exposure was set by hand."""
+        self.adjusting = False
+        self.changeTime = None
+        self.level = None
+        self.background = None
+        self.saturated = False
+        self.saturatedExposure = None
+
+    def measure(self, frame):
+        """Returns (level, background, maximum) of frame in counts."""
+        n = frame.shape[0]
+        kLevel = int(round(self.percentile / 100.0 * (n - 1)))
+        kBackground = int(round(self.backgroundPercentile / 100.0 * (n - 1)))
+        part = np.partition(frame, (kBackground, kLevel, n - 1))
+        return float(part[kLevel]), float(part[kBackground]), float(part[n - 1])
+
+    def update(self, frame, expTime, startTime=None):
+        """Returns the new exposure time in ms for the frames after frame,
+        which was exposed for expTime ms, or None to keep expTime. startTime
+        is the monotonic() start of the exposure of frame.
+        """
+        if self.changeTime is not None and startTime is not None and startTime < self.changeTime:
+            return None
+        level, background, maximum = self.measure(frame)
+        self.level = level
+        self.background = background
+        self.saturated = maximum >= SATURATION
+        if self.saturated == True:
+            if self.saturatedExposure is None or expTime < self.saturatedExposure:
+                self.saturatedExposure = expTime
+            scale = max(0.5, 1.0 / self.maxStep)
+        else:
+            if self.saturatedExposure is not None:
+                # Maximum expected at the capped exposure, the offset does
+                # not scale. The margin keeps the cap near the boundary.
+                predicted = background + (maximum - background) * self.saturatedExposure / expTime
+                if predicted < 0.8 * SATURATION:
+                    self.saturatedExposure = None
+            deviation = abs(level - self.target) / self.target
+            if self.adjusting == True:
+                band = 0.5 * self.tolerance
+            else:
+                band = self.tolerance
+            if deviation <= band:
+                self.adjusting = False
+                return None
+            signal = level - background
+            wanted = self.target - background
+            if signal <= 0 or wanted <= 0:
+                scale = self.maxStep
+            else:
+                scale = min(max(wanted / signal, 1.0 / self.maxStep), self.maxStep)
+        newExp = min(max(expTime * scale, self.minExposure), self.maxExposure)
+        if self.saturatedExposure is not None and newExp > expTime:
+            # Bisect (geometrically) towards the shortest saturating exposure
+            newExp = min(newExp, np.sqrt(expTime * self.saturatedExposure))
+            if newExp < expTime * (1.0 + 0.5 * self.tolerance):
+                self.adjusting = False
+                return None
+        # The hardware takes whole us
+        if abs(newExp - expTime) < 1e-3:
+            self.adjusting = False
+            return None
+        self.adjusting = True
+        self.changeTime = monotonic()
+        return newExp
@@ -0,0 +1,162 @@
+# -*- coding:utf-8 -*-
+"""
+Created on Oct 17, 2026
+
+Preallocated ring buffer of spectra, shared by the SPM002control backends.
+"""
+import numpy as np
+import time
+import zlib
+from SPM002_timing import monotonic
+
+
+class SpectrumRingBuffer(object):
+    """Fixed size ring buffer of numSlots spectra of numPixels uint16 values.
+
+    All memory is allocated up front. The producer (the acquisition thread)
+    fills the array returned by nextSlot() and then calls commit(); consumers
+    get read-only views into the buffer instead of copies. A view stays
+    valid until the producer has written numSlots newer frames, so a slow
+    reader can catch up on recent history with framesSince().
+
+    Contains:
+        data (numpy array): numSlots x numPixels spectrum storage
+        startTimes (numpy array): monotonic() when the exposure of each slot started
+        endTimes (numpy array): monotonic() when the readout of each slot finished
+        timestamps (numpy array): time.time() of each slot when committed, for
+                lining frames up with other diagnostics
+        sequence (numpy array): frame sequence number of each slot, -1 if empty
+        writeIndex: slot that will be written next
+        frameCount: number of frames committed so far
+    """
+    def __init__(self, numSlots=16, numPixels=3648):
+        self.numSlots = numSlots
+        self.numPixels = numPixels
+        self.data = np.zeros((numSlots, numPixels), dtype=np.uint16)
+        self.startTimes = np.zeros(numSlots, dtype=np.float64)
+        self.endTimes = np.zeros(numSlots, dtype=np.float64)
+        self.timestamps = np.zeros(numSlots, dtype=np.float64)
+        self.sequence = -np.ones(numSlots, dtype=np.int64)
+        self.writeIndex = 0
+        self.frameCount = 0
+        self.views = []
+        for k in range(numSlots):
+            view = self.data[k]
+            view.flags.writeable = False
+            self.views.append(view)
+
+    def nextSlot(self):
+        """Returns the writable array of the slot the next frame goes into."""
+        return self.data[self.writeIndex]
+
+    def commit(self, startTime=None, endTime=None):
+        """Publishes the slot filled after nextSlot() and returns its sequence
+        number. startTime and endTime are monotonic() values bracketing the
+        acquisition, endTime defaults to now.
+        """
+        if endTime is None:
+            endTime = monotonic()
+        if startTime is None:
+            startTime = endTime
+        seq = self.frameCount
+        self.startTimes[self.writeIndex] = startTime
+        self.endTimes[self.writeIndex] = endTime
+        self.timestamps[self.writeIndex] = time.time()
+        self.sequence[self.writeIndex] = seq
+        self.frameCount = seq + 1
+        self.writeIndex = (self.writeIndex + 1) % self.numSlots
+        return seq
+
+    def latestIndex(self):
+        return (self.writeIndex - 1) % self.numSlots
+
+    def latest(self):
+        """Returns a read-only view of the most recent frame."""
+        return self.views[self.latestIndex()]
+
+    def frameInfo(self, index=None):
+        """Returns (sequence, startTime, endTime, timestamp) of slot index,
+        the latest frame by default.
+        """
+        if index is None:
+            index = self.latestIndex()
+        return (int(self.sequence[index]), self.startTimes[index],
+                self.endTimes[index], self.timestamps[index])
+
+    def get(self, seq):
+        """Returns a read-only view of frame seq, or None if it was overwritten
+        or has not been acquired yet.
+        """
+        index = seq % self.numSlots
+        if self.sequence[index] != seq:
+            return None
+        return self.views[index]
+
+    def copy(self, seq, out=None):
+        """Copies frame seq into out, a new array if out is None, and
+        returns it. Returns None if the frame was overwritten, or the
+        producer may have started overwriting it, before the copy finished.
+        Consumers in other threads take views this way: they hold on to the
+        sequence number and copy only when they publish the frame.
+        """
+        index = seq % self.numSlots
+        # The producer only writes frame frameCount, into slot
+        # frameCount % numSlots
+        if self.sequence[index] != seq or self.frameCount - seq >= self.numSlots:
+            return None
+        if out is None:
+            out = np.empty(self.numPixels, dtype=np.uint16)
+        out[:] = self.data[index]
+        if self.frameCount - seq >= self.numSlots:
+            return None
+        return out
+
+    def framesSince(self, seq):
+        """Returns a list of (sequence, timestamp, view) for the frames after seq
+        that are still in the buffer, oldest first.
+        """
+        first = max(seq + 1, self.frameCount - self.numSlots)
+        frames = []
+        for s in range(first, self.frameCount):
+            index = s % self.numSlots
+            frames.append((s, self.timestamps[index], self.views[index]))
+        return frames
+
+
+def frameChecksum(frame):
+    """Returns a 64 bit checksum of the raw bytes of a C contiguous frame,
+    crc32 in the high and adler32 in the low word. Reads the buffer in
+    place, nothing is allocated.
+    """
+    return ((zlib.crc32(frame) & 0xffffffff) << 32) | (zlib.adler32(frame) & 0xffffffff)
+
+
+class StaleFrameDetector(object):
+    """Detects a spectrometer that stopped delivering new data.
+
+    A frame counts as new when both its sequence number and its checksum
+    differ from the previous frame: the sequence catches the acquisition
+    loop handing over the same slot again, the checksum a device that keeps
+    returning the same readout. update() returns True once no new frame
+    has been seen for timeout s.
+    """
+    def __init__(self, timeout=5.0):
+        self.timeout = timeout
+        self.reset()
+
+    def reset(self, now=None):
+        if now is None:
+            now = monotonic()
+        self.lastSequence = None
+        self.lastChecksum = None
+        self.lastChange = now
+
+    def update(self, seq, frame, now=None):
+        if now is None:
+            now = monotonic()
+        checksum = frameChecksum(frame)
+        if seq != self.lastSequence and checksum != self.lastChecksum:
+            self.lastChange = now
+        self.lastSequence = seq
+        self.lastChecksum = checksum
+        return now - self.lastChange > self.timeout
@@ -0,0 +1,348 @@
+# -*- coding:utf-8 -*-
+"""
+Created on Oct 17, 2026
+
+Named shared memory ring of spectra, for passing frames between processes
+on the same host without copying them through pipes or CORBA.
+"""
+import os
+import sys
+import mmap
+import glob
+import time
+import errno
+import select
+import socket
+import tempfile
+import numpy as np
+from SPM002_timing import monotonic
+
+MAGIC = 0x53504d3032524e47  # 'SPM02RNG'
+VERSION = 1
+
+# Header, uint64 words
+HEADER_SIZE = 64
+H_MAGIC = 0
+H_VERSION = 1
+H_NUM_PIXELS = 2
+H_NUM_SLOTS = 3
+H_WRITE_COUNT = 4
+H_WRITER_PID = 5
+
+# Slot: 4 uint64 words (seqlock, write count, frame sequence, spare), 4
+# float64 (startTime, endTime, timestamp, spare), then the uint16 pixels
+SLOT_META_SIZE = 64
+S_LOCK = 0
+S_COUNT = 1
+S_SEQUENCE = 2
+
+# Time in s between scans of the writer for new wakeup sockets
+WAKEUP_SCAN_INTERVAL = 1.0
+
+
+class SharedMemoryError(Exception):
+    pass
+
+
+def ringName(serial):
+    """Name of the ring of spectrometer serial, shared by all processes."""
+    return ''.join(('SPM002_', str(serial)))
+
+
+def _path(name):
+    if os.path.isdir('/dev/shm'):
+        return os.path.join('/dev/shm', name)
+    return os.path.join(tempfile.gettempdir(), name)
+
+
+class SharedSpectrumRing(object):
+    """Ring of numSlots uint16 spectra in a named shared memory segment,
+    with one writer and any number of readers in other processes.
+
+    Each slot is guarded by a sequence lock: the writer makes the slot lock
+    odd, writes the frame and makes it even again, then publishes the total
+    number of frames written in the header. A reader takes the newest slot
+    and copies it, and retries if the lock was odd or changed during the
+    copy. Neither side ever waits for the other, a reader slower than
+    numSlots frames simply gets the newest frame again.
+
+    The writer creates the segment with create=True and removes it in
+    close(). Every writer creates a new segment and renames it over the name
+    once the header is written, so readers of a crashed writer's segment see
+    replaced(). A segment whose writer process is still alive is never
+    replaced, a second writer of the same name gets SharedMemoryError.
+    Readers open an existing segment, the size is taken from its header. On Windows the segment is a named mapping (tagname), elsewhere a
+    file in /dev/shm or the temp directory.
+
+    A reader opened with wakeup=True binds a unix datagram socket
+    <name>.wake.<pid>.<id> beside the segment, and wait() blocks on it. After
+    each write() the writer sends one byte to every such socket, it looks
+    for new ones once per second. A frame written before wait() leaves its
+    byte queued, so no wakeup is lost. Without unix sockets (Windows)
+    wakeupEnabled() is False and wait() only sleeps.
+    """
+    def __init__(self, name, numPixels=3648, numSlots=8, create=False, wakeup=False):
+        self.name = name
+        self.create = create
+        self.path = None
+        self.newPath = None
+        self.inode = None
+        self.wakeSocket = None
+        self.wakePath = None
+        self.wakeAddresses = []
+        self.wakeScanTime = None
+        if create == True:
+            slotSize = self._slotSize(numPixels)
+            self.mm = self._map(HEADER_SIZE + numSlots * slotSize, True)
+        else:
+            header = self._map(HEADER_SIZE, False)
+            headerInode = self.inode
+            try:
+                words = np.frombuffer(header, dtype=np.uint64, count=HEADER_SIZE // 8)
+                if words[H_MAGIC] != MAGIC or words[H_VERSION] != VERSION:
+                    raise SharedMemoryError(''.join(('No spectrum ring ', name)))
+                numPixels = int(words[H_NUM_PIXELS])
+                numSlots = int(words[H_NUM_SLOTS])
+                del words
+            finally:
+                header.close()
+            slotSize = self._slotSize(numPixels)
+            self.mm = self._map(HEADER_SIZE + numSlots * slotSize, False)
+            if self.inode != headerInode:
+                self.mm.close()
+                raise SharedMemoryError(''.join(('Spectrum ring ', name, ' was replaced while opening it')))
+        self.numPixels = numPixels
+        self.numSlots = numSlots
+        self.header = np.ndarray(shape=(HEADER_SIZE // 8,), dtype=np.uint64, buffer=self.mm)
+        self.meta = np.ndarray(shape=(numSlots, 4), dtype=np.uint64, buffer=self.mm,
+                               offset=HEADER_SIZE, strides=(slotSize, 8))
+        self.sequence = np.ndarray(shape=(numSlots,), dtype=np.int64, buffer=self.mm,
+                                   offset=HEADER_SIZE + 8 * S_SEQUENCE, strides=(slotSize,))
+        self.times = np.ndarray(shape=(numSlots, 4), dtype=np.float64, buffer=self.mm,
+                                offset=HEADER_SIZE + 32, strides=(slotSize, 8))
+        self.data = np.ndarray(shape=(numSlots, numPixels), dtype=np.uint16, buffer=self.mm,
+                               offset=HEADER_SIZE + SLOT_META_SIZE, strides=(slotSize, 2))
+        if create == True:
+            self.header[H_MAGIC] = MAGIC
+            self.header[H_VERSION] = VERSION
+            self.header[H_NUM_PIXELS] = numPixels
+            self.header[H_NUM_SLOTS] = numSlots
+            self.header[H_WRITE_COUNT] = 0
+            self.header[H_WRITER_PID] = os.getpid()
+            if self.newPath is not None:
+                os.rename(self.newPath, self.path)
+                self.newPath = None
+        if hasattr(socket, 'AF_UNIX') == True and sys.platform != 'win32':
+            if create == True:
+                self.wakeSocket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                self.wakeSocket.setblocking(False)
+            elif wakeup == True:
+                self._bindWakeup()
+
+    def _bindWakeup(self):
+        # Unique per reader, a process may open the same ring twice
+        path = ''.join((_path(self.name), '.wake.', str(os.getpid()), '.', str(id(self))))
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.bind(path)
+        except socket.error:
+            # Fall back to sleeping in wait()
+            sock.close()
+            return
+        sock.setblocking(False)
+        self.wakeSocket = sock
+        self.wakePath = path
+
+    def _slotSize(self, numPixels):
+        return SLOT_META_SIZE + (2 * numPixels + 7) // 8 * 8
+
+    def _map(self, size, create):
+        if sys.platform == 'win32':
+            # Opening a tagname that does not exist creates an empty one,
+            # which fails the magic check
+            return mmap.mmap(-1, size, tagname=self.name)
+        path = _path(self.name)
+        if create == True:
+            self._checkWriter(path)
+            # Published under path by __init__ once the header is written
+            newPath = ''.join((path, '.new.', str(os.getpid())))
+            try:
+                os.unlink(newPath)
+            except OSError:
+                pass
+            fd = os.open(newPath, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+            self.path = path
+            self.newPath = newPath
+        else:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError, e:
+                raise SharedMemoryError(''.join(('No spectrum ring ', self.name, ': ', str(e))))
+        try:
+            self.inode = os.fstat(fd).st_ino
+            if create == True:
+                os.ftruncate(fd, size)
+                return mmap.mmap(fd, size)
+            if os.fstat(fd).st_size < size:
+                raise SharedMemoryError(''.join(('Spectrum ring ', self.name, ' is truncated')))
+            return mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+
+    def _checkWriter(self, path):
+        """Raises SharedMemoryError if the segment at path belongs to another
+        live writer process.
+        """
+        try:
+            with open(path, 'rb') as f:
+                words = np.frombuffer(f.read(HEADER_SIZE), dtype=np.uint64)
+        except IOError:
+            return
+        if words.shape[0] < HEADER_SIZE // 8 or words[H_MAGIC] != MAGIC:
+            return
+        pid = int(words[H_WRITER_PID])
+        if pid == os.getpid() or pid <= 0:
+            return
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            if e.errno == errno.ESRCH:
+                # Left behind by a writer that died
+                return
+        raise SharedMemoryError(''.join(('Spectrum ring ', self.name, ' is in use by process ', str(pid))))
+
+    def replaced(self):
+        """True if the name now refers to a different segment than the one
+        mapped, i.e. the writer was restarted and created a new one. False
+        while no segment of that name exists. A named mapping on Windows lives
+        as long as anybody maps it, so a restarted writer reuses it and this is
+        always False there.
+        """
+        if self.inode is None:
+            return False
+        try:
+            return os.stat(_path(self.name)).st_ino != self.inode
+        except OSError:
+            return False
+
+    def writeCount(self):
+        """Number of frames written so far, 0 before the first."""
+        return int(self.header[H_WRITE_COUNT])
+
+    def write(self, frame, frameInfo):
+        """Publishes frame with its (sequence, startTime, endTime, timestamp)
+        frameInfo, as returned by getFrameInfo(). Writer only.
+        """
+        count = int(self.header[H_WRITE_COUNT]) + 1
+        slot = (count - 1) % self.numSlots
+        meta = self.meta[slot]
+        meta[S_LOCK] += 1
+        meta[S_COUNT] = count
+        self.sequence[slot] = frameInfo[0]
+        self.times[slot, 0:3] = frameInfo[1:4]
+        self.data[slot] = frame
+        meta[S_LOCK] += 1
+        self.header[H_WRITE_COUNT] = count
+        if self.wakeSocket is not None:
+            self._notifyReaders()
+
+    def _notifyReaders(self):
+        now = monotonic()
+        if self.wakeScanTime is None or now - self.wakeScanTime > WAKEUP_SCAN_INTERVAL:
+            self.wakeScanTime = now
+            self.wakeAddresses = glob.glob(''.join((_path(self.name), '.wake.*')))
+        for address in self.wakeAddresses:
+            try:
+                self.wakeSocket.sendto(b'\0', address)
+            except socket.error, e:
+                if e.errno == errno.ECONNREFUSED:
+                    # Left behind by a reader that died, nobody is bound
+                    try:
+                        os.unlink(address)
+                    except OSError:
+                        pass
+                # A full socket already has a wakeup pending
+
+    def wakeupEnabled(self):
+        """True if wait() returns as soon as a frame is written."""
+        return self.create == False and self.wakeSocket is not None
+
+    def wait(self, timeout):
+        """Waits at most timeout s for the writer to publish a frame.
+        Returns True if woken by a write, which may be one already read.
+        Without wakeup it sleeps timeout s and returns False. Reader only.
+        """
+        if self.wakeupEnabled() == False:
+            time.sleep(timeout)
+            return False
+        try:
+            readable = select.select([self.wakeSocket], [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return False
+        if len(readable) == 0:
+            return False
+        # One read serves all the writes signalled so far
+        try:
+            while True:
+                self.wakeSocket.recv(64)
+        except socket.error:
+            pass
+        return True
+
+    def read(self, lastCount=0, retries=100, out=None):
+        """Returns (count, frame, frameInfo) of the newest frame if it is newer
+        than write count lastCount, None otherwise. The frame is copied into
+        out, or into a new array if out is None. A reader that keeps the
+        frame passes None, one that converts it right away reuses its out.
+        """
+        for attempt in range(retries):
+            count = int(self.header[H_WRITE_COUNT])
+            if count == 0 or count == lastCount:
+                return None
+            slot = (count - 1) % self.numSlots
+            meta = self.meta[slot]
+            lock = int(meta[S_LOCK])
+            if lock & 1 == 1 or int(meta[S_COUNT]) != count:
+                continue
+            if out is None:
+                out = np.empty(self.numPixels, dtype=np.uint16)
+            out[:] = self.data[slot]
+            frameInfo = (int(self.sequence[slot]), float(self.times[slot, 0]),
+                         float(self.times[slot, 1]), float(self.times[slot, 2]))
+            if int(meta[S_LOCK]) == lock:
+                return count, out, frameInfo
+        raise SharedMemoryError(''.join(('Spectrum ring ', self.name, ' kept changing during read')))
+
+    def close(self):
+        """Unmaps the segment, the writer also removes it."""
+        # The views point into the mapping and must go first
+        self.header = self.meta = self.sequence = self.times = self.data = None
+        if self.wakeSocket is not None:
+            self.wakeSocket.close()
+            self.wakeSocket = None
+        if self.wakePath is not None:
+            try:
+                os.unlink(self.wakePath)
+            except OSError:
+                pass
+            self.wakePath = None
+        try:
+            self.mm.close()
+        except Exception:
+            pass
+        if self.create == True and self.path is not None:
+            for path in (self.newPath, self.path):
+                try:
+                    # A later writer may have taken over the name
+                    if path is not None and os.stat(path).st_ino == self.inode:
+                        os.unlink(path)
+                except OSError:
+                    pass
+            self.path = None
+            self.newPath = None
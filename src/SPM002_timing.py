@@ -0,0 +1,141 @@
+# -*- coding:utf-8 -*-
+"""
+Created on Oct 17, 2026
+
+Timing helpers for the SPM002 acquisition loops.
+"""
+import ctypes
+import ctypes.util
+import sys
+import time
+
+
+def _linuxMonotonic():
+    """Builds a monotonic() on top of clock_gettime(CLOCK_MONOTONIC)."""
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    CLOCK_MONOTONIC = 1
+    libname = ctypes.util.find_library('rt') or ctypes.util.find_library('c')
+    clock_gettime = ctypes.CDLL(libname, use_errno=True).clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    ts = timespec()
+
+    def monotonic():
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+
+# monotonic() returns seconds from an arbitrary origin that never jumps
+# with wall clock adjustments. Only differences between values are meaningful.
+if hasattr(time, 'monotonic'):
+    monotonic = time.monotonic
+elif sys.platform == 'win32':
+    # time.clock is the performance counter on windows
+    monotonic = time.clock
+else:
+    try:
+        monotonic = _linuxMonotonic()
+    except (OSError, AttributeError, TypeError):
+        monotonic = time.time
+
+
+class FramePacer(object):
+    """Decides when the next frame is due and measures the achieved rate.
+
+    Modes:
+        fixedrate: a frame starts every period s. The schedule is kept on the
+                   original grid, so the rate does not drift with the time the
+                   acquisition takes. If a frame starts more than one period
+                   late the missed slots are skipped and counted in lateFrames.
+        fastest: the next frame is due as soon as the previous one is done.
+        fixeddelay: the next frame is due period s after the previous one
+                    finished.
+        continuous: free running acquisition, the hardware arms the next
+                    exposure as soon as the previous readout is done
+                    (SPM002control.streamSpectra). The pacer only measures
+                    the rate.
+
+    The acquisition loop calls timeToNext() to know how long it may block,
+    frameStarted() just before and frameDone() just after each acquisition.
+    """
+    FIXED_RATE = 'fixedrate'
+    FASTEST = 'fastest'
+    FIXED_DELAY = 'fixeddelay'
+    CONTINUOUS = 'continuous'
+    MODES = (FIXED_RATE, FASTEST, FIXED_DELAY, CONTINUOUS)
+
+    def __init__(self, period, mode=FIXED_RATE, window=20):
+        self.period = period
+        self.mode = None
+        self.window = window
+        self.startTimes = []
+        self.lateFrames = 0
+        self.nextDue = monotonic()
+        self.setMode(mode)
+
+    def setMode(self, mode):
+        if mode not in self.MODES:
+            raise ValueError(''.join(('Unknown pacing mode ', str(mode), ', use one of ', ', '.join(self.MODES))))
+        if mode != self.mode:
+            self.mode = mode
+            self.reset()
+
+    def setPeriod(self, period):
+        """Sets the period in s. The next frame is rescheduled from the last one."""
+        if self.mode == self.FIXED_RATE and len(self.startTimes) > 0:
+            self.nextDue = self.startTimes[-1] + period
+        self.period = period
+
+    def reset(self):
+        """Forgets the schedule and rate history, the next frame is due now."""
+        self.startTimes = []
+        self.lateFrames = 0
+        self.nextDue = monotonic()
+
+    def timeToNext(self, now=None):
+        """Returns the time in s until the next frame is due, <= 0 if it is due."""
+        if now is None:
+            now = monotonic()
+        return self.nextDue - now
+
+    def frameStarted(self, t=None):
+        if t is None:
+            t = monotonic()
+        self.startTimes.append(t)
+        if len(self.startTimes) > self.window:
+            del self.startTimes[0]
+        if self.mode == self.FIXED_RATE:
+            nextDue = self.nextDue + self.period
+            if nextDue <= t and self.period > 0:
+                missed = int((t - nextDue) / self.period) + 1
+                self.lateFrames += missed
+                nextDue += missed * self.period
+            self.nextDue = nextDue
+
+    def frameDone(self, t=None):
+        if t is None:
+            t = monotonic()
+        if self.mode in (self.FASTEST, self.CONTINUOUS):
+            self.nextDue = t
+        elif self.mode == self.FIXED_DELAY:
+            self.nextDue = t + self.period
+
+    def requestedRate(self):
+        """Returns the requested frame rate in Hz, 0 when there is none
+        (fastest, continuous).
+        """
+        if self.mode in (self.FASTEST, self.CONTINUOUS) or self.period <= 0:
+            return 0.0
+        return 1.0 / self.period
+
+    def achievedRate(self):
+        """Returns the frame rate in Hz measured over the last window frames."""
+        if len(self.startTimes) < 2:
+            return 0.0
+        dt = self.startTimes[-1] - self.startTimes[0]
+        if dt <= 0:
+            return 0.0
+        return (len(self.startTimes) - 1) / dt
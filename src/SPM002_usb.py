@@ -0,0 +1,618 @@
+# -*- coding:utf-8 -*-
+"""
+Created on Oct 17, 2026
+
+Native libusb backend for the SPM002 spectrometer. Exposes the same
+SPM002control interface as SPM002_control.py but talks to the hardware
+directly over USB instead of through the vendor DLL, so it runs on Linux.
+
+All hardware access goes through a SPM002Transport object. LibUSBTransport
+is the real implementation (python-libusb1), a test double implementing the
+same methods can be passed to SPM002control instead.
+
+The vendor request codes below are not yet checked against bus captures,
+so LibUSBTransport refuses to open the hardware unless the environment
+variable SPM002_USB_BACKEND is set to 1.
+"""
+import os
+import abc
+import numpy as np
+import struct
+import threading
+import time
+import collections
+from SPM002_ringbuffer import SpectrumRingBuffer
+from SPM002_timing import monotonic
+from SPM002_enumeration import DeviceEnumerator
+
+try:
+    import usb1
+except ImportError:
+    usb1 = None
+
+# USB ids of the SPM002-C
+VENDOR_ID = 0x04b4
+PRODUCT_ID = 0x1002
+
+INTERFACE = 0
+ENDPOINT_IN = 0x82
+
+# Opt in for the real hardware, see usbBackendEnabled()
+ENABLE_VARIABLE = 'SPM002_USB_BACKEND'
+
+# Vendor control requests for the command channel. Only the data channel is
+# documented in usb_protocol.md so far, these codes are unverified guesses.
+# Keep all request codes here so they can be checked against bus captures in
+# one place.
+CMD_GET_SERIAL = 0xb0
+CMD_GET_EXPOSURE = 0xb1
+CMD_SET_EXPOSURE = 0xb2
+CMD_GET_LUT = 0xb3
+CMD_ACQUIRE = 0xb4
+CMD_GET_FIRMWARE = 0xb5
+
+# Events passed to the HotplugMonitor listeners
+HOTPLUG_ARRIVED = 'arrived'
+HOTPLUG_LEFT = 'left'
+
+CONTROL_TIMEOUT = 1000  # ms
+READOUT_TIMEOUT = 1000  # ms, added to the exposure time for bulk reads
+
+# Data channel layout, see usb_protocol.md
+NUM_PIXELS = 3648
+GROUP_PIXELS = 31
+GROUP_SIZE = 2 + 2 * GROUP_PIXELS
+GROUP_WORDS = GROUP_SIZE // 2
+FULL_GROUPS = NUM_PIXELS // GROUP_PIXELS  # 117, the last group only holds 21 pixels
+GROUP_HEADER = 0x6031  # bytes 0x31 0x60 read as a little endian uint16
+FRAME_SIZE = 7532
+
+
+class SpectrometerError(Exception):
+    pass
+
+
+def usbBackendEnabled():
+    """True if the libusb backend may talk to real hardware. It sends
+    unverified vendor requests, so it has to be enabled explicitly with
+    SPM002_USB_BACKEND=1 until they are checked against bus captures.
+    """
+    return os.environ.get(ENABLE_VARIABLE, '').strip().lower() in ('1', 'true', 'yes')
+
+
+# Serial map shared by all SPM002control objects of the process, keyed by
+# (bus number, device address)
+enumerator = DeviceEnumerator()
+
+
+def decodeFrame(data, out=None):
+    """Decodes one raw 7532 byte frame into the 3648 pixel values.
+
+    data is any buffer holding the two bulk packets back to back. The pixels
+    are copied straight out of strided views of data into out (a uint16 array
+    of NUM_PIXELS elements, allocated if None), without per pixel Python code.
+    Raises SpectrometerError if the frame is short or a group header is wrong.
+    """
+    words = np.frombuffer(data, dtype='<u2')
+    if words.shape[0] != FRAME_SIZE // 2:
+        raise SpectrometerError(''.join(('Bad frame size ', str(len(data)), ' bytes')))
+    if out is None:
+        out = np.empty(NUM_PIXELS, dtype=np.uint16)
+    groups = words[:FULL_GROUPS * GROUP_WORDS].reshape(FULL_GROUPS, GROUP_WORDS)
+    tail = words[FULL_GROUPS * GROUP_WORDS:]
+    if (groups[:, 0] != GROUP_HEADER).any() or tail[0] != GROUP_HEADER:
+        raise SpectrometerError('Corrupt frame, group header mismatch')
+    out[:FULL_GROUPS * GROUP_PIXELS].reshape(FULL_GROUPS, GROUP_PIXELS)[...] = groups[:, 1:]
+    out[FULL_GROUPS * GROUP_PIXELS:] = tail[1:]
+    return out
+
+
+class SPM002Transport(object):
+    """Abstract byte level access to the SPM002 spectrometers on one host.
+
+    SPM002control only uses the methods below, so any object implementing
+    them (e.g. a test double replaying recorded frames) can stand in for the
+    real hardware. Errors are reported as SpectrometerError.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def listDevices(self):
+        """Returns a list of opaque device keys, one per connected spectrometer."""
+
+    @abc.abstractmethod
+    def open(self, key):
+        """Opens the device identified by key (as returned by listDevices)."""
+
+    @abc.abstractmethod
+    def close(self):
+        """Closes the open device, if any."""
+
+    @abc.abstractmethod
+    def controlRead(self, request, value, length):
+        """Issues a vendor IN control request and returns the response bytes."""
+
+    @abc.abstractmethod
+    def controlWrite(self, request, value, data=b''):
+        """Issues a vendor OUT control request."""
+
+    @abc.abstractmethod
+    def bulkRead(self, length, timeout):
+        """Reads length bytes from the data endpoint. timeout is in ms."""
+
+    @abc.abstractmethod
+    def startStream(self, length, numTransfers, callback):
+        """Queues numTransfers bulk IN transfers of length bytes on the data
+        endpoint. callback(buffer, actualLength) is called from pollStream for
+        every completed transfer, which is then resubmitted until stopStream.
+        """
+
+    @abc.abstractmethod
+    def pollStream(self, timeout):
+        """Waits up to timeout s for transfer completions and runs their callbacks."""
+
+    @abc.abstractmethod
+    def stopStream(self):
+        """Cancels the queued transfers and waits for them to return."""
+
+
+class LibUSBTransport(SPM002Transport):
+    """SPM002Transport on top of python-libusb1.
+
+    Device keys are (bus number, device address) tuples.
+    """
+    def __init__(self, context=None):
+        if usbBackendEnabled() == False:
+            raise SpectrometerError(''.join(('The libusb backend uses unverified vendor requests and is disabled, set ',
+                                             ENABLE_VARIABLE, '=1 to use it')))
+        if usb1 is None:
+            raise SpectrometerError('python-libusb1 (usb1) is needed for the libusb backend')
+        if context is None:
+            context = usb1.USBContext()
+        self.context = context
+        self.handle = None
+        self.streaming = False
+        self.streamTransfers = []
+        self.streamCallback = None
+        self.streamError = None
+
+    def listDevices(self):
+        keys = []
+        for device in self.context.getDeviceList(skip_on_error=True):
+            if device.getVendorID() == VENDOR_ID and device.getProductID() == PRODUCT_ID:
+                keys.append((device.getBusNumber(), device.getDeviceAddress()))
+        return keys
+
+    def open(self, key):
+        if self.handle is not None:
+            self.close()
+        for device in self.context.getDeviceList(skip_on_error=True):
+            if (device.getBusNumber(), device.getDeviceAddress()) == key:
+                try:
+                    handle = device.open()
+                    handle.claimInterface(INTERFACE)
+                except usb1.USBError as e:
+                    raise SpectrometerError(''.join(('Could not open device ', str(key), ': ', str(e))))
+                self.handle = handle
+                return
+        raise SpectrometerError(''.join(('Device ', str(key), ' not found on the bus')))
+
+    def close(self):
+        if self.handle is not None:
+            try:
+                self.handle.releaseInterface(INTERFACE)
+            except usb1.USBError:
+                pass
+            self.handle.close()
+            self.handle = None
+
+    def controlRead(self, request, value, length):
+        requestType = usb1.TYPE_VENDOR | usb1.RECIPIENT_DEVICE | usb1.ENDPOINT_IN
+        try:
+            return self.handle.controlRead(requestType, request, value, 0, length, CONTROL_TIMEOUT)
+        except usb1.USBError as e:
+            raise SpectrometerError(''.join(('Control request ', hex(request), ' failed: ', str(e))))
+
+    def controlWrite(self, request, value, data=b''):
+        requestType = usb1.TYPE_VENDOR | usb1.RECIPIENT_DEVICE | usb1.ENDPOINT_OUT
+        try:
+            self.handle.controlWrite(requestType, request, value, 0, data, CONTROL_TIMEOUT)
+        except usb1.USBError as e:
+            raise SpectrometerError(''.join(('Control request ', hex(request), ' failed: ', str(e))))
+
+    def bulkRead(self, length, timeout):
+        # The two data packets (4096 + 3436 bytes) are read back to back
+        # into one buffer; the short second packet terminates the transfer.
+        try:
+            return self.handle.bulkRead(ENDPOINT_IN, length, timeout)
+        except usb1.USBError as e:
+            raise SpectrometerError(''.join(('Bulk read failed: ', str(e))))
+
+    def startStream(self, length, numTransfers, callback):
+        if self.streaming == True:
+            self.stopStream()
+        self.streamCallback = callback
+        self.streamError = None
+        self.streamTransfers = []
+        self.streaming = True
+        try:
+            for k in range(numTransfers):
+                transfer = self.handle.getTransfer()
+                transfer.setBulk(ENDPOINT_IN, length, callback=self._transferDone)
+                transfer.submit()
+                self.streamTransfers.append(transfer)
+        except usb1.USBError as e:
+            self.stopStream()
+            raise SpectrometerError(''.join(('Could not queue bulk transfers: ', str(e))))
+
+    def _transferDone(self, transfer):
+        # Runs inside libusb event handling: no synchronous I/O here and no
+        # exceptions escaping, errors are raised later from pollStream.
+        status = transfer.getStatus()
+        if status == usb1.TRANSFER_CANCELLED:
+            return
+        if status == usb1.TRANSFER_COMPLETED:
+            try:
+                self.streamCallback(transfer.getBuffer(), transfer.getActualLength())
+            except Exception as e:
+                self.streamError = e
+        else:
+            self.streamError = SpectrometerError(''.join(('Bulk transfer failed with status ', str(status))))
+        if self.streaming == True:
+            try:
+                transfer.submit()
+            except usb1.USBError as e:
+                self.streamError = SpectrometerError(''.join(('Could not resubmit bulk transfer: ', str(e))))
+
+    def pollStream(self, timeout):
+        try:
+            self.context.handleEventsTimeout(timeout)
+        except usb1.USBError as e:
+            raise SpectrometerError(''.join(('Event handling failed: ', str(e))))
+        if self.streamError is not None:
+            e = self.streamError
+            self.streamError = None
+            raise e
+
+    def stopStream(self):
+        self.streaming = False
+        for transfer in self.streamTransfers:
+            try:
+                transfer.cancel()
+            except usb1.USBError:
+                pass
+        # Give the cancellations a bounded time to come back before freeing
+        t0 = monotonic()
+        while monotonic() - t0 < 1.0:
+            if not any(transfer.isSubmitted() for transfer in self.streamTransfers):
+                break
+            self.context.handleEventsTimeout(0.01)
+        for transfer in self.streamTransfers:
+            if not transfer.isSubmitted():
+                transfer.close()
+        self.streamTransfers = []
+
+
+class HotplugMonitor(object):
+    """Reports SPM002 arrivals and departures from libusb hotplug events.
+
+    A daemon thread handles the events of a private libusb context, so
+    listeners hear about a cable glitch as soon as the kernel does. Every
+    event invalidates the shared serial map before the listeners are
+    called as listener(event, key), event HOTPLUG_ARRIVED or HOTPLUG_LEFT
+    and key the (bus number, device address) of the device. Listeners run
+    in the monitor thread and must only hand the event over, e.g. by
+    queueing a command.
+    """
+    def __init__(self, context=None):
+        if usb1 is None:
+            raise SpectrometerError('python-libusb1 (usb1) is needed for hotplug monitoring')
+        if not usb1.hasCapability(usb1.CAP_HAS_HOTPLUG):
+            raise SpectrometerError('libusb has no hotplug support on this platform')
+        if context is None:
+            context = usb1.USBContext()
+        self.context = context
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.stopFlag = False
+        self.context.hotplugRegisterCallback(self._hotplug,
+                                             events=usb1.HOTPLUG_EVENT_DEVICE_ARRIVED | usb1.HOTPLUG_EVENT_DEVICE_LEFT,
+                                             flags=0, vendor_id=VENDOR_ID, product_id=PRODUCT_ID)
+        self.thread = threading.Thread(target=self._run, name='SPM002 hotplug')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def addListener(self, listener):
+        with self.lock:
+            if listener not in self.listeners:
+                self.listeners.append(listener)
+
+    def removeListener(self, listener):
+        with self.lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    def stop(self):
+        self.stopFlag = True
+        self.thread.join(3)
+
+    def _run(self):
+        # The timeout only bounds the time to notice stop()
+        while self.stopFlag == False:
+            try:
+                self.context.handleEventsTimeout(1.0)
+            except usb1.USBError:
+                time.sleep(0.1)
+
+    def _hotplug(self, context, device, event):
+        key = (device.getBusNumber(), device.getDeviceAddress())
+        if event == usb1.HOTPLUG_EVENT_DEVICE_ARRIVED:
+            self.notify(HOTPLUG_ARRIVED, key)
+        else:
+            self.notify(HOTPLUG_LEFT, key)
+        # False keeps the callback registered
+        return False
+
+    def notify(self, event, key):
+        enumerator.invalidate()
+        with self.lock:
+            listeners = list(self.listeners)
+        for listener in listeners:
+            try:
+                listener(event, key)
+            except Exception:
+                # A broken listener must not stop the monitor
+                pass
+
+
+_hotplugLock = threading.Lock()
+_hotplugMonitor = None
+
+
+def hotplugMonitor():
+    """Returns the process wide HotplugMonitor, started on the first call,
+    or None if hotplug events are not available.
+    """
+    global _hotplugMonitor
+    with _hotplugLock:
+        if _hotplugMonitor is None:
+            try:
+                _hotplugMonitor = HotplugMonitor()
+            except Exception:
+                return None
+        return _hotplugMonitor
+
+
+def resetAfterFork():
+    """Drops the process wide state a forked child inherits: the serial
+    map and the hotplug monitor, whose thread does not exist in the child
+    and whose libusb context must not be used there. Their locks may have
+    been held by threads of the parent, new ones are made.
+    """
+    global _hotplugLock, _hotplugMonitor
+    _hotplugLock = threading.Lock()
+    _hotplugMonitor = None
+    enumerator.reset()
+
+
+class SPM002control():
+    def __init__(self, transport=None, numBuffers=16):
+        if transport is None:
+            transport = LibUSBTransport()
+        self.transport = transport
+        self.deviceList = []
+        self.serialList = []
+        self.deviceHandle = None
+        self.deviceIndex = None
+        # Frames are decoded straight into a preallocated ring buffer,
+        # CCD is a read-only view of the latest frame
+        self.ringBuffer = SpectrumRingBuffer(numBuffers, NUM_PIXELS)
+        self.CCD = self.ringBuffer.latest()
+        self.exposure = None
+        self.streamFramesReady = 0
+        self.streamArmTimes = collections.deque()
+        self.streamLastEnd = None
+
+        self.LUT = None
+        self.wavelengths = np.zeros(NUM_PIXELS)
+
+    def populateDeviceList(self, rescan=False):
+        """Fills deviceList and serialList from the shared enumerator. The
+        bus is only scanned if the cached map is invalid or rescan is True.
+        """
+        self.deviceList, self.serialList = enumerator.devices(self._scanDevices, rescan)
+        if self.deviceHandle is not None:
+            try:
+                self.deviceIndex = self.deviceList.index(self.deviceHandle)
+            except ValueError:
+                self.closeDevice()
+
+    def _scanDevices(self, known):
+        # Listing the bus is cheap, only devices at a new bus path are opened
+        # to read their serial.
+        devices = []
+        openKey = self.deviceHandle
+        try:
+            for key in self.transport.listDevices():
+                serial = known.get(key)
+                if serial is None:
+                    if key == self.deviceHandle:
+                        serial = self._readSerial()
+                    else:
+                        # The transport holds one device at a time
+                        if self.deviceHandle is not None:
+                            self.transport.close()
+                            self.deviceHandle = None
+                        self.transport.open(key)
+                        try:
+                            serial = self._readSerial()
+                        finally:
+                            self.transport.close()
+                devices.append((key, serial))
+        finally:
+            if openKey is not None and self.deviceHandle is None:
+                self.transport.open(openKey)
+                self.deviceHandle = openKey
+        return devices
+
+    def openDeviceSerial(self, serial):
+        if serial not in self.serialList:
+            self.populateDeviceList()
+        try:
+            index = self.serialList.index(serial)
+        except ValueError:
+            raise SpectrometerError(''.join(('No device ', str(serial), ' found in list of connected spectrometers.')))
+        try:
+            self.openDeviceIndex(index)
+        except SpectrometerError:
+            # The device moved or was unplugged since the last scan
+            enumerator.invalidate()
+            raise
+
+    def openDeviceIndex(self, index):
+        if self.deviceHandle is not None:
+            self.closeDevice()
+        try:
+            key = self.deviceList[index]
+        except IndexError:
+            raise SpectrometerError('Error opening spectrometer')
+        self.transport.open(key)
+        self.deviceHandle = key
+        self.deviceIndex = index
+        self.exposure = None
+
+    def closeDevice(self):
+        if self.deviceHandle is not None:
+            self.transport.close()
+            self.deviceHandle = None
+            self.deviceIndex = None
+
+    def _readSerial(self):
+        return struct.unpack('<I', self.transport.controlRead(CMD_GET_SERIAL, 0, 4))[0]
+
+    def getSerial(self):
+        if self.deviceIndex is not None:
+            return self._readSerial()
+
+    def getFirmwareVersion(self):
+        if self.deviceIndex is not None:
+            return struct.unpack('<I', self.transport.controlRead(CMD_GET_FIRMWARE, 0, 4))[0]
+
+    def getExposureTime(self):
+        """Returns the exposure time in us"""
+        if self.deviceIndex is not None:
+            self.exposure = struct.unpack('<I', self.transport.controlRead(CMD_GET_EXPOSURE, 0, 4))[0]
+            return self.exposure
+
+    def setExposureTime(self, exposure):
+        """Sets the exposure time in us"""
+        if self.deviceIndex is not None:
+            exposure = int(exposure)
+            self.transport.controlWrite(CMD_SET_EXPOSURE, 0, struct.pack('<I', exposure))
+            self.exposure = exposure
+
+    def getLUT(self):
+        if self.deviceIndex is not None:
+            data = self.transport.controlRead(CMD_GET_LUT, 0, 16)
+            self.LUT = np.frombuffer(data, dtype='<f4').astype(np.float32)
+
+    def constructWavelengths(self):
+        if self.LUT is None:
+            self.getLUT()
+        if self.LUT is not None:
+            x = np.arange(self.wavelengths.shape[0], dtype=np.float64)
+            w = self.LUT[0] + self.LUT[1] * x + self.LUT[2] * x ** 2 + self.LUT[3] * x ** 3
+            self.wavelengths = w
+
+    def acquireSpectrum(self):
+        if self.deviceIndex is not None:
+            if self.exposure is None:
+                self.getExposureTime()
+            startTime = monotonic()
+            self.transport.controlWrite(CMD_ACQUIRE, 0)
+            data = self.transport.bulkRead(FRAME_SIZE, self.exposure // 1000 + READOUT_TIMEOUT)
+            endTime = monotonic()
+            decodeFrame(data, self.ringBuffer.nextSlot())
+            seq = self.ringBuffer.commit(startTime, endTime)
+            self.CCD = self.ringBuffer.latest()
+            return seq
+
+    def getFrameInfo(self):
+        """Returns (sequence, startTime, endTime, timestamp) of the latest frame.
+        startTime (exposure armed) and endTime (readout finished) are
+        monotonic, timestamp is the wall clock time when it was stored.
+        """
+        return self.ringBuffer.frameInfo()
+
+    def streamSpectra(self, numTransfers=4):
+        """Generator for streaming acquisition. Keeps numTransfers bulk IN
+        transfers queued and as many acquisitions armed, so the device starts
+        the next exposure while earlier frames are still being transferred
+        and processed. Every completed frame re-arms one acquisition. Yields
+        CCD, a read-only view of the newest frame in the ring buffer, once per
+        wakeup; frames completed in the same wakeup show up as gaps in the
+        frame sequence. Stops streaming when the generator is closed.
+        """
+        if self.deviceIndex is None:
+            return
+        if self.exposure is None:
+            self.getExposureTime()
+        self.streamFramesReady = 0
+        self.streamArmTimes = collections.deque()
+        self.streamLastEnd = None
+        self.transport.startStream(FRAME_SIZE, numTransfers, self._streamFrameDone)
+        try:
+            for k in range(numTransfers):
+                self._armStreamFrame()
+            while True:
+                # Re-read the exposure each frame, it may change while streaming
+                deadline = monotonic() + self._frameTimeout()
+                while self.streamFramesReady == 0:
+                    timeout = deadline - monotonic()
+                    if timeout <= 0:
+                        raise SpectrometerError('Timeout waiting for streamed frame')
+                    self.transport.pollStream(timeout)
+                for k in range(self.streamFramesReady):
+                    self._armStreamFrame()
+                self.streamFramesReady = 0
+                yield self.CCD
+        finally:
+            try:
+                # The acquisitions still armed would otherwise leave their
+                # frames in the endpoint for the next read
+                deadline = monotonic() + self._frameTimeout()
+                while len(self.streamArmTimes) > 0 and monotonic() < deadline:
+                    self.transport.pollStream(deadline - monotonic())
+            except SpectrometerError:
+                pass
+            self.transport.stopStream()
+
+    def _frameTimeout(self):
+        """Time in s to wait for one frame."""
+        return (self.exposure // 1000 + READOUT_TIMEOUT) * 1e-3
+
+    def _armStreamFrame(self):
+        self.streamArmTimes.append(monotonic())
+        self.transport.controlWrite(CMD_ACQUIRE, 0)
+
+    def _streamFrameDone(self, data, length):
+        if length != FRAME_SIZE:
+            raise SpectrometerError(''.join(('Short frame, got ', str(length), ' bytes')))
+        endTime = monotonic()
+        startTime = endTime
+        if len(self.streamArmTimes) > 0:
+            startTime = self.streamArmTimes.popleft()
+        # A queued acquisition only starts exposing when the previous one ends
+        if self.streamLastEnd is not None and self.streamLastEnd > startTime:
+            startTime = self.streamLastEnd
+        self.streamLastEnd = endTime
+        decodeFrame(data, self.ringBuffer.nextSlot())
+        self.ringBuffer.commit(startTime, endTime)
+        self.CCD = self.ringBuffer.latest()
+        self.streamFramesReady += 1
+
+
+if __name__ == '__main__':
+    spm = SPM002control()
+    spm.populateDeviceList()
+    print(spm.serialList)
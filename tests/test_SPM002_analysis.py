@@ -0,0 +1,60 @@
+# -*- coding:utf-8 -*-
+"""
+Tests of the peak position estimators in SPM002_analysis.
+"""
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from SPM002_analysis import peakPosition, PIXEL, PARABOLIC, GAUSSIAN, CENTROID
+
+
+def lineFrame(center, width=12.0, height=3000.0, background=200.0, numPixels=3648):
+    """Frame with one gaussian line of FWHM width pixels at the fractional
+    pixel position center.
+    """
+    x = np.arange(numPixels)
+    sigma = width / 2.355
+    return background + height * np.exp(-0.5 * ((x - center) / sigma) ** 2)
+
+
+def maxError(estimator, noiseFloor=200.0, **kwargs):
+    """Largest position error of estimator for a line moved across one
+    pixel in 0.05 pixel steps.
+    """
+    errors = []
+    for shift in np.arange(0, 1, 0.05):
+        frame = lineFrame(1800 + shift, **kwargs)
+        position = peakPosition(frame, frame.argmax(), estimator, noiseFloor)[0]
+        errors.append(position - (1800 + shift))
+    return np.abs(errors).max()
+
+
+class SubPixelTest(unittest.TestCase):
+    def test_pixel_is_within_half_a_pixel(self):
+        self.assertTrue(maxError(PIXEL) <= 0.5)
+
+    def test_parabolic(self):
+        self.assertTrue(maxError(PARABOLIC) < 0.05)
+
+    def test_gaussian(self):
+        self.assertTrue(maxError(GAUSSIAN) < 0.01)
+
+    def test_centroid(self):
+        self.assertTrue(maxError(CENTROID) < 0.01)
+
+    def test_centroid_with_local_baseline_above_noise_floor(self):
+        self.assertTrue(maxError(CENTROID, background=500.0) < 0.01)
+
+    def test_block_matches_rows(self):
+        frames = np.array([lineFrame(1000.3), lineFrame(2500.7)])
+        peakInd = frames.argmax(axis=1)
+        for estimator in (PARABOLIC, GAUSSIAN, CENTROID):
+            positions = peakPosition(frames, peakInd, estimator, np.array([200.0, 200.0]))
+            self.assertTrue(np.allclose(positions, [1000.3, 2500.7], atol=0.05))
+
+
+if __name__ == '__main__':
+    unittest.main()
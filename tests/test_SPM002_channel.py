@@ -0,0 +1,74 @@
+# -*- coding:utf-8 -*-
+"""
+Tests of ChannelHub and Channel in SPM002_channel.
+"""
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from SPM002_channel import ChannelHub, LATEST, LOSSLESS, DROP
+
+
+class DrainOrderTest(unittest.TestCase):
+    def test_items_come_out_in_put_order_across_channels(self):
+        hub = ChannelHub()
+        spectra = hub.channel('spectrum', LATEST, 10)
+        control = hub.channel('control', LOSSLESS, 10)
+        spectra.put('spectrum 1')
+        control.put('state ON')
+        spectra.put('spectrum 2')
+        control.put('state STANDBY')
+        self.assertEqual(hub.drain(0), ['spectrum 1', 'state ON', 'spectrum 2', 'state STANDBY'])
+
+    def test_overflow_policies(self):
+        hub = ChannelHub()
+        latest = hub.channel('latest', LATEST, 1)
+        drop = hub.channel('drop', DROP, 1)
+        latest.put(1)
+        latest.put(2)
+        drop.put(3)
+        self.assertFalse(drop.put(4))
+        self.assertEqual(hub.drain(0), [2, 3])
+        self.assertEqual(latest.counters(), (1, 1))
+        self.assertEqual(drop.counters(), (1, 1))
+
+
+class DrainWaitTest(unittest.TestCase):
+    def test_wait_without_timeout_wakes_up_at_once(self):
+        hub = ChannelHub()
+        channel = hub.channel('control', LOSSLESS, 10)
+        delays = []
+
+        def consume():
+            for k in range(20):
+                items = hub.drain()
+                delays.append(time.time() - items[0])
+
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+        for k in range(20):
+            time.sleep(0.02)
+            channel.put(time.time())
+        consumer.join(5)
+        self.assertEqual(len(delays), 20)
+        # Condition.wait(timeout) would sleep up to 50 ms between polls
+        self.assertTrue(sorted(delays)[10] < 0.005)
+
+    def test_wake_stops_the_consumer(self):
+        hub = ChannelHub()
+        hub.channel('control', LOSSLESS, 10)
+        result = []
+        consumer = threading.Thread(target=lambda: result.append(hub.drain()))
+        consumer.start()
+        time.sleep(0.05)
+        hub.wake()
+        consumer.join(1)
+        self.assertFalse(consumer.is_alive())
+        self.assertEqual(result, [[]])
+
+
+if __name__ == '__main__':
+    unittest.main()
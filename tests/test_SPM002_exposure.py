@@ -0,0 +1,68 @@
+# -*- coding:utf-8 -*-
+"""
+Tests of the AutoExposureController in SPM002_exposure.
+"""
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from SPM002_exposure import AutoExposureController, SATURATION
+
+
+def lineFrame(expTime, width=6.0, rate=20.0, background=100.0, numPixels=3648):
+    """Frame with one gaussian line of FWHM width pixels, rate counts per ms
+    at the peak, clipped at the ADC range like the hardware.
+    """
+    x = np.arange(numPixels)
+    sigma = width / 2.355
+    frame = background + rate * expTime * np.exp(-0.5 * ((x - numPixels // 2) / sigma) ** 2)
+    return np.minimum(frame, SATURATION).astype(np.uint16)
+
+
+def run(controller, expTime, numFrames, **kwargs):
+    """Feeds numFrames frames through controller, returns the exposure times
+    and saturation flags of the frames.
+    """
+    exposures = []
+    saturated = []
+    for k in range(numFrames):
+        frame = lineFrame(expTime, **kwargs)
+        exposures.append(expTime)
+        saturated.append(frame.max() >= SATURATION)
+        newExp = controller.update(frame, expTime)
+        if newExp is not None:
+            expTime = newExp
+    return exposures, saturated
+
+
+class NarrowLineTest(unittest.TestCase):
+    def test_settles_without_limit_cycle(self):
+        # 6 pixels are well inside the 0.5 % above the 99.5 percentile, so the
+        # level never reaches the target
+        exposures, saturated = run(AutoExposureController(), 100.0, 40)
+        self.assertEqual(len(set(exposures[-20:])), 1)
+        self.assertFalse(any(saturated[-20:]))
+        # Settled close below the shortest saturating exposure (about 200 ms)
+        self.assertTrue(150.0 < exposures[-1] < 200.0)
+
+    def test_cap_released_when_light_drops(self):
+        controller = AutoExposureController()
+        exposures, saturated = run(controller, 100.0, 20)
+        exposures, saturated = run(controller, exposures[-1], 20, rate=5.0)
+        self.assertFalse(any(saturated[-10:]))
+        # A quarter of the light allows a longer exposure than the old cap
+        self.assertTrue(exposures[-1] > 300.0)
+
+
+class BroadSpectrumTest(unittest.TestCase):
+    def test_reaches_target(self):
+        controller = AutoExposureController(target=2500.0)
+        exposures, saturated = run(controller, 10.0, 20, width=800.0)
+        level = controller.measure(lineFrame(exposures[-1], width=800.0))[0]
+        self.assertTrue(abs(level - 2500.0) / 2500.0 <= controller.tolerance)
+
+
+if __name__ == '__main__':
+    unittest.main()